@@ -15,7 +15,6 @@ import joblib
 import sys
 import numpy as np
 import torch
-from time import time
 
 current_dir = os.path.dirname(os.path.abspath('__file__'))
 root_dir = os.path.abspath(os.path.join(current_dir, '../../../'))
@@ -45,6 +44,10 @@ class AugmentedOnlineMixingDataset(Dataset):
     @note Each instance of the dataset should be stored using
     joblib.dump() and this is the way that it would be returned.
 
+    With shared_source_pool=True all the sources are loaded once in a
+    single tensor in shared memory, which all the DataLoader workers read,
+    instead of loading the files of each mixture in every worker.
+
     The path of all datasets should be defined inside config.
     All datasets should be formatted with appropriate subfolders of
     train / test and val and under them there should be all the
@@ -145,19 +148,37 @@ class AugmentedOnlineMixingDataset(Dataset):
             self.sample_folders.append(hier_folders_samples)
             self.n_sample_folders.append(n_hier_folders_samples)
 
+        self.shared_source_pool = self.kwargs.get('shared_source_pool', False)
+        if self.shared_source_pool:
+            self.create_source_pool()
+
+        # The number of samples of each hierarchical folder zero padded to
+        # n_datasets x max number of hierarchical folders, for indexing it
+        # with arrays of dataset and folder indices
+        self.n_sample_folders_table = np.zeros(
+            (self.n_datasets, max(self.n_hierarchical_folders)), dtype=int)
+        for dataset_idx, n_samples in enumerate(self.n_sample_folders):
+            self.n_sample_folders_table[dataset_idx, :len(n_samples)] = \
+                n_samples
+
         # If the dataset is fixed then just create the whole indexing
-        # beforehand.
+        # beforehand. Otherwise a new plan is drawn in each process for
+        # each epoch.
         self.fixed_seed = self.get_arg_and_check_validness(
             'fixed_seed', known_type=int, extra_lambda_checks=[lambda x: x >= 0])
+        self.rng = None
+        self.rng_worker_seed = None
+        self.used_plan_rows = None
         if self.fixed_seed == 0:
             print('Dataset is going to be created online for: {} '
                   'samples'.format(self.n_samples))
-            self.random_draws = None
         else:
             print('Dataset is fixed for: {} samples'.format(self.n_samples))
-            np.random.seed(self.fixed_seed)
-            self.random_draws = np.random.random(
-                (self.n_samples, self.n_sources, 5))
+            # Same draws as np.random.seed(fixed_seed) so the fixed
+            # partitions do not change
+            self.set_sampling_plan(
+                np.random.RandomState(self.fixed_seed).random_sample(
+                    (self.n_samples, self.n_sources, 5)))
 
     def get_n_batches(self):
         return self.n_batches
@@ -222,57 +243,132 @@ class AugmentedOnlineMixingDataset(Dataset):
                           "".format(path))
         return loaded_file
 
-    def get_selected_dataset_index(self, sample_idx, source_idx):
-        if self.random_draws is None:
-            random_draw = np.random.random()
-        else:
-            random_draw = self.random_draws[sample_idx, source_idx, 0]
-
-        for dataset_idx in range(self.n_datasets):
-            if random_draw < self.priors_cdf[dataset_idx]:
-                return dataset_idx
-        return self.n_datasets - 1
-
-    def get_selected_hierarchical_folder_index(
-            self, sample_idx, source_idx, dataset_idx, not_equal_to=None):
-        if self.random_draws is None:
-            random_draw = np.random.random()
-        else:
-            random_draw = self.random_draws[sample_idx, source_idx, 1]
-
-        ind = int(random_draw * self.n_hierarchical_folders[dataset_idx])
-        if not_equal_to is not None:
-            if ind == not_equal_to:
-                ind = (ind + 1) % self.n_hierarchical_folders[dataset_idx]
-
-        return ind
-
-    def get_selected_sample_folder_index(
-            self, sample_idx, source_idx, dataset_idx, hierarchical_folder_idx):
-        if self.random_draws is None:
-            random_draw = np.random.random()
-        else:
-            random_draw = self.random_draws[sample_idx, source_idx, 2]
-
-        return int(random_draw *
-                   self.n_sample_folders[dataset_idx][hierarchical_folder_idx])
-
-    def get_sample_delay(self, sample_idx, source_idx, tensor_samples):
-        if self.random_draws is None:
-            random_draw = np.random.random()
-        else:
-            random_draw = self.random_draws[sample_idx, source_idx, 3]
-
-        return int(random_draw * (tensor_samples - self.selected_wav_samples))
-
-    def get_snr_ratio(self, sample_idx, source_idx):
-        if self.random_draws is None:
-            random_draw = np.random.random()
-        else:
-            random_draw = self.random_draws[sample_idx, source_idx, 4]
+    def create_source_pool(self):
+        """!
+        Loads the sources of all the samples in a single tensor in shared
+        memory: n_channels x total_samples. The sources are concatenated
+        along the time axis and each one is indexed by its offset and its
+        length, so getting a source is only a slice of this tensor. The
+        extra return items are small and they are kept in a list.
+        """
+        item_folders = []
+        # self.pool_indices[dataset_idx][hierarchical_folder_idx][sample_idx]
+        self.pool_indices = []
+        for dataset_folders in self.sample_folders:
+            dataset_pool_indices = []
+            for hier_folder_samples in dataset_folders:
+                dataset_pool_indices.append(list(range(
+                    len(item_folders),
+                    len(item_folders) + len(hier_folder_samples))))
+                item_folders += hier_folder_samples
+            self.pool_indices.append(dataset_pool_indices)
+
+        print('Loading {} sources in shared memory...'.format(
+            len(item_folders)))
+        sources = joblib.Parallel(n_jobs=self.n_jobs)(
+            joblib.delayed(self.load_item_file)(
+                os.path.join(item_folder, self.return_items[0]))
+            for item_folder in item_folders)
+        n_channels = sources[0].shape[0]
+        if any([source.shape[0] != n_channels for source in sources]):
+            raise ValueError("All the sources must have the same number of "
+                             "channels for the shared source pool.")
+
+        self.pool_lengths = np.array([source.shape[-1] for source in sources])
+        self.pool_offsets = np.concatenate(
+            [[0], np.cumsum(self.pool_lengths)[:-1]])
+        self.source_pool = torch.empty(
+            (n_channels, int(self.pool_lengths.sum())),
+            dtype=sources[0].dtype).share_memory_()
+        for pool_idx in range(len(sources)):
+            offset = self.pool_offsets[pool_idx]
+            self.source_pool[:, offset:offset + self.pool_lengths[pool_idx]] \
+                = sources[pool_idx]
+            # Release each source as soon as it is copied
+            sources[pool_idx] = None
+
+        self.pool_extra_items = [
+            [self.load_item_file(os.path.join(item_folder, file))
+             for file in self.return_items[1:]]
+            for item_folder in item_folders]
+
+    def get_source_and_extra_items(self, dataset_idx, hier_folder_idx,
+                                   wav_idx):
+        if self.shared_source_pool:
+            pool_idx = self.pool_indices[dataset_idx][hier_folder_idx][wav_idx]
+            offset = self.pool_offsets[pool_idx]
+            source_tensor = self.source_pool[
+                :, offset:offset + self.pool_lengths[pool_idx]]
+            return source_tensor, self.pool_extra_items[pool_idx]
+
+        item_folder = \
+            self.sample_folders[dataset_idx][hier_folder_idx][wav_idx]
+        source_tensor = self.load_item_file(os.path.join(
+            item_folder, self.return_items[0]))
+        extra_items = [self.load_item_file(os.path.join(item_folder, file))
+                       for file in self.return_items[1:]]
+        return source_tensor, extra_items
+
+    def set_sampling_plan(self, random_draws):
+        """!
+        Turns the uniform draws of all the mixtures of an epoch into the
+        sampling plan of the epoch at once, so getting an item only reads
+        one row of each array.
 
-        return (random_draw - 0.5) * self.max_abs_snr * 2
-        # return np.random.normal(2.507, 2.1)
+        :param random_draws: n_samples x n_sources x 5 uniform draws in
+        [0, 1) for the dataset, the hierarchical folder, the sample, the
+        delay and the SNR of each source.
+        """
+        # Select with a prior probability between the list of datasets
+        dataset_indices = np.minimum(
+            np.searchsorted(self.priors_cdf, random_draws[:, :, 0],
+                            side='right'),
+            self.n_datasets - 1)
+
+        n_hier_folders = np.array(self.n_hierarchical_folders)[dataset_indices]
+        hier_folder_indices = (random_draws[:, :, 1] *
+                               n_hier_folders).astype(int)
+        # Avoid getting the same sound class as the first source
+        same_class = np.logical_and(
+            dataset_indices == dataset_indices[:, :1],
+            hier_folder_indices == hier_folder_indices[:, :1])
+        same_class[:, 0] = False
+        hier_folder_indices[same_class] = (
+            (hier_folder_indices[same_class] + 1) % n_hier_folders[same_class])
+
+        sample_indices = (random_draws[:, :, 2] * self.n_sample_folders_table[
+            dataset_indices, hier_folder_indices]).astype(int)
+
+        self.plan_dataset_indices = dataset_indices
+        self.plan_hier_folder_indices = hier_folder_indices
+        self.plan_sample_indices = sample_indices
+        # The delays depend on the length of each source so only the
+        # fraction of the available delay is kept
+        self.plan_delay_fractions = random_draws[:, :, 3]
+        self.plan_snr_ratios = (random_draws[:, 0, 4] - 0.5) * \
+            self.max_abs_snr * 2
+
+    def update_online_sampling_plan(self, mixture_idx):
+        """!
+        Draws a new sampling plan when the process has not drawn one yet or
+        when a mixture of the current plan is requested again, i.e. in the
+        next epoch. Each DataLoader worker gets the counter-based Philox
+        stream of its own seed, which torch changes in every epoch, so the
+        workers do not draw correlated plans. Without workers the stream is
+        seeded from the OS entropy.
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        worker_seed = None if worker_info is None else worker_info.seed
+        if self.rng is None or worker_seed != self.rng_worker_seed:
+            self.rng = np.random.Generator(np.random.Philox(key=worker_seed))
+            self.rng_worker_seed = worker_seed
+            self.used_plan_rows = None
+
+        if self.used_plan_rows is None or self.used_plan_rows[mixture_idx]:
+            self.set_sampling_plan(
+                self.rng.random((self.n_samples, self.n_sources, 5)))
+            self.used_plan_rows = np.zeros(self.n_samples, dtype=bool)
+        self.used_plan_rows[mixture_idx] = True
 
     def __getitem__(self, mixture_idx):
         """!
@@ -285,39 +381,23 @@ class AugmentedOnlineMixingDataset(Dataset):
         @throws If one of the desired objects cannot be loaded from
         disk then an IOError would be raised
         """
-        if self.random_draws is None:
-            the_time = int(np.modf(time())[0] * 100000000)
-            np.random.seed(the_time)
+        if self.fixed_seed == 0:
+            self.update_online_sampling_plan(mixture_idx)
 
         sources_wavs_l = []
         energies = []
-        prev_indexes = []
         extra_files = []
 
-        # Select with a prior probability between the list of datasets
         for source_idx in range(self.n_sources):
-            dataset_idx = self.get_selected_dataset_index(
-                mixture_idx, source_idx)
-
-            # Avoid getting the same sound class inside the mixture
-            not_equal_to = None
-            if len(prev_indexes) > 0:
-                prev_d_ind, prev_h_ind = prev_indexes[0]
-                if prev_d_ind == dataset_idx:
-                    not_equal_to = prev_h_ind
-            hier_folder_idx = self.get_selected_hierarchical_folder_index(
-                mixture_idx, source_idx, dataset_idx, not_equal_to=not_equal_to)
-            wav_idx = self.get_selected_sample_folder_index(
-                mixture_idx, source_idx, dataset_idx, hier_folder_idx)
-
-            prev_indexes.append([dataset_idx, hier_folder_idx])
-            item_folder = self.sample_folders[dataset_idx][hier_folder_idx][wav_idx]
-            source_tensor = self.load_item_file(os.path.join(
-                item_folder, self.return_items[0]))
+            source_tensor, extra_items = self.get_source_and_extra_items(
+                self.plan_dataset_indices[mixture_idx, source_idx],
+                self.plan_hier_folder_indices[mixture_idx, source_idx],
+                self.plan_sample_indices[mixture_idx, source_idx])
 
             # Random shifting of the source signals
-            samples_delay = self.get_sample_delay(
-                mixture_idx, source_idx, source_tensor.shape[-1])
+            samples_delay = int(
+                self.plan_delay_fractions[mixture_idx, source_idx] *
+                (source_tensor.shape[-1] - self.selected_wav_samples))
             delayed_source_tensor = source_tensor[
                 :, samples_delay:samples_delay+self.selected_wav_samples]
 
@@ -330,15 +410,12 @@ class AugmentedOnlineMixingDataset(Dataset):
 
             if len(self.return_items) > 1:
                 if len(extra_files) == 0:
-                    extra_files = [
-                        [self.load_item_file(os.path.join(item_folder, file))]
-                        for file in self.return_items[1:]]
+                    extra_files = [[extra_item] for extra_item in extra_items]
                 else:
-                    for j, file in enumerate(self.return_items[1:]):
-                        extra_files[j].append(
-                            self.load_item_file(os.path.join(item_folder, file)))
+                    for j, extra_item in enumerate(extra_items):
+                        extra_files[j].append(extra_item)
 
-        snr_ratio = self.get_snr_ratio(mixture_idx, 0)
+        snr_ratio = self.plan_snr_ratios[mixture_idx]
         new_energy_ratio = np.sqrt(np.power(10., snr_ratio / 10.))
 
         sources_wavs_l[0] = new_energy_ratio * sources_wavs_l[0] / (
@@ -417,6 +494,11 @@ def get_args():
                         checking in this return argument.""",
                         default=['wav'],
                         choices=['wav', 'wav_norm'])
+    parser.add_argument("--shared_source_pool", action='store_true',
+                        help="""Load all the sources once in shared memory
+                        for all the workers instead of loading the files
+                        of each mixture.""",
+                        default=False)
     return parser.parse_args()
 
 
@@ -425,7 +507,8 @@ def get_data_gen_from_loader(data_loader):
     generator_params = {'batch_size': data_loader.batch_size,
                         'shuffle': True,
                         'num_workers': data_loader.n_jobs,
-                        'drop_last': True}
+                        'drop_last': True,
+                        'pin_memory': torch.cuda.is_available()}
     data_generator = DataLoader(data_loader,
                                 **generator_params)
     return data_generator
@@ -527,6 +610,70 @@ def test_metadata_loading():
         # assert data[3].shape == torch.Size([int(bs), int(n_sources)])
 
 
+def test_sampling_plan():
+    these_args = argparse.Namespace(
+        input_dataset_p=[os.path.join(WSJ_MIX_HIERARCHICAL_P, 'test'),
+                         os.path.join(ESC50_HIERARCHICAL_P, 'test')],
+        datasets_priors=[0.5, 0.5],
+        batch_size=1,
+        n_jobs=4,
+        n_samples=1000,
+        return_items=['wav'],
+        fs=8000.,
+        selected_timelength=4.,
+        n_sources=2,
+        max_abs_snr=2.5,
+        fixed_seed=0
+    )
+    data_loader = AugmentedOnlineMixingDataset(**vars(these_args))
+    data_loader.update_online_sampling_plan(0)
+    prev_dataset_indices = data_loader.plan_dataset_indices
+
+    for i in range(1, len(data_loader)):
+        data_loader.update_online_sampling_plan(i)
+    # The same plan is used for the whole epoch
+    assert data_loader.plan_dataset_indices is prev_dataset_indices
+    data_loader.update_online_sampling_plan(0)
+    assert data_loader.plan_dataset_indices is not prev_dataset_indices
+
+    d_inds = data_loader.plan_dataset_indices
+    h_inds = data_loader.plan_hier_folder_indices
+    s_inds = data_loader.plan_sample_indices
+    assert np.all(h_inds < np.array(
+        data_loader.n_hierarchical_folders)[d_inds])
+    assert np.all(s_inds < data_loader.n_sample_folders_table[d_inds, h_inds])
+    assert not np.any(np.logical_and(d_inds[:, 0] == d_inds[:, 1],
+                                     h_inds[:, 0] == h_inds[:, 1]))
+    assert np.all(np.abs(data_loader.plan_snr_ratios) <=
+                  data_loader.max_abs_snr)
+
+
+def test_shared_source_pool():
+    these_args = argparse.Namespace(
+        input_dataset_p=[os.path.join(WSJ_MIX_HIERARCHICAL_P, 'test'),
+                         os.path.join(ESC50_HIERARCHICAL_P, 'test')],
+        datasets_priors=[0.5, 0.5],
+        batch_size=1,
+        n_jobs=4,
+        n_samples=50,
+        return_items=['wav'],
+        fs=8000.,
+        selected_timelength=4.,
+        n_sources=2,
+        max_abs_snr=2.5,
+        fixed_seed=7
+    )
+    data_loader = AugmentedOnlineMixingDataset(**vars(these_args))
+    these_args.shared_source_pool = True
+    pool_data_loader = AugmentedOnlineMixingDataset(**vars(these_args))
+
+    for i in range(len(data_loader)):
+        mixture, sources = data_loader[i]
+        pool_mixture, pool_sources = pool_data_loader[i]
+        assert torch.allclose(mixture, pool_mixture)
+        assert torch.allclose(sources, pool_sources)
+
+
 if __name__ == "__main__":
     # pytorch_dataloader_args = get_args()
     # example_of_usage(pytorch_dataloader_args)
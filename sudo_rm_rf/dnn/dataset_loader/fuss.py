@@ -12,6 +12,8 @@ import pickle
 import glob2
 import sudo_rm_rf.dnn.dataset_loader.abstract_dataset as \
     abstract_dataset
+import sudo_rm_rf.dnn.dataset_loader.length_bucketing as \
+    length_bucketing
 from scipy.io import wavfile
 from tqdm import tqdm
 from time import time
@@ -151,13 +153,28 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
 
         return zero_padded_sources_wavs
 
-    def get_generator(self, batch_size=4, shuffle=True, num_workers=4):
+    def get_generator(self, batch_size=4, shuffle=True, num_workers=4,
+                      distributed=False, pin_memory=True,
+                      evaluation=False):
+        """! With distributed=True each process of the initialized process
+        group gets a different part of the dataset, call
+        generator.sampler.set_epoch before each epoch to reshuffle it.
+        With evaluation=True no utterance is dropped or repeated, so the
+        losses of all the processes cover each utterance exactly once."""
         generator_params = {'batch_size': batch_size,
                             'shuffle': shuffle,
                             'num_workers': num_workers,
-                            'drop_last': True}
+                            'drop_last': not evaluation}
+        if distributed and evaluation:
+            generator_params['sampler'] = \
+                length_bucketing.StridedSampler(len(self))
+            generator_params['shuffle'] = False
+        elif distributed:
+            generator_params['sampler'] = \
+                torch.utils.data.DistributedSampler(self, shuffle=shuffle)
+            generator_params['shuffle'] = False
         return torch.utils.data.DataLoader(self, **generator_params,
-                                           pin_memory=True)
+                                           pin_memory=pin_memory)
 
 
 def test_generator():
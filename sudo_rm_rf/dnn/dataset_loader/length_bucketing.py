@@ -0,0 +1,191 @@
+"""!
+@brief Batching of full utterances of different lengths. Utterances of
+similar lengths are grouped in the same batch and padded to the longest one
+in the batch, together with a mask of the valid samples.
+
+The evaluation samplers split the utterances among the processes without
+the padding of DistributedSampler, so the losses gathered from all the
+processes cover each utterance exactly once. The processes may then get a
+different number of batches.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of illinois at Urbana Champaign
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import torch
+
+current_dir = os.path.dirname(os.path.abspath('__file__'))
+root_dir = os.path.abspath(os.path.join(current_dir, '../../../'))
+sys.path.append(root_dir)
+import sudo_rm_rf.dnn.experiments.utils.distributed as distributed
+
+
+class StridedSampler(torch.utils.data.Sampler):
+    """! Sampler for evaluation with multiple processes. Each process of the
+    initialized process group gets every world_size-th utterance, starting
+    from its rank, in a fixed order and without any repeated utterance."""
+
+    def __init__(self, n_items):
+        self.indices = list(range(distributed.get_rank(), n_items,
+                                  distributed.get_world_size()))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class BucketBySequenceLengthSampler(torch.utils.data.Sampler):
+    """! Batch sampler which yields the indices of utterances with similar
+    lengths. Use it as the batch_sampler of a DataLoader with pad_collate."""
+
+    def __init__(self, lengths, batch_size=4, max_batch_samples=None,
+                 shuffle=False, drop_last=False, distributed=False):
+        """
+        :param lengths: The number of samples of each utterance
+        :param batch_size: Maximum number of utterances per batch
+        :param max_batch_samples: If set, also limits the number of padded
+        samples per batch, so the batches of short utterances get more
+        utterances than the batches of long ones
+        :param shuffle: Shuffle the order of the batches in each epoch
+        :param drop_last: Drop the last batch if it is not full
+        :param distributed: Each process of the initialized process group
+        only gets every world_size-th utterance of the length-sorted ones,
+        starting from its rank, and batches them
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_batch_samples = max_batch_samples
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+        # The longest utterances come first so that a batch which does not
+        # fit in memory fails right away
+        order = np.argsort(-self.lengths, kind='stable').tolist()
+        if distributed:
+            order = order[torch.distributed.get_rank()::
+                          torch.distributed.get_world_size()]
+        self.batches, batch = [], []
+        for i in order:
+            if batch and self.max_batch_samples is not None and \
+                    (len(batch) + 1) * self.lengths[batch[0]] > \
+                    self.max_batch_samples:
+                self.batches.append(batch)
+                batch = []
+            batch.append(i)
+            if len(batch) == self.batch_size:
+                self.batches.append(batch)
+                batch = []
+        if batch and not self.drop_last:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        order = (np.random.permutation(len(self.batches)) if self.shuffle
+                 else np.arange(len(self.batches)))
+        for i in order:
+            yield self.batches[i]
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def pad_collate(batch):
+    """! Zero pads all the tensors of the items of a batch to the longest
+    item in the batch. The items are tuples of tensors with the time in the
+    last dimension, e.g. (mixture, sources) for WHAM and LIBRI2MIX or
+    (sources, targets) for WHAMR, and the valid length of each item is the
+    one of its first tensor.
+
+    :returns the padded first tensors: batch_size x ... x max_len
+             mask: batch_size x 1 x max_len with 1 on the valid samples
+             the rest of the padded tensors: batch_size x ... x max_len
+             The mask is second, so the first and the last tensors are at
+             the same positions as in the unpadded batches.
+    """
+    max_len = max(item[0].shape[-1] for item in batch)
+    padded = [torch.zeros((len(batch),) + tensor.shape[:-1] + (max_len,),
+                          dtype=tensor.dtype)
+              for tensor in batch[0]]
+    mask = torch.zeros(len(batch), 1, max_len)
+    for i, item in enumerate(batch):
+        for padded_tensors, tensor in zip(padded, item):
+            padded_tensors[i, ..., :tensor.shape[-1]] = tensor
+        mask[i, :, :item[0].shape[-1]] = 1.
+    return tuple([padded[0], mask] + padded[1:])
+
+
+def normalize_padded_wavs(wav_tensor, mask, eps=1e-8):
+    """! Same as normalize_tensor_wav but the statistics are computed only on
+    the valid samples of each utterance and the padding stays zero."""
+    n_valid = mask.sum(-1, keepdim=True)
+    mean = (wav_tensor * mask).sum(-1, keepdim=True) / n_valid
+    std = torch.sqrt((((wav_tensor - mean) * mask) ** 2).sum(-1, keepdim=True)
+                     / (n_valid - 1))
+    return (wav_tensor - mean) / (std + eps) * mask
+
+
+def test_pad_collate():
+    # WHAM, LIBRI2MIX: (mixture, sources)
+    batch = [(torch.ones(5), torch.ones(2, 5)),
+             (torch.ones(3), torch.ones(2, 3))]
+    mixtures, mask, sources = pad_collate(batch)
+    assert mixtures.shape == (2, 5) and sources.shape == (2, 2, 5)
+    assert mask[1, 0].tolist() == [1., 1., 1., 0., 0.]
+    assert sources[1, :, 3:].abs().sum() == 0
+
+    # WHAMR: (sources, targets)
+    batch = [(torch.ones(3, 4), torch.ones(3, 4)),
+             (torch.ones(3, 7), torch.ones(3, 7))]
+    sources, mask, targets = pad_collate(batch)
+    assert sources.shape == targets.shape == (2, 3, 7)
+    assert mask.shape == (2, 1, 7)
+    assert mask[0, 0].tolist() == [1.] * 4 + [0.] * 3
+    assert targets[0, :, 4:].abs().sum() == 0
+    assert torch.equal(targets[1], torch.ones(3, 7))
+
+
+def _gather_evaluated_items(rank, world_size, init_file, n_items, results):
+    torch.distributed.init_process_group(
+        'gloo', init_method='file://' + init_file, rank=rank,
+        world_size=world_size)
+    lengths = [10 + 7 * i % 5 for i in range(n_items)]
+    generators = {
+        'strided': torch.utils.data.DataLoader(
+            torch.arange(n_items), batch_size=2,
+            sampler=StridedSampler(n_items)),
+        'bucketed': torch.utils.data.DataLoader(
+            torch.arange(n_items), batch_sampler=BucketBySequenceLengthSampler(
+                lengths, batch_size=2, distributed=True))}
+    for name, generator in generators.items():
+        res_dic = {'item': {'mean': 0., 'std': 0., 'acc': []}}
+        for data in generator:
+            res_dic['item']['acc'] += data.tolist()
+        results[name + str(rank)] = distributed.gather_losses(
+            res_dic)['item']['acc']
+    torch.distributed.destroy_process_group()
+
+
+def test_distributed_eval_samplers():
+    n_items, world_size = 7, 2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = torch.multiprocessing.Manager().dict()
+        torch.multiprocessing.spawn(
+            _gather_evaluated_items,
+            args=(world_size, os.path.join(tmp_dir, 'init'), n_items,
+                  results),
+            nprocs=world_size)
+    for name in ['strided', 'bucketed']:
+        for rank in range(world_size):
+            gathered = results[name + str(rank)]
+            assert len(gathered) == n_items
+            assert sorted(gathered) == list(range(n_items))
+
+
+if __name__ == "__main__":
+    test_pad_collate()
+    test_distributed_eval_samplers()
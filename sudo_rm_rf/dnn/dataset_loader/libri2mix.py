@@ -8,8 +8,6 @@
 import torch
 import os
 import numpy as np
-import pickle
-import glob2
 
 import sys
 current_dir = os.path.dirname(os.path.abspath('__file__'))
@@ -17,8 +15,10 @@ root_dir = os.path.abspath(os.path.join(current_dir, '../../'))
 sys.path.append(root_dir)
 
 import sudo_rm_rf.dnn.dataset_loader.abstract_dataset as abstract_dataset
-from scipy.io import wavfile
-from tqdm import tqdm
+import sudo_rm_rf.dnn.dataset_loader.wav_shards as wav_shards
+import sudo_rm_rf.dnn.dataset_loader.wav_index as wav_index
+import sudo_rm_rf.dnn.dataset_loader.length_bucketing as \
+    length_bucketing
 
 EPS = 1e-8
 enh_single = {'mixture': 'mix_single',
@@ -93,8 +93,20 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
             extra_lambda_checks=[lambda y: os.path.lexists(y)])
         self.dataset_dirpath = self.get_path()
 
-        self.mixtures_info_metadata_path = os.path.join(
-            self.dataset_dirpath, 'metadata')
+        # Optionally read the pre-decoded shards of this split (see
+        # wav_shards.pack_split) instead of the wav files
+        self.shards = None
+        shards_root_dirpath = self.kwargs.get('shards_root_dirpath', None)
+        if shards_root_dirpath is not None:
+            self.shards = wav_shards.WavShards(os.path.join(
+                shards_root_dirpath,
+                os.path.relpath(self.dataset_dirpath, self.root_path)))
+
+        # The index of the files is cached outside of the dataset folder
+        self.metadata_cache_dirpath = self.kwargs.get(
+            'metadata_cache_dirpath', None)
+        if self.metadata_cache_dirpath is None:
+            self.metadata_cache_dirpath = wav_index.DEFAULT_CACHE_DIRPATH
 
         self.timelength = self.get_arg_and_check_validness(
             'timelength', known_type=float)
@@ -104,29 +116,16 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
         # Create the indexing for the dataset
         mix_folder_path = os.path.join(self.dataset_dirpath,
                                        WHAM_TASKS[self.task]['mixture'])
-        self.file_names = []
-        self.available_mixtures = glob2.glob(mix_folder_path + '/*.wav')
-
-        self.mixtures_info = []
         print('Parsing Dataset found at: {}...'.format(self.dataset_dirpath))
-        if not os.path.lexists(self.mixtures_info_metadata_path):
-            for file_path in tqdm(self.available_mixtures):
-                sample_rate, waveform = wavfile.read(file_path)
-                assert sample_rate == self.sample_rate
-                numpy_wav = np.array(waveform)
-                self.mixtures_info.append(
-                    [os.path.basename(file_path), numpy_wav.shape[0]])
-
-            print('Dumping metadata in: {}'.format(
-                self.mixtures_info_metadata_path))
-            with open(self.mixtures_info_metadata_path, 'wb') as filehandle:
-                pickle.dump(self.mixtures_info, filehandle)
-
-        if os.path.lexists(self.mixtures_info_metadata_path):
-            with open(self.mixtures_info_metadata_path, 'rb') as filehandle:
-                self.mixtures_info = pickle.load(filehandle)
-                print('Loaded metadata from: {}'.format(
-                    self.mixtures_info_metadata_path))
+        if self.shards is not None:
+            self.mixtures_info = self.shards.get_mixtures_info()
+        else:
+            file_names, lengths = wav_index.get_mixtures_info(
+                mix_folder_path, sample_rate=self.sample_rate,
+                cache_dirpath=self.metadata_cache_dirpath)
+            self.mixtures_info = [
+                [name, length] for name, length in zip(file_names.tolist(),
+                                                       lengths.tolist())]
 
         self.file_names = [(path, n_samples)
                            for (path, n_samples) in self.mixtures_info
@@ -135,6 +134,7 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
             self.file_names = self.file_names[:self.n_samples]
 
         max_time_samples = max([n_s for (_, n_s) in self.file_names])
+        self.file_lengths = [n_s for (_, n_s) in self.file_names]
         self.file_names = [x for (x, _) in self.file_names]
 
         # for the case that we need the whole audio input
@@ -161,16 +161,24 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
         else:
             return tensor_wav[:self.time_samples]
 
+    def read_wav(self, folder_name, filename, start=0, n_frames=None):
+        """! Reads only the frames [start, start + n_frames) of the file, by
+        default the whole file."""
+        if self.shards is not None:
+            return self.shards.read(folder_name, filename, start=start,
+                                    n_frames=n_frames)
+        return wav_index.read_wav_frames(
+            os.path.join(self.dataset_dirpath, folder_name, filename),
+            start=start, n_frames=n_frames)
+
     def __len__(self):
         return len(self.file_names)
 
     def __getitem__(self, idx):
         filename = self.file_names[idx]
 
-        mixture_path = os.path.join(self.dataset_dirpath,
-                                    WHAM_TASKS[self.task]['mixture'],
-                                    filename)
-        _, waveform = wavfile.read(mixture_path)
+        waveform = self.read_wav(WHAM_TASKS[self.task]['mixture'], filename,
+                                 n_frames=self.time_samples)
         mixture_wav = np.array(waveform)
         mixture_wav = torch.tensor(mixture_wav, dtype=torch.float32)
         mixture_wav = self.safe_pad(mixture_wav)
@@ -180,7 +188,8 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
             source_path = os.path.join(self.dataset_dirpath,
                                        source_name, filename)
             try:
-                _, waveform = wavfile.read(source_path)
+                waveform = self.read_wav(source_name, filename,
+                                         n_frames=self.time_samples)
             except Exception as e:
                 print(e)
                 raise IOError('Could not load file from: {}'.format(
@@ -199,13 +208,49 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
 
         return mixture_wav, sources_wavs
 
-    def get_generator(self, batch_size=4, shuffle=True, num_workers=4):
+    def get_generator(self, batch_size=4, shuffle=True, num_workers=4,
+                      distributed=False, pin_memory=False,
+                      evaluation=False):
+        """! With distributed=True each process of the initialized process
+        group gets a different part of the dataset, call
+        generator.sampler.set_epoch before each epoch to reshuffle it.
+        With evaluation=True no utterance is dropped or repeated, so the
+        losses of all the processes cover each utterance exactly once.
+        Use pin_memory=True for non-blocking copies to the gpu."""
         generator_params = {'batch_size': batch_size,
                             'shuffle': shuffle,
                             'num_workers': num_workers,
-                            'drop_last': True}
+                            'drop_last': not evaluation,
+                            'pin_memory': pin_memory}
+        if distributed and evaluation:
+            generator_params['sampler'] = \
+                length_bucketing.StridedSampler(len(self))
+            generator_params['shuffle'] = False
+        elif distributed:
+            generator_params['sampler'] = \
+                torch.utils.data.DistributedSampler(self, shuffle=shuffle)
+            generator_params['shuffle'] = False
         return torch.utils.data.DataLoader(self, **generator_params)
 
+    def get_bucketed_generator(self, batch_size=4, shuffle=False,
+                               num_workers=4, max_batch_samples=None,
+                               distributed=False, pin_memory=False):
+        """! Batches utterances of similar lengths which are padded to the
+        longest one in the batch. Each batch is: (mixtures, mask, sources)
+        with the mask of the valid samples of each utterance. Use it with
+        zero_pad=False, otherwise all the utterances are padded to
+        time_samples anyway."""
+        lengths = [self.time_samples if self.zero_pad
+                   else min(n_s, self.time_samples)
+                   for n_s in self.file_lengths]
+        sampler = length_bucketing.BucketBySequenceLengthSampler(
+            lengths, batch_size=batch_size,
+            max_batch_samples=max_batch_samples, shuffle=shuffle,
+            distributed=distributed)
+        return torch.utils.data.DataLoader(
+            self, batch_sampler=sampler, num_workers=num_workers,
+            collate_fn=length_bucketing.pad_collate, pin_memory=pin_memory)
+
 
 def test_generator():
     wham_root_p = '/mnt/data/libri_mix/Libri2Mix'
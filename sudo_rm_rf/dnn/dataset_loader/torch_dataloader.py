@@ -21,6 +21,7 @@ current_dir = os.path.dirname(os.path.abspath('__file__'))
 root_dir = os.path.abspath(os.path.join(current_dir, '../../../'))
 sys.path.append(root_dir)
 
+import torch
 from torch.utils.data import Dataset, DataLoader
 from sudo_rm_rf.utils import preprocess_wsj0mix
 
@@ -258,7 +259,8 @@ def get_data_gen_from_loader(data_loader):
     generator_params = {'batch_size': data_loader.batch_size,
                         'shuffle': True,
                         'num_workers': data_loader.n_jobs,
-                        'drop_last': True}
+                        'drop_last': True,
+                        'pin_memory': torch.cuda.is_available()}
     data_generator = DataLoader(data_loader,
                                 **generator_params)
     return data_generator
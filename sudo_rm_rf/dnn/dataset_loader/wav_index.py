@@ -0,0 +1,181 @@
+"""!
+@brief Fast indexing of the wav files of a dataset folder. Only the RIFF
+headers are parsed, in a pool of processes, and the resulting lengths are
+cached as numpy arrays outside of the (possibly read-only) dataset folder.
+The same header parsing is used for reading only a range of frames of a
+wav file, e.g. a random training crop of a long utterance.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of illinois at Urbana Champaign
+"""
+
+import os
+import struct
+import hashlib
+import multiprocessing
+import numpy as np
+from scipy.io import wavfile
+
+DEFAULT_CACHE_DIRPATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'sudo_rm_rf', 'metadata')
+
+
+# (format tag, bits per sample) -> numpy dtype of the samples
+PCM_FORMAT, FLOAT_FORMAT, EXTENSIBLE_FORMAT = 1, 3, 0xFFFE
+WAV_DTYPES = {(PCM_FORMAT, 8): np.uint8,
+              (PCM_FORMAT, 16): np.dtype('<i2'),
+              (PCM_FORMAT, 32): np.dtype('<i4'),
+              (PCM_FORMAT, 64): np.dtype('<i8'),
+              (FLOAT_FORMAT, 32): np.dtype('<f4'),
+              (FLOAT_FORMAT, 64): np.dtype('<f8')}
+
+
+def parse_wav_header(f, path):
+    """! Parses the chunks of an open wav file up to its data chunk.
+
+    Returns:
+        None if it is not a RIFF/WAVE file, otherwise a dict with the
+        sample_rate, n_channels, block_align, dtype (None for the formats
+        which are not in WAV_DTYPES), data_offset and n_frames.
+    """
+    riff_id, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff_id != b'RIFF' or wave_id != b'WAVE':
+        return None
+    file_size = os.fstat(f.fileno()).st_size
+    header = {}
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise IOError('No data chunk found in: {}'.format(path))
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'fmt ':
+            fmt = f.read(chunk_size)
+            format_tag, n_channels, sample_rate, _, block_align = \
+                struct.unpack('<HHIIH', fmt[:14])
+            bits_per_sample = struct.unpack('<H', fmt[14:16])[0] \
+                if chunk_size >= 16 else None
+            if format_tag == EXTENSIBLE_FORMAT and chunk_size >= 26:
+                format_tag = struct.unpack('<H', fmt[24:26])[0]
+            header.update(sample_rate=sample_rate, n_channels=n_channels,
+                          block_align=block_align,
+                          dtype=WAV_DTYPES.get((format_tag,
+                                                bits_per_sample)))
+            f.seek(chunk_size % 2, 1)
+        elif chunk_id == b'data':
+            # Some writers do not fill in the size of the data chunk
+            data_size = min(chunk_size, file_size - f.tell())
+            header.update(data_offset=f.tell(),
+                          n_frames=data_size // header['block_align'])
+            return header
+        else:
+            f.seek(chunk_size + chunk_size % 2, 1)
+
+
+def get_wav_info(path):
+    """! Returns the sample rate and the number of frames of a wav file by
+    reading only its header."""
+    with open(path, 'rb') as f:
+        header = parse_wav_header(f, path)
+    if header is None:
+        # Let scipy handle the rest of the formats
+        sample_rate, waveform = wavfile.read(path, mmap=True)
+        return sample_rate, waveform.shape[0]
+    return header['sample_rate'], header['n_frames']
+
+
+def read_wav_frames(path, start=0, n_frames=None):
+    """! Reads only the frames [start, start + n_frames) of a wav file by
+    seeking to them after the header, so the bytes which are read scale
+    with n_frames and not with the length of the file.
+
+    Args:
+        path: The path of the wav file
+        start: The first frame to read
+        n_frames: The number of frames to read, all the frames until the
+                  end of the file by default. Fewer frames are returned if
+                  the file ends before.
+
+    Returns:
+        The samples with the same dtype and shape as wavfile.read, i.e.
+        n_frames for one channel and n_frames x n_channels otherwise.
+    """
+    with open(path, 'rb') as f:
+        header = parse_wav_header(f, path)
+        if header is not None and header['dtype'] is not None:
+            start = min(start, header['n_frames'])
+            if n_frames is None:
+                n_frames = header['n_frames'] - start
+            n_frames = min(n_frames, header['n_frames'] - start)
+            f.seek(header['data_offset'] + start * header['block_align'])
+            waveform = np.frombuffer(
+                f.read(n_frames * header['block_align']),
+                dtype=header['dtype'])
+            if header['n_channels'] > 1:
+                waveform = waveform.reshape(-1, header['n_channels'])
+            return waveform
+
+    # Let scipy decode the rest of the formats, e.g. 24 bit PCM
+    _, waveform = wavfile.read(path)
+    if n_frames is None:
+        return waveform[start:]
+    return waveform[start:start + n_frames]
+
+
+def get_mixtures_info(folder_path,
+                      sample_rate=None,
+                      cache_dirpath=DEFAULT_CACHE_DIRPATH,
+                      n_jobs=None):
+    """! Returns the names and the lengths of all the wav files in a folder.
+
+    Args:
+        folder_path: The folder containing the wav files
+        sample_rate: If set, all files are checked to have this sample rate
+        cache_dirpath: The folder where the index is cached, keyed by the
+                       path and the modification time of folder_path. If
+                       it is not writable the index is just not cached.
+        n_jobs: Number of processes for parsing the headers, defaults to
+                the number of cpus
+
+    Returns:
+        file_names: numpy array of the sorted file names
+        lengths: numpy array of the numbers of samples of each file
+    """
+    folder_path = os.path.abspath(folder_path)
+    cache_key = hashlib.sha1('{}:{}'.format(
+        folder_path, os.stat(folder_path).st_mtime_ns).encode()).hexdigest()
+    cache_path = os.path.join(cache_dirpath, cache_key + '.npz')
+
+    if os.path.lexists(cache_path):
+        with np.load(cache_path) as index:
+            file_names = index['file_names']
+            sample_rates = index['sample_rates']
+            lengths = index['lengths']
+        print('Loaded metadata from: {}'.format(cache_path))
+    else:
+        file_names = np.array(sorted([entry.name
+                                      for entry in os.scandir(folder_path)
+                                      if entry.name.endswith('.wav')]))
+        paths = [os.path.join(folder_path, name) for name in file_names]
+        with multiprocessing.Pool(n_jobs) as pool:
+            wav_infos = pool.map(get_wav_info, paths, chunksize=64)
+        sample_rates = np.array([fs for fs, _ in wav_infos], dtype=np.int64)
+        lengths = np.array([n for _, n in wav_infos], dtype=np.int64)
+
+        try:
+            os.makedirs(cache_dirpath, exist_ok=True)
+            # Write and then rename so that concurrent readers never see a
+            # partially written index
+            tmp_path = cache_path + '.{}.tmp.npz'.format(os.getpid())
+            np.savez(tmp_path, file_names=file_names,
+                     sample_rates=sample_rates, lengths=lengths)
+            os.replace(tmp_path, cache_path)
+            print('Dumping metadata in: {}'.format(cache_path))
+        except OSError as e:
+            print('Could not cache metadata in: {} ({})'.format(
+                cache_dirpath, e))
+
+    if sample_rate is not None and np.any(sample_rates != sample_rate):
+        raise ValueError('Expected all files in: {} to have sample rate: {} '
+                         'but found: {}'.format(folder_path, sample_rate,
+                                                np.unique(sample_rates)))
+    return file_names, lengths
@@ -0,0 +1,225 @@
+"""!
+@brief Pre-decoded wav shards for the WHAM, WHAMR! and Libri2Mix loaders.
+
+All the wav files of a split are packed once in a few large .npy shards per
+folder (e.g. mix_clean, s1, s2) alongside a single index with the offset and
+the length of each file. The loaders memory-map the shards and slice the crop
+that they need directly instead of opening and decoding 3-4 wav files per
+item. The shards may store another dtype than the wav files, but the crops
+are read back in the scale of the wav files, so the loaders give the same
+samples with or without the shards.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of illinois at Urbana Champaign
+"""
+
+import os
+import numpy as np
+import glob2
+import sys
+
+current_dir = os.path.dirname(os.path.abspath('__file__'))
+root_dir = os.path.abspath(os.path.join(current_dir, '../../../'))
+sys.path.append(root_dir)
+import sudo_rm_rf.dnn.dataset_loader.wav_index as wav_index
+from scipy.io import wavfile
+from tqdm import tqdm
+
+INDEX_FILENAME = 'index.npz'
+
+
+def get_shard_path(shards_dirpath, folder_name, shard_id):
+    return os.path.join(shards_dirpath, folder_name,
+                        'shard_{:03d}.npy'.format(shard_id))
+
+
+def convert_samples(waveform, dtype):
+    """! Converts the samples of a wav file to dtype with the scaling of
+    scipy.io.wavfile: the integer samples are mapped to [-1, 1) by dividing
+    with 2 ** (bits - 1) and the float samples are clipped to [-1, 1) before
+    the multiplication. Integer to integer conversions, and integer to
+    float16 which cannot store all the 16 bit samples, are rejected."""
+    dtype = np.dtype(dtype)
+    if waveform.dtype == dtype:
+        return waveform
+    if np.issubdtype(waveform.dtype, np.integer):
+        if (not np.issubdtype(dtype, np.floating) or
+                dtype.itemsize < 4):
+            raise ValueError('Cannot convert {} samples to {} without '
+                             'losing precision'.format(waveform.dtype,
+                                                       dtype))
+        scale = 2. ** (8 * waveform.dtype.itemsize - 1)
+        return (waveform.astype(np.float64) / scale).astype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        scale = 2. ** (8 * dtype.itemsize - 1)
+        return np.round(np.clip(waveform.astype(np.float64), -1.,
+                                (scale - 1) / scale) * scale).astype(dtype)
+    return waveform.astype(dtype)
+
+
+def pack_split(dataset_dirpath,
+               shards_dirpath,
+               folder_names=None,
+               max_shard_samples=2 ** 28,
+               dtype=None):
+    """! Packs all the wav files of a dataset split in .npy shards.
+
+    Args:
+        dataset_dirpath: The path of the split, e.g.
+                         /mnt/data/wham/wav8k/min/tr
+        shards_dirpath: The path for storing the shards and the index
+        folder_names: The folders to pack. All the folders of the split which
+                      contain wav files are packed by default.
+        max_shard_samples: Maximum number of samples per shard
+        dtype: The dtype of the stored samples e.g. float16. By default the
+               dtype of the wav files is kept. The samples are scaled when
+               converted between integer and float dtypes, see
+               convert_samples.
+    """
+    if folder_names is None:
+        folder_names = sorted([
+            f for f in os.listdir(dataset_dirpath)
+            if glob2.glob(os.path.join(dataset_dirpath, f, '*.wav'))])
+    file_names = sorted([
+        os.path.basename(p) for p in
+        glob2.glob(os.path.join(dataset_dirpath, folder_names[0], '*.wav'))])
+
+    _, waveform = wavfile.read(
+        os.path.join(dataset_dirpath, folder_names[0], file_names[0]),
+        mmap=True)
+    wav_dtype = waveform.dtype
+    if dtype is None:
+        dtype = wav_dtype
+    # Fail before packing anything if the conversion is not supported
+    convert_samples(waveform[:1], dtype)
+
+    # Only the headers are parsed
+    lengths = []
+    for file_name in tqdm(file_names, desc='Indexing'):
+        wav_lengths = set()
+        for folder_name in folder_names:
+            _, n_frames = wav_index.get_wav_info(
+                os.path.join(dataset_dirpath, folder_name, file_name))
+            wav_lengths.add(n_frames)
+        if len(wav_lengths) > 1:
+            raise ValueError('Files with name: {} have different lengths '
+                             'across folders: {}'.format(file_name,
+                                                         wav_lengths))
+        lengths.append(wav_lengths.pop())
+    lengths = np.array(lengths, dtype=np.int64)
+
+    # Assign consecutive files to shards
+    shard_ids = np.zeros(len(lengths), dtype=np.int32)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    shard_id, offset = 0, 0
+    for i, length in enumerate(lengths):
+        if offset > 0 and offset + length > max_shard_samples:
+            shard_id, offset = shard_id + 1, 0
+        shard_ids[i], offsets[i] = shard_id, offset
+        offset += length
+    shard_sizes = [int(lengths[shard_ids == s].sum())
+                   for s in range(shard_id + 1)]
+
+    for folder_name in folder_names:
+        os.makedirs(os.path.join(shards_dirpath, folder_name), exist_ok=True)
+        shards = [np.lib.format.open_memmap(
+            get_shard_path(shards_dirpath, folder_name, s), mode='w+',
+            dtype=dtype, shape=(size,)) for s, size in enumerate(shard_sizes)]
+        for i, file_name in enumerate(tqdm(file_names,
+                                           desc='Packing ' + folder_name)):
+            _, waveform = wavfile.read(
+                os.path.join(dataset_dirpath, folder_name, file_name),
+                mmap=True)
+            shards[shard_ids[i]][offsets[i]:offsets[i] + lengths[i]] = \
+                convert_samples(waveform, dtype)
+        for shard in shards:
+            shard.flush()
+        del shards
+
+    np.savez(os.path.join(shards_dirpath, INDEX_FILENAME),
+             file_names=np.array(file_names),
+             folder_names=np.array(folder_names),
+             lengths=lengths, shard_ids=shard_ids, offsets=offsets,
+             wav_dtype=np.array(np.dtype(wav_dtype).str))
+    print('Packed {} files of {} in: {}'.format(
+        len(file_names), dataset_dirpath, shards_dirpath))
+
+
+class WavShards(object):
+    """! Read-only view of the shards of a split. The shards are
+    memory-mapped lazily so that every dataloader worker opens its own maps
+    instead of receiving pickled copies of the data."""
+
+    def __init__(self, shards_dirpath):
+        self.shards_dirpath = shards_dirpath
+        index_path = os.path.join(shards_dirpath, INDEX_FILENAME)
+        if not os.path.lexists(index_path):
+            raise IOError('Shards index: {} not found!'.format(index_path))
+        with np.load(index_path) as index:
+            self.file_names = index['file_names'].tolist()
+            self.folder_names = index['folder_names'].tolist()
+            self.lengths = index['lengths']
+            self.shard_ids = index['shard_ids']
+            self.offsets = index['offsets']
+            # The indices of the older shards do not store it, those shards
+            # always have the dtype of the wav files
+            self.wav_dtype = (np.dtype(str(index['wav_dtype']))
+                              if 'wav_dtype' in index.files else None)
+        self.file_index = {name: i for i, name in enumerate(self.file_names)}
+        self.shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_mixtures_info(self):
+        return [[name, int(length)]
+                for name, length in zip(self.file_names, self.lengths)]
+
+    def get_shard(self, folder_name, shard_id):
+        key = (folder_name, shard_id)
+        if key not in self.shards:
+            self.shards[key] = np.load(
+                get_shard_path(self.shards_dirpath, folder_name, shard_id),
+                mmap_mode='r')
+        return self.shards[key]
+
+    def read(self, folder_name, file_name, start=0, n_frames=None):
+        """! Returns a memory-mapped view of the frames
+        [start, start + n_frames) of the file (by default the whole file)
+        without copying any data, so only the selected crop is read. When
+        the shards store another dtype than the wav files, the crop is
+        converted back to the scale and the dtype of the wav files."""
+        i = self.file_index[file_name]
+        shard = self.get_shard(folder_name, int(self.shard_ids[i]))
+        length = self.lengths[i] - min(start, self.lengths[i])
+        if n_frames is not None:
+            length = min(length, n_frames)
+        offset = self.offsets[i] + min(start, self.lengths[i])
+        samples = shard[offset:offset + length]
+        if self.wav_dtype is not None and samples.dtype != self.wav_dtype:
+            samples = convert_samples(samples, self.wav_dtype)
+        return samples
+
+
+def test_convert_samples():
+    int_wav = np.array([-32768, -1, 0, 1, 32767], dtype=np.int16)
+    float_wav = convert_samples(int_wav, 'float32')
+    assert np.allclose(float_wav, int_wav / 32768.)
+    # The scaling is undone exactly and out of range samples are clipped
+    assert np.array_equal(convert_samples(float_wav, 'int16'), int_wav)
+    assert np.array_equal(
+        convert_samples(np.array([-1.5, 1.5], dtype=np.float32), 'int16'),
+        np.array([-32768, 32767], dtype=np.int16))
+    assert convert_samples(float_wav, 'float16').dtype == np.float16
+    for dtype in ['float16', 'int32']:
+        try:
+            convert_samples(int_wav, dtype)
+            assert False
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    test_convert_samples()
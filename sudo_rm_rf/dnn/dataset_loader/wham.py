@@ -8,17 +8,17 @@
 import torch
 import os
 import numpy as np
-import pickle
-import glob2
 import sys
 
 current_dir = os.path.dirname(os.path.abspath('__file__'))
 root_dir = os.path.abspath(os.path.join(current_dir, '../../../'))
 sys.path.append(root_dir)
 import sudo_rm_rf.dnn.dataset_loader.abstract_dataset as abstract_dataset
-from scipy.io import wavfile
+import sudo_rm_rf.dnn.dataset_loader.wav_shards as wav_shards
+import sudo_rm_rf.dnn.dataset_loader.wav_index as wav_index
+import sudo_rm_rf.dnn.dataset_loader.length_bucketing as \
+    length_bucketing
 import warnings
-from tqdm import tqdm
 from time import time
 
 EPS = 1e-8
@@ -96,8 +96,20 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
             extra_lambda_checks=[lambda y: os.path.lexists(y)])
         self.dataset_dirpath = self.get_path()
 
-        self.mixtures_info_metadata_path = os.path.join(
-            self.dataset_dirpath, 'metadata')
+        # Optionally read the pre-decoded shards of this split (see
+        # wav_shards.pack_split) instead of the wav files
+        self.shards = None
+        shards_root_dirpath = self.kwargs.get('shards_root_dirpath', None)
+        if shards_root_dirpath is not None:
+            self.shards = wav_shards.WavShards(os.path.join(
+                shards_root_dirpath,
+                os.path.relpath(self.dataset_dirpath, self.root_path)))
+
+        # The index of the files is cached outside of the dataset folder
+        self.metadata_cache_dirpath = self.kwargs.get(
+            'metadata_cache_dirpath', None)
+        if self.metadata_cache_dirpath is None:
+            self.metadata_cache_dirpath = wav_index.DEFAULT_CACHE_DIRPATH
 
         self.timelength = self.get_arg_and_check_validness(
             'timelength', known_type=float)
@@ -107,29 +119,16 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
         # Create the indexing for the dataset
         mix_folder_path = os.path.join(self.dataset_dirpath,
                                        WHAM_TASKS[self.task]['mixture'])
-        self.file_names = []
-        self.available_mixtures = glob2.glob(mix_folder_path + '/*.wav')
-
-        self.mixtures_info = []
         print('Parsing Dataset found at: {}...'.format(self.dataset_dirpath))
-        if not os.path.lexists(self.mixtures_info_metadata_path):
-            for file_path in tqdm(self.available_mixtures):
-                sample_rate, waveform = wavfile.read(file_path)
-                assert sample_rate == self.sample_rate
-                numpy_wav = np.array(waveform)
-                self.mixtures_info.append(
-                    [os.path.basename(file_path), numpy_wav.shape[0]])
-
-            print('Dumping metadata in: {}'.format(
-                self.mixtures_info_metadata_path))
-            with open(self.mixtures_info_metadata_path, 'wb') as filehandle:
-                pickle.dump(self.mixtures_info, filehandle)
-
-        if os.path.lexists(self.mixtures_info_metadata_path):
-            with open(self.mixtures_info_metadata_path, 'rb') as filehandle:
-                self.mixtures_info = pickle.load(filehandle)
-                print('Loaded metadata from: {}'.format(
-                    self.mixtures_info_metadata_path))
+        if self.shards is not None:
+            self.mixtures_info = self.shards.get_mixtures_info()
+        else:
+            file_names, lengths = wav_index.get_mixtures_info(
+                mix_folder_path, sample_rate=self.sample_rate,
+                cache_dirpath=self.metadata_cache_dirpath)
+            self.mixtures_info = [
+                [name, length] for name, length in zip(file_names.tolist(),
+                                                       lengths.tolist())]
 
         self.file_names = [(path, n_samples)
                            for (path, n_samples) in self.mixtures_info
@@ -138,6 +137,7 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
             self.file_names = self.file_names[:self.n_samples]
 
         max_time_samples = max([n_s for (_, n_s) in self.file_names])
+        self.file_lengths = [n_s for (_, n_s) in self.file_names]
         self.file_names = [x for (x, _) in self.file_names]
         print(len(self.file_names))
 
@@ -165,6 +165,16 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
         else:
             return tensor_wav[:self.time_samples]
 
+    def read_wav(self, folder_name, filename, start=0, n_frames=None):
+        """! Reads only the frames [start, start + n_frames) of the file, by
+        default the whole file."""
+        if self.shards is not None:
+            return self.shards.read(folder_name, filename, start=start,
+                                    n_frames=n_frames)
+        return wav_index.read_wav_frames(
+            os.path.join(self.dataset_dirpath, folder_name, filename),
+            start=start, n_frames=n_frames)
+
     def __len__(self):
         return len(self.file_names)
 
@@ -175,15 +185,19 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
 
         filename = self.file_names[idx]
 
-        mixture_path = os.path.join(self.dataset_dirpath,
-                                    WHAM_TASKS[self.task]['mixture'],
-                                    filename)
-        _, waveform = wavfile.read(mixture_path)
-        max_len = len(waveform)
+        # The crop is selected from the indexed length before opening any
+        # file, so only the frames of the crop are read
+        max_len = self.file_lengths[idx]
         rand_start = 0
         if self.augment and max_len > self.time_samples:
             rand_start = np.random.randint(0, max_len - self.time_samples)
-            waveform = waveform[rand_start:rand_start+self.time_samples]
+        # Without augmentation the whole mixture is normalized before it is
+        # cropped
+        mixture_frames = self.time_samples
+        if self.normalize_audio and not self.augment:
+            mixture_frames = None
+        waveform = self.read_wav(WHAM_TASKS[self.task]['mixture'], filename,
+                                 start=rand_start, n_frames=mixture_frames)
         mixture_wav = np.array(waveform)
         mixture_wav = torch.tensor(mixture_wav, dtype=torch.float32)
         # First normalize the mixture and then pad
@@ -196,11 +210,12 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
             source_path = os.path.join(self.dataset_dirpath,
                                        source_name, filename)
             try:
-                _, waveform = wavfile.read(source_path)
+                waveform = self.read_wav(source_name, filename,
+                                         start=rand_start,
+                                         n_frames=self.time_samples)
             except Exception as e:
                 print(e)
                 raise IOError('could not load file from: {}'.format(source_path))
-            waveform = waveform[rand_start:rand_start + self.time_samples]
             numpy_wav = np.array(waveform)
             source_wav = torch.tensor(numpy_wav, dtype=torch.float32)
             # First normalize the mixture and then pad
@@ -218,13 +233,49 @@ class Dataset(torch.utils.data.Dataset, abstract_dataset.Dataset):
 
         return mixture_wav, sources_wavs
 
-    def get_generator(self, batch_size=4, shuffle=True, num_workers=4):
+    def get_generator(self, batch_size=4, shuffle=True, num_workers=4,
+                      distributed=False, pin_memory=False,
+                      evaluation=False):
+        """! With distributed=True each process of the initialized process
+        group gets a different part of the dataset, call
+        generator.sampler.set_epoch before each epoch to reshuffle it.
+        With evaluation=True no utterance is dropped or repeated, so the
+        losses of all the processes cover each utterance exactly once.
+        Use pin_memory=True for non-blocking copies to the gpu."""
         generator_params = {'batch_size': batch_size,
                             'shuffle': shuffle,
                             'num_workers': num_workers,
-                            'drop_last': True}
+                            'drop_last': not evaluation,
+                            'pin_memory': pin_memory}
+        if distributed and evaluation:
+            generator_params['sampler'] = \
+                length_bucketing.StridedSampler(len(self))
+            generator_params['shuffle'] = False
+        elif distributed:
+            generator_params['sampler'] = \
+                torch.utils.data.DistributedSampler(self, shuffle=shuffle)
+            generator_params['shuffle'] = False
         return torch.utils.data.DataLoader(self, **generator_params)
 
+    def get_bucketed_generator(self, batch_size=4, shuffle=False,
+                               num_workers=4, max_batch_samples=None,
+                               distributed=False, pin_memory=False):
+        """! Batches utterances of similar lengths which are padded to the
+        longest one in the batch. Each batch is: (mixtures, mask, sources)
+        with the mask of the valid samples of each utterance. Use it with
+        zero_pad=False, otherwise all the utterances are padded to
+        time_samples anyway."""
+        lengths = [self.time_samples if self.zero_pad
+                   else min(n_s, self.time_samples)
+                   for n_s in self.file_lengths]
+        sampler = length_bucketing.BucketBySequenceLengthSampler(
+            lengths, batch_size=batch_size,
+            max_batch_samples=max_batch_samples, shuffle=shuffle,
+            distributed=distributed)
+        return torch.utils.data.DataLoader(
+            self, batch_sampler=sampler, num_workers=num_workers,
+            collate_fn=length_bucketing.pad_collate, pin_memory=pin_memory)
+
 
 def test_generator():
     wham_root_p = '/mnt/data/wham'
@@ -255,5 +306,45 @@ def test_generator():
     for mixture, sources in generator:
         assert mixture.shape[-1] == sources.shape[-1]
 
+def test_shards_match_wavs(sample_rate=8000):
+    import tempfile
+    from scipy.io import wavfile
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wham_root_p = os.path.join(tmp_dir, 'wham')
+        split_dirpath = os.path.join(wham_root_p, 'wav8k', 'min', 'tt')
+        for folder_name in ['mix_clean', 's1', 's2']:
+            os.makedirs(os.path.join(split_dirpath, folder_name))
+            for i, length in enumerate([8000, 9123, 12000]):
+                wavfile.write(
+                    os.path.join(split_dirpath, folder_name,
+                                 '{}.wav'.format(i)), sample_rate,
+                    np.random.randint(-12000, 12000, size=length,
+                                      dtype=np.int16))
+
+        loader_kwargs = dict(
+            root_dirpath=wham_root_p, task='sep_clean', split='tt',
+            sample_rate=sample_rate, timelength=-1., zero_pad=False,
+            min_or_max='min', augment=False, normalize_audio=False,
+            n_samples=0,
+            metadata_cache_dirpath=os.path.join(tmp_dir, 'cache'))
+        wav_dataset = Dataset(**loader_kwargs)
+        # The int16 samples are stored as they are or scaled to [-1, 1)
+        for dtype in [None, 'float32']:
+            shards_root_p = os.path.join(tmp_dir, 'shards_{}'.format(dtype))
+            wav_shards.pack_split(
+                split_dirpath,
+                os.path.join(shards_root_p, 'wav8k', 'min', 'tt'),
+                dtype=dtype)
+            shards_dataset = Dataset(shards_root_dirpath=shards_root_p,
+                                     **loader_kwargs)
+            assert shards_dataset.file_names == wav_dataset.file_names
+            for i in range(len(wav_dataset)):
+                for wav_tensor, shards_tensor in zip(wav_dataset[i],
+                                                     shards_dataset[i]):
+                    assert torch.equal(wav_tensor, shards_tensor)
+
+
 if __name__ == "__main__":
     test_generator()
+    test_shards_match_wavs()
@@ -16,13 +16,10 @@ from comet_ml import Experiment
 import torch
 from torch.nn import functional as F
 import numpy as np
-from tqdm import tqdm
-from pprint import pprint
 import sudo_rm_rf.dnn.experiments.utils.dataset_specific_params \
     as dataset_specific_params
+import sudo_rm_rf.dnn.experiments.utils.trainer as trainer
 import sudo_rm_rf.dnn.losses.sisdr as sisdr_lib
-import sudo_rm_rf.dnn.utils.cometml_loss_report as cometml_report
-import sudo_rm_rf.dnn.utils.metrics_logger as metrics_logger
 import sudo_rm_rf.dnn.utils.cometml_log_audio as cometml_audio_logger
 import sudo_rm_rf.dnn.experiments.utils.cmd_args_parser as parser
 import sudo_rm_rf.dnn.models.dprnn as dprnn
@@ -56,6 +53,7 @@ train_gen, val_gen, tr_val_gen = dataset_specific_params.get_data_loaders(hparam
 
 os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([cad
                                                for cad in hparams['cuda_devs']])
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 back_loss_tr_loss_name, back_loss_tr_loss = (
     'tr_back_loss_SISDRi',
@@ -106,7 +104,7 @@ for f in model.parameters():
 experiment.log_parameter('Parameters', numparams)
 print('Trainable Parameters: {}'.format(numparams))
 
-model = torch.nn.DataParallel(model).cuda()
+model = torch.nn.DataParallel(model).to(device)
 # model = model.cuda()
 
 if hparams['optimizer'] == 'adam':
@@ -126,102 +124,48 @@ else:
     raise NotImplementedError('Optimizer: {} is not available!'.format(
         hparams['optimizer']))
 
-all_losses = [back_loss_tr_loss_name] + \
-             [k for k in sorted(val_losses.keys())] + \
-             [k for k in sorted(tr_val_losses.keys())]
-
-tr_step = 0
-val_step = 0
-for i in range(hparams['n_epochs']):
-    res_dic = {}
-    for loss_name in all_losses:
-        res_dic[loss_name] = {'mean': 0., 'std': 0., 'acc': []}
-    print("Baseline Experiment: {} - {} || Epoch: {}/{}".format(
-        experiment.get_key(), experiment.get_tags(), i+1, hparams['n_epochs']))
-    model.train()
-
-    for data in tqdm(train_gen, desc='Training'):
-        opt.zero_grad()
-        m1wavs = data[0].cuda()
-        clean_wavs = data[-1].cuda()
-
-        rec_sources_wavs = model(m1wavs)
-
-        l = back_loss_tr_loss(rec_sources_wavs,
-                              clean_wavs,
-                              initial_mixtures=m1wavs.unsqueeze(1))
-        if hparams['clip_grad_norm'] > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                           hparams['clip_grad_norm'])
-        l.backward()
-        opt.step()
-
-        if hparams['optimizer'] == 'radam':
-            lr_scheduler.step()
-            warmup_scheduler.dampen()
-        res_dic[back_loss_tr_loss_name]['acc'].append(l.item())
-
-
-    if hparams['reduce_lr_every'] > 0:
-        if tr_step % hparams['reduce_lr_every'] == 0:
-            new_lr = (hparams['learning_rate'] /
-                      (hparams['divide_lr_by'] ** (tr_step // hparams['reduce_lr_every'])))
-            print('Reducing Learning rate to: {}'.format(new_lr))
-            for param_group in opt.param_groups:
-                param_group['lr'] = new_lr
-    tr_step += 1
-
-    if val_gen is not None:
-        model.eval()
-        with torch.no_grad():
-            for data in tqdm(val_gen, desc='Validation'):
-                m1wavs = data[0].cuda()
-                clean_wavs = data[-1].cuda()
-
-                rec_sources_wavs = model(m1wavs)
-
-                for loss_name, loss_func in val_losses.items():
-                    l = loss_func(rec_sources_wavs,
-                                  clean_wavs,
-                                  initial_mixtures=m1wavs.unsqueeze(1))
-                    res_dic[loss_name]['acc'] += l.tolist()
-
-            if hparams["log_audio"]:
-                audio_logger.log_batch(rec_sources_wavs, clean_wavs, m1wavs,
-                                       experiment, step=val_step)
-
-        val_step += 1
-
-    if tr_val_losses.values():
-        model.eval()
-        with torch.no_grad():
-            for data in tqdm(tr_val_gen, desc='Train Validation'):
-                m1wavs = data[0].cuda()
-                clean_wavs = data[-1].cuda()
-
-                rec_sources_wavs = model(m1wavs)
-
-                for loss_name, loss_func in tr_val_losses.items():
-                    l = loss_func(rec_sources_wavs,
-                                  clean_wavs,
-                                  initial_mixtures=m1wavs.unsqueeze(1))
-                    res_dic[loss_name]['acc'] += l.tolist()
-
-    if hparams["metrics_log_path"] is not None:
-        metrics_logger.log_metrics(res_dic, hparams["metrics_log_path"],
-                                   tr_step, val_step,
-                                   cometml_experiment=experiment)
-
-    res_dic = cometml_report.report_losses_mean_and_std(res_dic,
-                                                        experiment,
-                                                        tr_step,
-                                                        val_step)
-
-    model_class.save_if_best(
-        hparams['log_path'], model.module, opt, tr_step,
-        res_dic[back_loss_tr_loss_name]['mean'],
-        res_dic[val_loss_name]['mean'], val_loss_name.replace("_", ""),
-        cometml_experiment=experiment)
-    for loss_name in res_dic:
-        res_dic[loss_name]['acc'] = []
-    pprint(res_dic)
+
+class WarmupSchedule(trainer.Hook):
+    def on_train_step_end(self, trainer, loss):
+        lr_scheduler.step()
+        warmup_scheduler.dampen()
+
+
+class SaveIfBest(trainer.Hook):
+    def on_epoch_end(self, trainer, res_dic):
+        model_class.save_if_best(
+            hparams['log_path'], model.module, opt, trainer.tr_step,
+            res_dic[back_loss_tr_loss_name]['mean'],
+            res_dic[val_loss_name]['mean'], val_loss_name.replace("_", ""),
+            cometml_experiment=experiment)
+
+
+def prepare_batch(data):
+    return data[0], data[-1], {'initial_mixtures': data[0].unsqueeze(1)}
+
+
+def log_audio(val_set, rec_sources_wavs, clean_wavs, m1wavs, val_step):
+    if hparams["log_audio"] and val_set == 'val':
+        audio_logger.log_batch(rec_sources_wavs, clean_wavs, m1wavs,
+                               experiment, step=val_step)
+
+
+hooks = [trainer.StepLearningRate(hparams['learning_rate'],
+                                  hparams['divide_lr_by'],
+                                  hparams['reduce_lr_every'])]
+if hparams['optimizer'] == 'radam':
+    hooks.append(WarmupSchedule())
+if hparams["metrics_log_path"] is not None:
+    hooks.append(trainer.LogMetrics(hparams["metrics_log_path"]))
+hooks.append(SaveIfBest())
+
+trainer.Trainer(model, opt, back_loss_tr_loss,
+                {'train': train_gen, 'val': val_gen, 'train_val': tr_val_gen},
+                {'val': val_losses, 'train_val': tr_val_losses},
+                experiment, device, hparams['n_epochs'],
+                tr_loss_name=back_loss_tr_loss_name,
+                prepare_train_batch=prepare_batch,
+                prepare_eval_batch=prepare_batch,
+                clip_grad_norm=hparams['clip_grad_norm'],
+                log_audio=log_audio, hooks=hooks,
+                name='Baseline Experiment').fit()
@@ -17,20 +17,25 @@ from comet_ml import Experiment
 
 import torch
 
-from torch.nn import functional as F
-from tqdm import tqdm
-from pprint import pprint
 import sudo_rm_rf.dnn.experiments.utils.improved_cmd_args_parser_v2 as parser
 import sudo_rm_rf.dnn.experiments.utils.dataset_setup as dataset_setup
+import sudo_rm_rf.dnn.experiments.utils.distributed as distributed
+import sudo_rm_rf.dnn.experiments.utils.online_mixing as online_mixing
+import sudo_rm_rf.dnn.experiments.utils.trainer as trainer
+import sudo_rm_rf.dnn.dataset_loader.length_bucketing as length_bucketing
 import sudo_rm_rf.dnn.losses.sisdr as sisdr_lib
 import sudo_rm_rf.dnn.models.improved_sudormrf as improved_sudormrf
 import sudo_rm_rf.dnn.models.sudormrf as initial_sudormrf
-import sudo_rm_rf.dnn.utils.cometml_loss_report as cometml_report
+import sudo_rm_rf.dnn.models.reversible_sudormrf as reversible_sudormrf
 import sudo_rm_rf.dnn.utils.cometml_log_audio as cometml_audio_logger
 
 args = parser.get_args()
 hparams = vars(args)
-generators = dataset_setup.setup(hparams)
+os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(
+    [cad for cad in hparams['cuda_available_devices']])
+# One process (python) or one process per device (torchrun)
+device = distributed.init(hparams)
+generators = dataset_setup.setup(hparams, pin_memory=device.type == 'cuda')
 
 if hparams['separation_task'] == 'enh_single':
     hparams['n_sources'] = 1
@@ -41,14 +46,16 @@ if hparams["checkpoints_path"] is not None:
     if hparams["save_checkpoint_every"] <= 0:
         raise ValueError("Expected a value greater than 0 for checkpoint "
                          "storing.")
-    if not os.path.exists(hparams["checkpoints_path"]):
+    if (not os.path.exists(hparams["checkpoints_path"]) and
+            distributed.is_main_process()):
         os.makedirs(hparams["checkpoints_path"])
 
 # if hparams["log_audio"]:
 audio_logger = cometml_audio_logger.AudioLogger(
     fs=hparams["fs"], bs=hparams["batch_size"], n_sources=hparams["n_sources"])
 
-experiment = Experiment(API_KEY, project_name=hparams["project_name"])
+experiment = distributed.create_experiment(
+    Experiment, API_KEY, project_name=hparams["project_name"])
 experiment.log_parameters(hparams)
 experiment_name = '_'.join(hparams['cometml_tags'])
 for tag in hparams['cometml_tags']:
@@ -58,9 +65,6 @@ if hparams['experiment_name'] is not None:
 else:
     experiment.set_name(experiment_name)
 
-os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(
-    [cad for cad in hparams['cuda_available_devices']])
-
 back_loss_tr_loss_name, back_loss_tr_loss = (
     'tr_back_loss_SISDRi',
     sisdr_lib.PITLossWrapper(sisdr_lib.PairwiseNegSDR("sisdr"),
@@ -73,17 +77,14 @@ back_loss_tr_loss_name, back_loss_tr_loss = (
 )
 
 val_losses = {}
-all_losses = []
 for val_set in [x for x in generators if not x == 'train']:
     if generators[val_set] is None:
         continue
     val_losses[val_set] = {}
-    all_losses.append(val_set + '_SISDRi')
     val_losses[val_set][val_set + '_SISDRi'] = sisdr_lib.PermInvariantSISDR(
         batch_size=hparams['batch_size'], n_sources=hparams['n_sources'],
         zero_mean=True, backward_loss=False, improvement=True,
         return_individual_results=True)
-all_losses.append(back_loss_tr_loss_name)
 
 if hparams['model_type'] == 'relu':
     model = improved_sudormrf.SuDORMRF(out_channels=hparams['out_channels'],
@@ -94,7 +95,9 @@ if hparams['model_type'] == 'relu':
                                        enc_kernel_size=hparams[
                                            'enc_kernel_size'],
                                        enc_num_basis=hparams['enc_num_basis'],
-                                       num_sources=hparams['n_sources'])
+                                       num_sources=hparams['n_sources'],
+                                       early_exit_blocks=hparams[
+                                           'early_exit_blocks'])
 elif hparams['model_type'] == 'softmax':
     model = initial_sudormrf.SuDORMRF(out_channels=hparams['out_channels'],
                                       in_channels=hparams['in_channels'],
@@ -105,123 +108,108 @@ elif hparams['model_type'] == 'softmax':
                                           'enc_kernel_size'],
                                       enc_num_basis=hparams['enc_num_basis'],
                                       num_sources=hparams['n_sources'])
+elif hparams['model_type'] == 'reversible':
+    model = reversible_sudormrf.ReversibleSuDORMRF(
+        out_channels=hparams['out_channels'],
+        in_channels=hparams['in_channels'],
+        num_blocks=hparams['num_blocks'],
+        upsampling_depth=hparams['upsampling_depth'],
+        enc_kernel_size=hparams['enc_kernel_size'],
+        enc_num_basis=hparams['enc_num_basis'],
+        num_sources=hparams['n_sources'])
 else:
     raise ValueError('Invalid model: {}.'.format(hparams['model_type']))
+if hparams['early_exit_blocks'] and hparams['model_type'] != 'relu':
+    raise ValueError('Early exits are only available for the relu model.')
+if (hparams['checkpoint_every_k_blocks'] > 0 or
+        hparams['checkpoint_levels'] > 0):
+    if hparams['model_type'] != 'relu':
+        raise ValueError('Activation checkpointing is only available for '
+                         'the relu model.')
+    model.set_checkpointing(
+        every_k_blocks=hparams['checkpoint_every_k_blocks'],
+        highest_res_levels=hparams['checkpoint_levels'])
 
 numparams = 0
 for f in model.parameters():
     if f.requires_grad:
         numparams += f.numel()
 experiment.log_parameter('Parameters', numparams)
-print('Trainable Parameters: {}'.format(numparams))
+if distributed.is_main_process():
+    print('Trainable Parameters: {}'.format(numparams))
+
 
-model = torch.nn.DataParallel(model).cuda()
+class EarlyExitsForward(torch.nn.Module):
+    """! Makes the forward pass return the estimates of all the exits, so
+    that DataParallel splits the batch (and DistributedDataParallel syncs
+    the gradients) for the joint training of the early exit heads."""
+    def __init__(self, sudormrf_model):
+        super().__init__()
+        self.sudormrf_model = sudormrf_model
+
+    def forward(self, input_wav):
+        return self.sudormrf_model.forward_early_exits(input_wav)
+
+
+# With early exits only the wrapper which is trained syncs the gradients
+model = distributed.wrap_model(
+    model, device, sync_gradients=not hparams['early_exit_blocks'])
+tr_model = model
+if hparams['early_exit_blocks']:
+    tr_model = distributed.wrap_model(EarlyExitsForward(model.module), device)
 opt = torch.optim.Adam(model.parameters(), lr=hparams['learning_rate'])
 
 
-# lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-#     optimizer=opt, mode='max', factor=1. / hparams['divide_lr_by'],
-#     patience=hparams['patience'], verbose=True)
-
-
-def normalize_tensor_wav(wav_tensor, eps=1e-8, std=None):
-    mean = wav_tensor.mean(-1, keepdim=True)
-    if std is None:
-        std = wav_tensor.std(-1, keepdim=True)
-    return (wav_tensor - mean) / (std + eps)
-
-
-tr_step = 0
-val_step = 0
-prev_epoch_val_loss = 0.
-for i in range(hparams['n_epochs']):
-    res_dic = {}
-    for loss_name in all_losses:
-        res_dic[loss_name] = {'mean': 0., 'std': 0., 'acc': []}
-    print("Improved Sudo-RM-RF: {} - {} || Epoch: {}/{}".format(
-        experiment.get_key(), experiment.get_tags(), i + 1,
-        hparams['n_epochs']))
-    model.train()
-
-    for data in tqdm(generators['train'], desc='Training'):
-        opt.zero_grad()
-        clean_wavs = data[-1].cuda()
-        m1wavs = data[0].cuda()
-
-        # Online mixing over samples of the batch. (This might cause to get
-        # utterances from the same speaker but it's highly improbable).
-        # Keep the exact same SNR distribution with the initial mixtures.
-        energies = torch.sum(clean_wavs ** 2, dim=-1, keepdim=True)
-        random_wavs = clean_wavs[:, torch.randperm(energies.shape[1])]
-        new_s1 = random_wavs[torch.randperm(energies.shape[0]), 0, :]
-        new_s2 = random_wavs[torch.randperm(energies.shape[0]), 1, :]
-        new_s2 = new_s2 * torch.sqrt(energies[:, 1] /
-                                     (new_s2 ** 2).sum(-1, keepdims=True))
-        new_s1 = new_s1 * torch.sqrt(energies[:, 0] /
-                                     (new_s1 ** 2).sum(-1, keepdims=True))
-        m1wavs = normalize_tensor_wav(new_s1 + new_s2)
-        clean_wavs[:, 0, :] = normalize_tensor_wav(new_s1)
-        clean_wavs[:, 1, :] = normalize_tensor_wav(new_s2)
-        # ===============================================
-
-        rec_sources_wavs = model(m1wavs.unsqueeze(1))
-
-        l = torch.clamp(
-            back_loss_tr_loss(rec_sources_wavs, clean_wavs),
+def prepare_train_batch(data):
+    m1wavs, clean_wavs = online_mixing.remix_two_sources(data[-1])
+    return m1wavs.unsqueeze(1), clean_wavs, {}
+
+
+def train_loss(rec_sources_wavs, clean_wavs):
+    if hparams['early_exit_blocks']:
+        # The last exit is the final output of the model
+        exits_losses = [torch.clamp(
+            back_loss_tr_loss(rec_sources_wavs[:, k], clean_wavs),
             min=-30., max=+30.)
-        l.backward()
-        if hparams['clip_grad_norm'] > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                           hparams['clip_grad_norm'])
-
-        opt.step()
-    # lr_scheduler.step(res_dic['val_SISDRi']['mean'])
-    if hparams['patience'] > 0:
-        if tr_step % hparams['patience'] == 0:
-            new_lr = (hparams['learning_rate']
-                      / (hparams['divide_lr_by'] ** (
-                                tr_step // hparams['patience'])))
-            print('Reducing Learning rate to: {}'.format(new_lr))
-            for param_group in opt.param_groups:
-                param_group['lr'] = new_lr
-    tr_step += 1
-
-    for val_set in [x for x in generators if not x == 'train']:
-        if generators[val_set] is not None:
-            model.eval()
-            with torch.no_grad():
-                for data in tqdm(generators[val_set],
-                                 desc='Validation on {}'.format(val_set)):
-                    m1wavs = data[0].cuda()
-                    m1wavs = normalize_tensor_wav(m1wavs)
-                    clean_wavs = data[-1].cuda()
-
-                    rec_sources_wavs = model(m1wavs.unsqueeze(1))
-
-                    for loss_name, loss_func in val_losses[val_set].items():
-                        l = loss_func(rec_sources_wavs,
-                                      clean_wavs,
-                                      initial_mixtures=m1wavs.unsqueeze(1))
-                        res_dic[loss_name]['acc'] += l.tolist()
-
-            audio_logger.log_batch(rec_sources_wavs, clean_wavs, m1wavs,
-                                   experiment, step=val_step, tag=val_set)
-
-    val_step += 1
-
-    res_dic = cometml_report.report_losses_mean_and_std(res_dic,
-                                                        experiment,
-                                                        tr_step,
-                                                        val_step)
-
-    for loss_name in res_dic:
-        res_dic[loss_name]['acc'] = []
-    pprint(res_dic)
-
-    if hparams["save_checkpoint_every"] > 0:
-        if tr_step % hparams["save_checkpoint_every"] == 0:
-            torch.save(
-                model.state_dict(),
-                os.path.join(hparams["checkpoints_path"],
-                             f"improved_sudo_epoch_{tr_step}"),
-            )
+            for k in range(rec_sources_wavs.shape[1])]
+        return exits_losses[-1] + hparams['early_exit_loss_weight'] * (
+            torch.stack(exits_losses[:-1]).mean())
+    return torch.clamp(back_loss_tr_loss(rec_sources_wavs, clean_wavs),
+                       min=-30., max=+30.)
+
+
+def prepare_eval_batch(data):
+    m1wavs = data[0]
+    # Length bucketed batches also carry the padding mask
+    mask = data[1] if len(data) == 3 else None
+    if mask is None:
+        m1wavs = online_mixing.normalize_tensor_wav(m1wavs)
+    else:
+        m1wavs = length_bucketing.normalize_padded_wavs(m1wavs, mask[:, 0])
+    return (m1wavs.unsqueeze(1), data[-1],
+            {'initial_mixtures': m1wavs.unsqueeze(1), 'mask': mask})
+
+
+def log_audio(val_set, rec_sources_wavs, clean_wavs, m1wavs, val_step):
+    audio_logger.log_batch(rec_sources_wavs, clean_wavs, m1wavs,
+                           experiment, step=val_step, tag=val_set)
+
+
+hooks = [trainer.StepLearningRate(hparams['learning_rate'],
+                                  hparams['divide_lr_by'],
+                                  hparams['patience']),
+         trainer.SaveCheckpoint(hparams["checkpoints_path"],
+                                hparams["save_checkpoint_every"],
+                                "improved_sudo_epoch")]
+
+trainer.Trainer(model, opt, train_loss, generators, val_losses, experiment,
+                device, hparams['n_epochs'],
+                tr_loss_name=back_loss_tr_loss_name,
+                prepare_train_batch=prepare_train_batch,
+                prepare_eval_batch=prepare_eval_batch,
+                tr_model=tr_model,
+                clip_grad_norm=hparams['clip_grad_norm'],
+                log_audio=log_audio, hooks=hooks,
+                name='Improved Sudo-RM-RF').fit()
+
+distributed.cleanup()
@@ -14,13 +14,10 @@ from __config__ import API_KEY
 from comet_ml import Experiment
 
 import torch
-from tqdm import tqdm
-from pprint import pprint
 import sudo_rm_rf.dnn.experiments.utils.dataset_specific_params \
     as dataset_specific_params
+import sudo_rm_rf.dnn.experiments.utils.trainer as trainer
 import sudo_rm_rf.dnn.losses.sisdr as sisdr_lib
-import sudo_rm_rf.dnn.utils.cometml_loss_report as cometml_report
-import sudo_rm_rf.dnn.utils.metrics_logger as metrics_logger
 import sudo_rm_rf.dnn.utils.cometml_log_audio as cometml_audio_logger
 import sudo_rm_rf.dnn.experiments.utils.cmd_args_parser as parser
 import sudo_rm_rf.dnn.models.sudormrf as sudormrf
@@ -52,6 +49,7 @@ train_gen, val_gen, tr_val_gen = dataset_specific_params.get_data_loaders(hparam
 
 os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([cad
                                                for cad in hparams['cuda_devs']])
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 back_loss_tr_loss_name, back_loss_tr_loss = (
     'tr_back_loss_SISDRi',
@@ -95,95 +93,34 @@ experiment.log_parameter('Parameters', numparams)
 print('Trainable Parameters: {}'.format(numparams))
 
 
-model = torch.nn.DataParallel(model).cuda()
+model = torch.nn.DataParallel(model).to(device)
 
 opt = torch.optim.Adam(model.parameters(), lr=hparams['learning_rate'])
 
-all_losses = [back_loss_tr_loss_name] + \
-             [k for k in sorted(val_losses.keys())] + \
-             [k for k in sorted(tr_val_losses.keys())]
-
-tr_step = 0
-val_step = 0
-for i in range(hparams['n_epochs']):
-    res_dic = {}
-    for loss_name in all_losses:
-        res_dic[loss_name] = {'mean': 0., 'std': 0., 'acc': []}
-    print("Experiment: {} - {} || Epoch: {}/{}".format(experiment.get_key(),
-                                                       experiment.get_tags(),
-                                                       i+1,
-                                                       hparams['n_epochs']))
-    model.train()
-
-    for data in tqdm(train_gen, desc='Training'):
-        opt.zero_grad()
-        m1wavs = data[0].unsqueeze(1).cuda()
-        clean_wavs = data[-1].cuda()
-
-        rec_sources_wavs = model(m1wavs)
-
-        l = back_loss_tr_loss(rec_sources_wavs,
-                              clean_wavs,
-                              initial_mixtures=m1wavs)
-        l.backward()
-
-        if hparams['clip_grad_norm'] > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                           hparams['clip_grad_norm'])
-        opt.step()
-        res_dic[back_loss_tr_loss_name]['acc'].append(l.item())
-    tr_step += 1
-
-    if hparams['reduce_lr_every'] > 0:
-        if tr_step % hparams['reduce_lr_every'] == 0:
-            new_lr = (hparams['learning_rate']
-                      / (hparams['divide_lr_by'] ** (tr_step // hparams['reduce_lr_every'])))
-            print('Reducing Learning rate to: {}'.format(new_lr))
-            for param_group in opt.param_groups:
-                param_group['lr'] = new_lr
-
-    if val_gen is not None:
-        model.eval()
-        with torch.no_grad():
-            for data in tqdm(val_gen, desc='Validation'):
-                m1wavs = data[0].unsqueeze(1).cuda()
-                clean_wavs = data[-1].cuda()
-
-                rec_sources_wavs = model(m1wavs)
-                for loss_name, loss_func in val_losses.items():
-                    l = loss_func(rec_sources_wavs,
-                                  clean_wavs,
-                                  initial_mixtures=m1wavs)
-                    res_dic[loss_name]['acc'] += l.tolist()
-            if hparams["log_audio"]:
-                audio_logger.log_batch(rec_sources_wavs, clean_wavs, m1wavs,
-                                       experiment, step=val_step)
-
-    val_step += 1
-
-    if tr_val_losses.values():
-        model.eval()
-        with torch.no_grad():
-            for data in tqdm(tr_val_gen, desc='Train Validation'):
-                m1wavs = data[0].unsqueeze(1).cuda()
-                clean_wavs = data[-1].cuda()
-
-                rec_sources_wavs = model(m1wavs)
-                for loss_name, loss_func in tr_val_losses.items():
-                    l = loss_func(rec_sources_wavs,
-                                  clean_wavs,
-                                  initial_mixtures=m1wavs)
-                    res_dic[loss_name]['acc'] += l.tolist()
-    if hparams["metrics_log_path"] is not None:
-        metrics_logger.log_metrics(res_dic, hparams["metrics_log_path"],
-                                   tr_step, val_step,
-                                   cometml_experiment=experiment)
-
-    res_dic = cometml_report.report_losses_mean_and_std(res_dic,
-                                                        experiment,
-                                                        tr_step,
-                                                        val_step)
-
-    for loss_name in res_dic:
-        res_dic[loss_name]['acc'] = []
-    pprint(res_dic)
+
+def prepare_train_batch(data):
+    m1wavs = data[0].unsqueeze(1)
+    return m1wavs, data[-1], {'initial_mixtures': m1wavs}
+
+
+def log_audio(val_set, rec_sources_wavs, clean_wavs, m1wavs, val_step):
+    if hparams["log_audio"] and val_set == 'val':
+        audio_logger.log_batch(rec_sources_wavs, clean_wavs, m1wavs,
+                               experiment, step=val_step)
+
+
+hooks = [trainer.StepLearningRate(hparams['learning_rate'],
+                                  hparams['divide_lr_by'],
+                                  hparams['reduce_lr_every'])]
+if hparams["metrics_log_path"] is not None:
+    hooks.append(trainer.LogMetrics(hparams["metrics_log_path"]))
+
+trainer.Trainer(model, opt, back_loss_tr_loss,
+                {'train': train_gen, 'val': val_gen, 'train_val': tr_val_gen},
+                {'val': val_losses, 'train_val': tr_val_losses},
+                experiment, device, hparams['n_epochs'],
+                tr_loss_name=back_loss_tr_loss_name,
+                prepare_train_batch=prepare_train_batch,
+                clip_grad_norm=hparams['clip_grad_norm'],
+                log_audio=log_audio, hooks=hooks,
+                name='Experiment').fit()
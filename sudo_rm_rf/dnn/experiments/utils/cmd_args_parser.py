@@ -91,6 +91,12 @@ def get_args():
                             the random seed. If seed is zero then it means that 
                             the dataset is not going to be fixed.""",
                         default=0)
+    parser.add_argument("--shared_source_pool", action='store_true',
+                        help="""Load all the sources of the augmented
+                            datasets once in shared memory for all the
+                            workers instead of loading the files of each
+                            mixture.""",
+                        default=False)
 
     # device params
     parser.add_argument("-cad", "--cuda_available_devices", type=str,
@@ -12,6 +12,7 @@ import sudo_rm_rf.dnn.dataset_loader.whamr as whamr_loader
 import sudo_rm_rf.dnn.dataset_loader.fuss as fuss_loader
 import sudo_rm_rf.dnn.dataset_loader.musdb_dataset as \
     musdb_loader
+import sudo_rm_rf.dnn.experiments.utils.distributed as distributed
 
 
 def create_loader_for_simple_dataset(dataset_name=None,
@@ -25,7 +26,9 @@ def create_loader_for_simple_dataset(dataset_name=None,
                                      normalize_audio=None,
                                      n_samples=None,
                                      min_num_sources=None,
-                                     max_num_sources=None):
+                                     max_num_sources=None,
+                                     shards_root_dirpath=None,
+                                     metadata_cache_dirpath=None):
     if dataset_name == 'WHAM':
         loader = wham_loader
         root_path = WHAM_ROOT_PATH
@@ -73,11 +76,15 @@ def create_loader_for_simple_dataset(dataset_name=None,
         zero_pad=zero_pad, min_or_max=min_or_max, n_channels=n_channels,
         augment='tr' in data_split,
         normalize_audio=normalize_audio, n_samples=n_samples,
-        min_num_sources=min_num_sources, max_num_sources=max_num_sources)
+        min_num_sources=min_num_sources, max_num_sources=max_num_sources,
+        shards_root_dirpath=shards_root_dirpath,
+        metadata_cache_dirpath=metadata_cache_dirpath)
     return data_loader
 
-def setup(hparams):
-    # Create all generators
+def setup(hparams, pin_memory=False):
+    # Create all generators, for multiple processes (distributed.init has
+    # been called) each process gets a different part of each split and the
+    # evaluation splits are not padded, so that no utterance is counted twice
     generators = {}
     for data_split in ['train', 'val', 'test', 'train_val']:
         if hparams[data_split] is None:
@@ -100,8 +107,23 @@ def setup(hparams):
                     normalize_audio=hparams['normalize_audio'],
                     n_samples=hparams['n_'+data_split],
                     min_num_sources=hparams['min_num_sources'],
-                    max_num_sources=hparams['max_num_sources'])
-        generators[data_split] = loader.get_generator(
-            batch_size=hparams['batch_size'], num_workers=hparams['n_jobs'])
+                    max_num_sources=hparams['max_num_sources'],
+                    shards_root_dirpath=hparams['shards_root_dirpath'],
+                    metadata_cache_dirpath=hparams['metadata_cache_dirpath'])
+        if (hparams['bucket_eval_by_length'] and data_split != 'train' and
+                hasattr(loader, 'get_bucketed_generator')):
+            generators[data_split] = loader.get_bucketed_generator(
+                batch_size=hparams['batch_size'],
+                num_workers=hparams['n_jobs'],
+                max_batch_samples=hparams['eval_max_batch_samples'],
+                distributed=distributed.is_distributed(),
+                pin_memory=pin_memory)
+        else:
+            generators[data_split] = loader.get_generator(
+                batch_size=hparams['batch_size'],
+                num_workers=hparams['n_jobs'],
+                distributed=distributed.is_distributed(),
+                pin_memory=pin_memory,
+                evaluation=data_split != 'train')
 
     return generators
\ No newline at end of file
@@ -110,7 +110,8 @@ def get_data_loaders(hparams):
             selected_timelength=hparams['selected_timelength'],
             n_sources=hparams['n_sources'],
             max_abs_snr=hparams['max_abs_snr'],
-            fixed_seed=hparams['fixed_seed']
+            fixed_seed=hparams['fixed_seed'],
+            shared_source_pool=hparams['shared_source_pool']
         )
 
         data_loader = augmented_dataloader.AugmentedOnlineMixingDataset(
@@ -134,7 +135,8 @@ def get_data_loaders(hparams):
             selected_timelength=hparams['selected_timelength'],
             n_sources=hparams['n_sources'],
             max_abs_snr=hparams['max_abs_snr'],
-            fixed_seed=7
+            fixed_seed=7,
+            shared_source_pool=hparams['shared_source_pool']
         )
 
         data_loader = augmented_dataloader.AugmentedOnlineMixingDataset(
@@ -160,7 +162,8 @@ def get_data_loaders(hparams):
             selected_timelength=hparams['selected_timelength'],
             n_sources=hparams['n_sources'],
             max_abs_snr=hparams['max_abs_snr'],
-            fixed_seed=8
+            fixed_seed=8,
+            shared_source_pool=hparams['shared_source_pool']
         )
 
         data_loader = augmented_dataloader.AugmentedOnlineMixingDataset(
@@ -0,0 +1,151 @@
+"""!
+@brief Multi-process training with DistributedDataParallel. The experiment
+scripts run unchanged with one process when they are started with python
+and with one process per device (or per group of cpu cores) when they are
+started with torchrun, which sets RANK, LOCAL_RANK and WORLD_SIZE.
+
+E.g. on a cpu node with 4 processes of 8 threads each:
+OMP_NUM_THREADS=8 torchrun --nproc_per_node 4 run_improved_sudormrf.py \
+--ddp_backend gloo ...
+and on 2 such nodes:
+OMP_NUM_THREADS=8 torchrun --nnodes 2 --node_rank <0 or 1> \
+--nproc_per_node 4 --master_addr <node 0> --master_port 29500 \
+run_improved_sudormrf.py --ddp_backend gloo ...
+
+The batch size is per process, so the effective batch size is
+batch_size x number of processes.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import contextlib
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+DDP_BACKENDS = ['gloo', 'nccl']
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init(hparams):
+    '''
+    Joins the process group when the script is started with torchrun and
+    returns the device of this process.
+
+    :param hparams: the parsed arguments with the ddp_backend key
+    :return: cpu for gloo, the local gpu for nccl and for a single process
+             cuda if it is available, as before
+    '''
+    if int(os.environ.get('WORLD_SIZE', 1)) == 1:
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    dist.init_process_group(backend=hparams['ddp_backend'])
+    if hparams['ddp_backend'] == 'nccl':
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
+        return device
+    return torch.device('cpu')
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+class LocalModel(torch.nn.Module):
+    """! Same interface as the parallel wrappers (the model is in .module)
+    for a model which runs only on the device of its process."""
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+
+def wrap_model(model, device, sync_gradients=True):
+    '''
+    :param model: the separation model
+    :param device: the device returned by init
+    :param sync_gradients: if False the model is not wrapped with
+                           DistributedDataParallel, e.g. when another
+                           wrapper of the same parameters is trained
+    :return: the model in DistributedDataParallel for multiple processes
+             and in DataParallel for one process, as before
+    '''
+    model = model.to(device)
+    if not is_distributed():
+        return torch.nn.DataParallel(model)
+    if not sync_gradients:
+        return LocalModel(model)
+    # None of the models has running statistics, so there is no need to
+    # broadcast buffers, which would also hang the validation when the
+    # processes get a different number of batches
+    return DistributedDataParallel(
+        model, device_ids=[device.index] if device.type == 'cuda' else None,
+        broadcast_buffers=False)
+
+
+def set_epoch(generator, epoch):
+    """! Reshuffles the DistributedSampler of a generator, otherwise all the
+    epochs go through the same order."""
+    if isinstance(getattr(generator, 'sampler', None),
+                  torch.utils.data.DistributedSampler):
+        generator.sampler.set_epoch(epoch)
+
+
+def gather_losses(res_dic):
+    '''
+    Concatenates the accumulated values of each loss from all the
+    processes, so the mean and the std are computed over the whole
+    validation set and every process reports the same numbers.
+
+    :param res_dic: res_dic[loss_name] = {'mean': 0., 'std': 0., 'acc': []}
+    :return: res_dic with the values of all the processes in 'acc'
+    '''
+    if not is_distributed():
+        return res_dic
+    all_accs = [None] * get_world_size()
+    dist.all_gather_object(
+        all_accs, dict((l_name, res_dic[l_name]['acc']) for l_name in res_dic))
+    for l_name in res_dic:
+        res_dic[l_name]['acc'] = [v for accs in all_accs
+                                  for v in accs[l_name]]
+    return res_dic
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+class NoOpExperiment:
+    """! Stands in for the cometml experiment in all the processes but the
+    first one, so that only one experiment is created and logged. Every
+    method call does nothing and returns a context manager, so that
+    experiment.train() and experiment.validate() also work."""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: contextlib.nullcontext()
+
+
+def create_experiment(experiment_cls, *args, **kwargs):
+    if is_main_process():
+        return experiment_cls(*args, **kwargs)
+    return NoOpExperiment()
@@ -37,6 +37,7 @@ def get_hparams_from_args(args):
         "max_abs_snr": args.max_abs_snr,
         'selected_timelength': args.selected_timelength,
         'fixed_seed': args.fixed_seed,
+        'shared_source_pool': args.shared_source_pool,
         'model_type': args.model_type,
         'divide_lr_by': args.divide_lr_by,
         'reduce_lr_every': args.reduce_lr_every,
@@ -60,6 +60,17 @@ def get_args():
                         and a specific timelegth is required then the files 
                         with less than required legth are not going to be 
                         used.""", default=False)
+    parser.add_argument("--shards_root_dirpath", type=str,
+                        help="""Root path of the pre-decoded shards created 
+                        with utils/pack_wav_shards.py. If set, the WHAM, 
+                        WHAMR and LIBRI2MIX loaders read the shards instead 
+                        of the wav files.""",
+                        default=None)
+    parser.add_argument("--metadata_cache_dirpath", type=str,
+                        help="""Directory for caching the lengths of the 
+                        dataset files. Defaults to ~/.cache/sudo_rm_rf/metadata 
+                        so that the dataset folders can be read-only.""",
+                        default=None)
     parser.add_argument("--normalize_audio", action='store_true',
                         help="""Normalize using mean and standard deviation 
                         before processing each audio file.""",
@@ -90,6 +101,16 @@ def get_args():
                         help="""The number of samples in each batch. 
                                 Warning: Cannot be less than the number of 
                                 the validation samples""", default=4)
+    parser.add_argument("--bucket_eval_by_length", action='store_true',
+                        help="""Batch the full validation and test 
+                        utterances of similar lengths together, padded to 
+                        the longest one in the batch. Useful with 
+                        --audio_timelength -1 where otherwise only a batch 
+                        size of 1 is possible.""", default=False)
+    parser.add_argument("--eval_max_batch_samples", type=int,
+                        help="""Maximum number of padded samples in each 
+                        bucketed validation and test batch.""", 
+                        default=None)
     parser.add_argument("--n_epochs", type=int,
                         help="""The number of epochs that the 
                             experiment should run""", default=500)
@@ -135,6 +156,13 @@ def get_args():
     parser.add_argument("--n_jobs", type=int,
                         help="""The number of cpu workers for 
                                         loading the data, etc.""", default=4)
+    parser.add_argument("--ddp_backend", type=str,
+                        help="""The backend of DistributedDataParallel when
+                        the experiment is started with torchrun. gloo runs
+                        each process on the cpu and nccl on its own
+                        gpu.""",
+                        default='gloo',
+                        choices=['gloo', 'nccl'])
     # ===============================================
     # Local experiment logging
     parser.add_argument("-elp", "--experiment_logs_path", type=str,
@@ -179,6 +207,28 @@ def get_args():
                         help="Number of the encoded basis representations.",
                         default=512)
 
+    parser.add_argument("--early_exit_blocks", type=int, nargs='+',
+                        help="""The numbers of U-Blocks after which an
+                        intermediate mask head is trained jointly, e.g. 4 8.
+                        The heads are used by separate_early_exit for
+                        latency-budgeted inference.""",
+                        default=[])
+    parser.add_argument("--early_exit_loss_weight", type=float,
+                        help="""The weight of the mean loss of the early
+                        exits w.r.t. the loss of the final output.""",
+                        default=0.5)
+
+    parser.add_argument("--checkpoint_every_k_blocks", type=int,
+                        help="""Recompute every k-th U-Block in the
+                        backward pass instead of storing its activations,
+                        for training on long segments. 0 disables it.""",
+                        default=0)
+    parser.add_argument("--checkpoint_levels", type=int,
+                        help="""Recompute the layers of this number of the
+                        highest resolution levels of every U-Block in the
+                        backward pass. 0 disables it.""",
+                        default=0)
+
     # Attentive sudo parameters
     parser.add_argument("--att_dims", type=int,
                         help="The number of attention depth.",
@@ -189,12 +239,18 @@ def get_args():
     parser.add_argument("--att_dropout", type=float,
                         help="The dropout rate inside the attention layers.",
                         default=0.1)
+    parser.add_argument("--att_window_size", type=int,
+                        help="""If set, the attention layers are local and
+                        attend only to the neighbouring windows of this
+                        number of frames, so that their memory grows
+                        linearly with the length of the input.""",
+                        default=None)
 
     parser.add_argument("--model_type", type=str,
                         help="The type of model you would like to use.",
                         default='relu',
-                        choices=['relu', 'softmax', 'groupcomm',
-                                 'groupcomm_v2', 'causal',
+                        choices=['relu', 'softmax', 'reversible',
+                                 'groupcomm', 'groupcomm_v2', 'causal',
                                  'attention', 'attention_v2',
                                  'attention_v3', 'sepformer'])
 
@@ -0,0 +1,97 @@
+"""!
+@brief Online mixing augmentations of the training batches, which create new
+mixtures by combining sources of different utterances of the same batch.
+They run on the device of the batch.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+
+
+def normalize_tensor_wav(wav_tensor, eps=1e-8, std=None):
+    mean = wav_tensor.mean(-1, keepdim=True)
+    if std is None:
+        std = wav_tensor.std(-1, keepdim=True)
+    return (wav_tensor - mean) / (std + eps)
+
+
+def remix_two_sources(clean_wavs):
+    '''
+    Online mixing over samples of the batch. (This might cause to get
+    utterances from the same speaker but it's highly improbable).
+    Keep the exact same SNR distribution with the initial mixtures.
+
+    :param clean_wavs: batch_size x 2 x n_samples, it is overwritten with
+                       the normalized new sources
+    :return: the normalized new mixtures: batch_size x n_samples and the
+             new sources
+    '''
+    energies = torch.sum(clean_wavs ** 2, dim=-1, keepdim=True)
+    random_wavs = clean_wavs[:, torch.randperm(energies.shape[1])]
+    new_s1 = random_wavs[torch.randperm(energies.shape[0]), 0, :]
+    new_s2 = random_wavs[torch.randperm(energies.shape[0]), 1, :]
+    new_s2 = new_s2 * torch.sqrt(energies[:, 1] /
+                                 (new_s2 ** 2).sum(-1, keepdims=True))
+    new_s1 = new_s1 * torch.sqrt(energies[:, 0] /
+                                 (new_s1 ** 2).sum(-1, keepdims=True))
+    m1wavs = normalize_tensor_wav(new_s1 + new_s2)
+    clean_wavs[:, 0, :] = normalize_tensor_wav(new_s1)
+    clean_wavs[:, 1, :] = normalize_tensor_wav(new_s2)
+    return m1wavs, clean_wavs
+
+
+def remix_reverberant_sources(sources_wavs, targets_wavs):
+    '''
+    Online mixing of reverberant sources, each target is permuted together
+    with its reverberant source and both keep the energies of the initial
+    ones.
+
+    :param sources_wavs: batch_size x n_sources x n_samples
+    :param targets_wavs: batch_size x n_sources x n_samples
+    :return: the normalized new mixtures: batch_size x n_samples and the
+             new targets
+    '''
+    s_energies = torch.sum(sources_wavs ** 2, dim=-1, keepdim=True)
+    t_energies = torch.sum(targets_wavs ** 2, dim=-1, keepdim=True)
+    b_size, n_sources, _ = sources_wavs.shape
+    new_sources = []
+    new_targets = []
+    for k in range(n_sources):
+        this_rand_perm = torch.randperm(b_size)
+        new_src = sources_wavs[this_rand_perm, k]
+        new_trgt = targets_wavs[this_rand_perm, k]
+        new_src = new_src * torch.sqrt(
+            s_energies[:, k] / (new_src ** 2).sum(-1, keepdims=True))
+        new_trgt = new_trgt * torch.sqrt(
+            t_energies[:, k] / (new_trgt ** 2).sum(-1, keepdims=True))
+        new_sources.append(new_src)
+        new_targets.append(new_trgt)
+
+    new_sources = torch.stack(new_sources, dim=1)
+    new_targets = torch.stack(new_targets, dim=1)
+    return normalize_tensor_wav(new_sources.sum(1)), new_targets
+
+
+def remix_with_random_gains(clean_sources):
+    '''
+    Online mixing over samples of the batch. (This might cause to get
+    mixtures from the same type of sound but it's highly improbable).
+    Each source gets a random gain in [0.5, 1.5).
+
+    :param clean_sources: batch_size x n_sources x n_samples
+    :return: the new sources: batch_size x n_sources x n_samples
+    '''
+    n_sources = clean_sources.shape[1]
+    batch_size = clean_sources.shape[0]
+
+    augmented_wavs_l = []
+    for i in range(n_sources):
+        augmented_wavs_l.append(clean_sources[torch.randperm(batch_size), i])
+    augmented_wavs = torch.stack(augmented_wavs_l, 1)
+    augmented_wavs = augmented_wavs[:, torch.randperm(n_sources)]
+    augmented_wavs *= (torch.rand(batch_size, n_sources,
+                                  device=clean_sources.device).unsqueeze(-1)
+                       + 0.5)
+    return augmented_wavs
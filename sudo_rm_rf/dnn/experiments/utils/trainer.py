@@ -0,0 +1,343 @@
+"""!
+@brief Training engine shared by all the experiment scripts. The scripts
+only define the model, the losses, the generators and how each batch is
+turned into an input mixture and the targets. The engine runs the epochs,
+the validation on all the other generators, the cometml reporting and the
+hooks (learning rate schedule, checkpoints, etc.).
+
+The next batch is copied to the device with a non-blocking copy on a side
+cuda stream while the current one is processed, and all the losses are
+accumulated on the device and copied to the host only once per epoch,
+so nothing forces a cuda sync in the middle of an epoch.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import os
+from pprint import pprint
+import torch
+from tqdm import tqdm
+import sudo_rm_rf.dnn.experiments.utils.distributed as distributed
+import sudo_rm_rf.dnn.utils.cometml_loss_report as cometml_report
+import sudo_rm_rf.dnn.utils.metrics_logger as metrics_logger
+
+
+def to_device(batch, device, non_blocking=False):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    return type(batch)(to_device(b, device, non_blocking=non_blocking)
+                       for b in batch)
+
+
+def record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    else:
+        for b in batch:
+            record_stream(b, stream)
+
+
+class Prefetcher(object):
+    """! Iterates over a generator and copies each batch to the device one
+    batch ahead. The copies are only asynchronous when the generator pins
+    the memory of its batches (pin_memory=True)."""
+    def __init__(self, generator, device):
+        self.generator = generator
+        self.device = device
+
+    def __len__(self):
+        return len(self.generator)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.generator:
+                yield to_device(batch, self.device)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+        compute_stream = torch.cuda.current_stream(self.device)
+        prefetched = None
+        for batch in self.generator:
+            with torch.cuda.stream(copy_stream):
+                batch = to_device(batch, self.device, non_blocking=True)
+            if prefetched is not None:
+                yield prefetched
+            compute_stream.wait_stream(copy_stream)
+            # The batch was allocated on the copy stream but it is used on
+            # the compute stream
+            record_stream(batch, compute_stream)
+            prefetched = batch
+        if prefetched is not None:
+            yield prefetched
+
+
+class LossesAccumulator(object):
+    """! Keeps the values of each loss on the device and returns them as the
+    res_dic of the cometml report."""
+    def __init__(self, loss_names):
+        self.loss_names = loss_names
+        self.values = dict((loss_name, []) for loss_name in loss_names)
+
+    def add(self, loss_name, values):
+        self.values[loss_name].append(values.detach().reshape(-1))
+
+    def get_res_dic(self):
+        res_dic = {}
+        for loss_name in self.loss_names:
+            values = self.values[loss_name]
+            res_dic[loss_name] = {
+                'mean': 0., 'std': 0.,
+                'acc': torch.cat(values).tolist() if values else []}
+            self.values[loss_name] = []
+        return res_dic
+
+
+def default_prepare_train_batch(data):
+    return data[0].unsqueeze(1), data[-1], {}
+
+
+def default_prepare_eval_batch(data):
+    m1wavs = data[0].unsqueeze(1)
+    return m1wavs, data[-1], {'initial_mixtures': m1wavs}
+
+
+def default_separate(model, mixture):
+    return model(mixture)
+
+
+class Hook(object):
+    """! Base class of the hooks, which are called by the trainer in the
+    order of the list it got."""
+    def on_epoch_start(self, trainer):
+        pass
+
+    def on_train_step_end(self, trainer, loss):
+        pass
+
+    def on_train_epoch_end(self, trainer):
+        pass
+
+    def on_validation_end(self, trainer, res_dic):
+        pass
+
+    def on_epoch_end(self, trainer, res_dic):
+        pass
+
+
+class StepLearningRate(Hook):
+    """! Divides the initial learning rate by divide_lr_by every
+    reduce_lr_every epochs."""
+    def __init__(self, learning_rate, divide_lr_by, reduce_lr_every):
+        self.learning_rate = learning_rate
+        self.divide_lr_by = divide_lr_by
+        self.reduce_lr_every = reduce_lr_every
+
+    def on_train_epoch_end(self, trainer):
+        if self.reduce_lr_every <= 0:
+            return
+        if trainer.tr_step % self.reduce_lr_every == 0:
+            new_lr = (self.learning_rate /
+                      (self.divide_lr_by ** (
+                          trainer.tr_step // self.reduce_lr_every)))
+            if distributed.is_main_process():
+                print('Reducing Learning rate to: {}'.format(new_lr))
+            for param_group in trainer.optimizer.param_groups:
+                param_group['lr'] = new_lr
+
+
+class SaveCheckpoint(Hook):
+    """! Saves the state dict of the model every save_every epochs."""
+    def __init__(self, checkpoints_path, save_every, name):
+        self.checkpoints_path = checkpoints_path
+        self.save_every = save_every
+        self.name = name
+
+    def on_epoch_end(self, trainer, res_dic):
+        if self.save_every <= 0 or not distributed.is_main_process():
+            return
+        if trainer.tr_step % self.save_every == 0:
+            torch.save(
+                trainer.model.state_dict(),
+                os.path.join(self.checkpoints_path,
+                             '{}_{}'.format(self.name, trainer.tr_step)))
+
+
+class LogMetrics(Hook):
+    """! Saves the values of all the metrics of each epoch."""
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+
+    def on_validation_end(self, trainer, res_dic):
+        if distributed.is_main_process():
+            metrics_logger.log_metrics(res_dic, self.dirpath,
+                                       trainer.tr_step, trainer.val_step,
+                                       cometml_experiment=trainer.experiment)
+
+
+class Trainer(object):
+    def __init__(self,
+                 model,
+                 optimizer,
+                 train_loss,
+                 generators,
+                 val_losses,
+                 experiment,
+                 device,
+                 n_epochs,
+                 tr_loss_name='tr_back_loss_SISDRi',
+                 prepare_train_batch=default_prepare_train_batch,
+                 prepare_eval_batch=default_prepare_eval_batch,
+                 separate=default_separate,
+                 tr_model=None,
+                 clip_grad_norm=0.,
+                 log_audio=None,
+                 hooks=(),
+                 name='Sudo-RM-RF',
+                 log_every=50,
+                 show_progress=True):
+        '''
+        :param model: the wrapped model (DataParallel or
+                      DistributedDataParallel)
+        :param optimizer: optimizer of the model parameters
+        :param train_loss: train_loss(estimates, targets, **loss_kwargs)
+                           returns the scalar loss of the batch
+        :param generators: dict of generators with the 'train' one, all the
+                           other ones which are not None are validated
+        :param val_losses: val_losses[val_set][loss_name] is a loss which
+                           returns the value of each utterance
+        :param experiment: cometml experiment
+        :param device: device of the model
+        :param n_epochs: number of epochs
+        :param tr_loss_name: name under which the train loss is reported
+        :param prepare_train_batch: turns a batch on the device into
+                                    (mixture, targets, loss_kwargs), e.g.
+                                    with online mixing
+        :param prepare_eval_batch: same for the validation batches, the
+                                   loss_kwargs go to all the val losses
+        :param separate: separate(model, mixture) returns the estimates
+        :param tr_model: the model which is trained if it is not the model
+                         which is validated, e.g. with extra outputs
+        :param clip_grad_norm: max gradient norm, no clipping for 0
+        :param log_audio: log_audio(val_set, estimates, targets, mixture,
+                          val_step) for the last batch of each val set
+        :param hooks: list of Hook
+        :param name: printed before each epoch
+        :param log_every: number of batches between each update of the
+                          running average of the training loss
+        :param show_progress: show the progress bars on the main process
+        '''
+        self.model = model
+        self.tr_model = model if tr_model is None else tr_model
+        self.optimizer = optimizer
+        self.train_loss = train_loss
+        self.generators = generators
+        self.val_losses = val_losses
+        self.experiment = experiment
+        self.device = device
+        self.n_epochs = n_epochs
+        self.tr_loss_name = tr_loss_name
+        self.prepare_train_batch = prepare_train_batch
+        self.prepare_eval_batch = prepare_eval_batch
+        self.separate = separate
+        self.clip_grad_norm = clip_grad_norm
+        self.log_audio = log_audio
+        self.hooks = list(hooks)
+        self.name = name
+        self.log_every = log_every
+        self.show_progress = show_progress
+
+        self.epoch = 0
+        self.tr_step = 0
+        self.val_step = 0
+        loss_names = [loss_name for val_set in self.get_val_sets()
+                      for loss_name in self.val_losses[val_set]]
+        self.losses = LossesAccumulator(loss_names + [self.tr_loss_name])
+
+    def get_val_sets(self):
+        return [val_set for val_set in self.generators
+                if val_set != 'train' and
+                self.generators[val_set] is not None]
+
+    def train_epoch(self):
+        self.model.train()
+        distributed.set_epoch(self.generators['train'], self.epoch)
+        show_progress = self.show_progress and distributed.is_main_process()
+        sum_loss = torch.zeros((), device=self.device)
+        training_gen_tqdm = tqdm(
+            Prefetcher(self.generators['train'], self.device),
+            desc='Training', disable=not show_progress)
+        for batch_step, data in enumerate(training_gen_tqdm):
+            self.optimizer.zero_grad()
+            mixture, targets, loss_kwargs = self.prepare_train_batch(data)
+            estimates = self.separate(self.tr_model, mixture)
+            l = self.train_loss(estimates, targets, **loss_kwargs)
+            l.backward()
+            if self.clip_grad_norm > 0:
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(),
+                                               self.clip_grad_norm)
+            self.optimizer.step()
+
+            l = l.detach()
+            sum_loss += l
+            self.losses.add(self.tr_loss_name, l)
+            for hook in self.hooks:
+                hook.on_train_step_end(self, l)
+            # The only sync with the host in the epoch
+            if show_progress and (batch_step + 1) % self.log_every == 0:
+                training_gen_tqdm.set_description(
+                    "Training, Running Avg Loss: {}".format(
+                        round(sum_loss.item() / (batch_step + 1), 3)))
+
+    def validate(self):
+        self.model.eval()
+        for val_set in self.get_val_sets():
+            with torch.no_grad():
+                for data in tqdm(
+                        Prefetcher(self.generators[val_set], self.device),
+                        desc='Validation on {}'.format(val_set),
+                        disable=not (self.show_progress and
+                                     distributed.is_main_process())):
+                    mixture, targets, loss_kwargs = \
+                        self.prepare_eval_batch(data)
+                    estimates = self.separate(self.model, mixture)
+                    for loss_name, loss_func in \
+                            self.val_losses[val_set].items():
+                        self.losses.add(loss_name,
+                                        loss_func(estimates, targets,
+                                                  **loss_kwargs))
+
+            if self.log_audio is not None and distributed.is_main_process():
+                self.log_audio(val_set, estimates, targets, mixture,
+                               self.val_step)
+
+    def fit(self):
+        for i in range(self.n_epochs):
+            self.epoch = i
+            if distributed.is_main_process():
+                print("{}: {} - {} || Epoch: {}/{}".format(
+                    self.name, self.experiment.get_key(),
+                    self.experiment.get_tags(), i + 1, self.n_epochs))
+            for hook in self.hooks:
+                hook.on_epoch_start(self)
+
+            self.train_epoch()
+            for hook in self.hooks:
+                hook.on_train_epoch_end(self)
+            self.tr_step += 1
+
+            self.validate()
+            self.val_step += 1
+
+            res_dic = distributed.gather_losses(self.losses.get_res_dic())
+            for hook in self.hooks:
+                hook.on_validation_end(self, res_dic)
+            res_dic = cometml_report.report_losses_mean_and_std(
+                res_dic, self.experiment, self.tr_step, self.val_step)
+            for hook in self.hooks:
+                hook.on_epoch_end(self, res_dic)
+
+            for loss_name in res_dic:
+                res_dic[loss_name]['acc'] = []
+            if distributed.is_main_process():
+                pprint(res_dic)
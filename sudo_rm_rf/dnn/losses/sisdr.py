@@ -6,11 +6,21 @@ asteroid for values cross checking.
 @copyright University of illinois at Urbana Champaign
 """
 
+import math
+import numpy as np
 import torch
 import torch.nn as nn
 import itertools
+from scipy.optimize import linear_sum_assignment
 from torch.nn.modules.loss import _Loss
 
+# Above this number of sources the Hungarian algorithm is used instead of
+# checking all the permutations in the 'auto' permutation search
+MAX_GATHER_SOURCES = 7
+# Same for the 'auto' backend of PITLossWrapper which scores the
+# permutations from the pairwise losses only
+MAX_PERMUTATIONS_SOURCES = 5
+
 
 def _sdr( y, z, SI=False):
     if SI:
@@ -63,6 +73,46 @@ def pit_loss( y, z, of=0, SI=False):
     return -s[j,i].mean()
 
 
+def get_permutation_index(permutations):
+    """! Returns the index of each permutation in the lexicographic order of
+    itertools.permutations, without listing all the permutations."""
+    n_sources = permutations.shape[-1]
+    later_and_smaller = ((permutations.unsqueeze(-2) <
+                          permutations.unsqueeze(-1)) &
+                         torch.ones(n_sources, n_sources, dtype=torch.bool,
+                                    device=permutations.device).triu(1))
+    factorials = torch.tensor(
+        [math.factorial(n_sources - 1 - i) for i in range(n_sources)],
+        device=permutations.device)
+    return (later_and_smaller.sum(-1) * factorials).sum(-1)
+
+
+def get_permutation_from_index(index, n_sources):
+    """! Inverse of get_permutation_index."""
+    available = torch.ones(index.shape + (n_sources,), dtype=torch.long,
+                           device=index.device)
+    permutations = []
+    for i in range(n_sources):
+        factorial = math.factorial(n_sources - 1 - i)
+        digit, index = index // factorial, index % factorial
+        # The digit-th of the sources which are not used yet
+        chosen = torch.argmax(
+            (torch.cumsum(available, -1) == digit.unsqueeze(-1) + 1).long() *
+            available, -1)
+        available.scatter_(-1, chosen.unsqueeze(-1), 0)
+        permutations.append(chosen)
+    return torch.stack(permutations, -1)
+
+
+def solve_assignment(scores, maximize=False):
+    """! Solves the linear assignment problem of each batch_size x n x n
+    scores matrix with the Hungarian algorithm on cpu. Returns the column
+    assigned to each row as a batch_size x n LongTensor."""
+    assignments = [linear_sum_assignment(m, maximize=maximize)[1]
+                   for m in scores.detach().cpu().numpy()]
+    return torch.as_tensor(np.stack(assignments), device=scores.device)
+
+
 class PermInvariantSISDR(nn.Module):
     """!
     Class for SISDR computation between reconstructed signals and
@@ -74,7 +124,8 @@ class PermInvariantSISDR(nn.Module):
                  n_sources=None,
                  backward_loss=True,
                  improvement=False,
-                 return_individual_results=False):
+                 return_individual_results=False,
+                 perm_search='loop'):
         """
         Initialization for the results and torch tensors that might
         be used afterwards
@@ -82,19 +133,41 @@ class PermInvariantSISDR(nn.Module):
         :param batch_size: The number of the samples in each batch
         :param zero_mean: If you want to perform zero-mean across
         last dimension (time dim) of the signals before SDR computation
+        :param perm_search: How the best permutation is found.
+        'loop': computes the SI-SDR of every permutation separately.
+        'gather': computes the n_sources x n_sources pairwise SI-SDR matrix
+        once and gathers all the permutations from it.
+        'hungarian': solves the assignment on the pairwise matrix with the
+        Hungarian algorithm on cpu, for large numbers of sources.
+        'auto': 'gather' up to MAX_GATHER_SOURCES sources, else 'hungarian'.
+        The SI-SDR of the selected permutation is always computed exactly
+        as in 'loop', so all modes give the same loss.
         """
         super().__init__()
+        if perm_search not in ['loop', 'gather', 'hungarian', 'auto']:
+            raise ValueError('Unknown permutation search: {}'.format(
+                perm_search))
+        if perm_search == 'auto':
+            perm_search = ('gather' if n_sources <= MAX_GATHER_SOURCES
+                           else 'hungarian')
+        self.perm_search = perm_search
         self.bs = batch_size
         self.perform_zero_mean = zero_mean
         self.backward_loss = backward_loss
-        self.permutations = list(itertools.permutations(
-            torch.arange(n_sources)))
-        self.permutations_tensor = torch.LongTensor(self.permutations)
+        # The n_sources! permutations are only listed for the searches which
+        # go through all of them
+        self.permutations = None
+        self.permutations_tensor = None
+        if self.perm_search in ['loop', 'gather']:
+            self.permutations = list(itertools.permutations(
+                torch.arange(n_sources)))
+            self.permutations_tensor = torch.LongTensor(self.permutations)
         self.improvement = improvement
         self.n_sources = n_sources
         self.return_individual_results = return_individual_results
 
-    def normalize_input(self, pr_batch, t_batch, initial_mixtures=None):
+    def normalize_input(self, pr_batch, t_batch, initial_mixtures=None,
+                        mask=None):
         min_len = min(pr_batch.shape[-1],
                       t_batch.shape[-1])
         if initial_mixtures is not None:
@@ -103,7 +176,25 @@ class PermInvariantSISDR(nn.Module):
         pr_batch = pr_batch[:, :, :min_len]
         t_batch = t_batch[:, :, :min_len]
 
-        if self.perform_zero_mean:
+        if mask is not None:
+            # Zero the padded samples so that they do not contribute to any
+            # of the sums
+            mask = mask.view(mask.shape[0], 1, -1)[:, :, :min_len]
+            pr_batch = pr_batch * mask
+            t_batch = t_batch * mask
+            if initial_mixtures is not None:
+                initial_mixtures = initial_mixtures * mask
+            if self.perform_zero_mean:
+                n_valid = mask.sum(-1, keepdim=True)
+                pr_batch = pr_batch - torch.sum(
+                    pr_batch, dim=-1, keepdim=True) / n_valid * mask
+                t_batch = t_batch - torch.sum(
+                    t_batch, dim=-1, keepdim=True) / n_valid * mask
+                if initial_mixtures is not None:
+                    initial_mixtures = initial_mixtures - torch.sum(
+                        initial_mixtures, dim=-1,
+                        keepdim=True) / n_valid * mask
+        elif self.perform_zero_mean:
             pr_batch = pr_batch - torch.mean(
                 pr_batch, dim=-1, keepdim=True)
             t_batch = t_batch - torch.mean(
@@ -128,6 +219,37 @@ class PermInvariantSISDR(nn.Module):
                                   (self.dot(e_t, e_t) + eps))
         return sisnrs
 
+    @staticmethod
+    def compute_pairwise_sisnrs(pr_batch, t_batch, t_t_diag, eps=10e-8):
+        """! Returns the batch_size x n_sources x n_sources matrix with the
+        SI-SDR of each estimated source (rows) with each target (columns)
+        without forming any of the permuted signals."""
+        pr_t = torch.matmul(pr_batch, t_batch.transpose(-1, -2)).double()
+        pr_pr = PermInvariantSISDR.dot(pr_batch, pr_batch).double()
+        t_t = t_t_diag.transpose(-1, -2).double()
+        alpha = pr_t / (t_t + eps)
+        s_t_energy = alpha ** 2 * t_t
+        e_t_energy = torch.clamp(pr_pr - 2 * alpha * pr_t + s_t_energy,
+                                 min=0.)
+        return 10 * torch.log10(s_t_energy / (e_t_energy + eps))
+
+    def find_best_permutations(self, pr_batch, t_batch, t_t_diag, eps=10e-8):
+        """! Returns the best permutation of the estimated sources for
+        each element of the batch using the pairwise SI-SDR matrix."""
+        with torch.no_grad():
+            pw_sisnrs = self.compute_pairwise_sisnrs(
+                pr_batch, t_batch, t_t_diag, eps=eps)
+            if self.perm_search == 'gather':
+                perms = self.permutations_tensor.to(pr_batch.device)
+                # batch_size x n_sources! x n_sources
+                perm_sisnrs = pw_sisnrs[:, perms,
+                                        torch.arange(self.n_sources,
+                                                     device=perms.device)]
+                return perms[torch.argmax(perm_sisnrs.mean(-1), -1)]
+
+            return solve_assignment(pw_sisnrs.transpose(-1, -2),
+                                    maximize=True)
+
     def compute_sisnr(self,
                       pr_batch,
                       t_batch,
@@ -136,15 +258,25 @@ class PermInvariantSISDR(nn.Module):
 
         t_t_diag = self.dot(t_batch, t_batch)
 
-        sisnr_l = []
-        for perm in self.permutations:
-            permuted_pr_batch = pr_batch[:, perm, :]
-            sisnr = self.compute_permuted_sisnrs(permuted_pr_batch,
-                                                 t_batch,
-                                                 t_t_diag, eps=eps)
-            sisnr_l.append(sisnr)
-        all_sisnrs = torch.cat(sisnr_l, -1)
-        best_sisdr, best_perm_ind = torch.max(all_sisnrs.mean(-2), -1)
+        if self.perm_search == 'loop':
+            sisnr_l = []
+            for perm in self.permutations:
+                permuted_pr_batch = pr_batch[:, perm, :]
+                sisnr = self.compute_permuted_sisnrs(permuted_pr_batch,
+                                                     t_batch,
+                                                     t_t_diag, eps=eps)
+                sisnr_l.append(sisnr)
+            all_sisnrs = torch.cat(sisnr_l, -1)
+            best_sisdr, best_perm_ind = torch.max(all_sisnrs.mean(-2), -1)
+        else:
+            best_perms = self.find_best_permutations(
+                pr_batch, t_batch, t_t_diag, eps=eps)
+            permuted_pr_batch = torch.gather(
+                pr_batch, 1,
+                best_perms.unsqueeze(-1).expand(-1, -1, pr_batch.shape[-1]))
+            best_sisdr = self.compute_permuted_sisnrs(
+                permuted_pr_batch, t_batch, t_t_diag, eps=eps).mean(-2)[:, 0]
+            best_perm_ind = get_permutation_index(best_perms)
 
         if self.improvement:
             initial_mix = initial_mixtures.repeat(1, self.n_sources, 1)
@@ -165,7 +297,8 @@ class PermInvariantSISDR(nn.Module):
                 t_batch,
                 eps=1e-9,
                 initial_mixtures=None,
-                return_best_permutation=False):
+                return_best_permutation=False,
+                mask=None):
         """!
         :param pr_batch: Reconstructed wavs: Torch Tensors of size:
                          batch_size x self.n_sources x length_of_wavs
@@ -174,20 +307,28 @@ class PermInvariantSISDR(nn.Module):
         :param eps: Numerical stability constant.
         :param initial_mixtures: Initial Mixtures for SISDRi: Torch Tensor
                                  of size: batch_size x 1 x length_of_wavs
+        :param mask: For zero padded batches, 1 on the valid samples and 0
+                     on the padding: Torch Tensor of size:
+                     batch_size x 1 x length_of_wavs
 
         :returns results_buffer Buffer for loading the results directly
                  to gpu and not having to reconstruct the results matrix: Torch
                  Tensor of size: batch_size x 1
         """
         pr_batch, t_batch, initial_mixtures = self.normalize_input(
-            pr_batch, t_batch, initial_mixtures=initial_mixtures)
+            pr_batch, t_batch, initial_mixtures=initial_mixtures, mask=mask)
 
         sisnr_l, best_perm_ind = self.compute_sisnr(
             pr_batch, t_batch, eps=eps,
             initial_mixtures=initial_mixtures)
 
         if return_best_permutation:
-            best_permutations = self.permutations_tensor[best_perm_ind]
+            if self.permutations_tensor is None:
+                best_permutations = get_permutation_from_index(
+                    best_perm_ind, self.n_sources)
+            else:
+                best_permutations = self.permutations_tensor[
+                    best_perm_ind.cpu()]
             return sisnr_l, best_permutations
         else:
             return sisnr_l
@@ -220,6 +361,15 @@ class PITLossWrapper(nn.Module):
             `reduce_kwargs` argument (dict). If those argument are static,
             consider defining a small function or using `functools.partial`.
             Only used in `'pw_mtx'` and `'pw_pt'` `pit_from` modes.
+        perm_backend (str): how the best permutation is found from the
+            pairwise losses.
+            * ``'permutations'``: scores all the n_src! permutations.
+            * ``'hungarian'``: solves the assignment with the Hungarian
+              algorithm on cpu in O(n_src^3). It only minimizes the mean
+              reduction, so it cannot be combined with `perm_reduce`.
+            * ``'auto'``: ``'hungarian'`` for more than
+              MAX_PERMUTATIONS_SOURCES sources without `perm_reduce`, else
+              ``'permutations'``.
     For each of these modes, the best permutation and reordering will be
     automatically computed.
     Examples:
@@ -242,14 +392,23 @@ class PITLossWrapper(nn.Module):
         >>> loss_val = loss_func(est_sources, sources,
         >>>                      reduce_kwargs=reduce_kwargs)
     """
-    def __init__(self, loss_func, pit_from='pw_mtx', perm_reduce=None):
+    def __init__(self, loss_func, pit_from='pw_mtx', perm_reduce=None,
+                 perm_backend='auto'):
         super().__init__()
         self.loss_func = loss_func
         self.pit_from = pit_from
         self.perm_reduce = perm_reduce
+        self.perm_backend = perm_backend
         if self.pit_from not in ['pw_mtx', 'pw_pt', 'perm_avg']:
             raise ValueError('Unsupported loss function type for now. Expected'
                              'one of [`pw_mtx`, `pw_pt`, `perm_avg`]')
+        if self.perm_backend not in ['auto', 'permutations', 'hungarian']:
+            raise ValueError('Unsupported permutation backend. Expected '
+                             'one of [`auto`, `permutations`, `hungarian`]')
+        if self.perm_backend == 'hungarian' and self.perm_reduce is not None:
+            raise ValueError('The `hungarian` permutation backend only '
+                             'minimizes the mean over the sources and cannot '
+                             'be used with `perm_reduce`')
 
     def forward(self, est_targets, targets, return_est=False,
                 reduce_kwargs=None, **kwargs):
@@ -272,7 +431,15 @@ class PITLossWrapper(nn.Module):
                 torch.Tensor of shape [batch, nsrc, *].
         """
         n_src = targets.shape[1]
-        assert n_src < 10, f"Expected source axis along dim 1, found {n_src}"
+        backend = self.perm_backend
+        if backend == 'auto':
+            # Only the search over all the permutations gives the minimum
+            # of an arbitrary perm_reduce
+            backend = ('hungarian' if (n_src > MAX_PERMUTATIONS_SOURCES and
+                                       self.perm_reduce is None)
+                       else 'permutations')
+        assert n_src < 10 or backend == 'hungarian', (
+            f"Expected source axis along dim 1, found {n_src}")
         if self.pit_from == 'pw_mtx':
             # Loss function already returns pairwise losses
             pw_losses = self.loss_func(est_targets, targets, **kwargs)
@@ -302,7 +469,8 @@ class PITLossWrapper(nn.Module):
 
         reduce_kwargs = reduce_kwargs if reduce_kwargs is not None else dict()
         min_loss, min_loss_idx = self.find_best_perm(
-            pw_losses, n_src, perm_reduce=self.perm_reduce, **reduce_kwargs
+            pw_losses, n_src, perm_reduce=self.perm_reduce, backend=backend,
+            **reduce_kwargs
         )
         mean_loss = torch.mean(min_loss)
         if not return_est:
@@ -339,7 +507,8 @@ class PITLossWrapper(nn.Module):
         return pair_wise_losses
 
     @staticmethod
-    def find_best_perm(pair_wise_losses, n_src, perm_reduce=None, **kwargs):
+    def find_best_perm(pair_wise_losses, n_src, perm_reduce=None,
+                       backend='permutations', **kwargs):
         """Find the best permutation, given the pair-wise losses.
         Args:
             pair_wise_losses (:class:`torch.Tensor`):
@@ -348,6 +517,8 @@ class PITLossWrapper(nn.Module):
             perm_reduce (Callable): torch function to reduce permutation losses.
                 Defaults to None (equivalent to mean). Signature of the func
                 (pwl_set, **kwargs) : (B, n_src!, n_src) --> (B, n_src!)
+            backend (str): ``'permutations'`` or ``'hungarian'`` (only
+                without `perm_reduce`), see :class:`PITLossWrapper`.
             **kwargs: additional keyword argument that will be passed to the
                 permutation reduce function.
         Returns:
@@ -362,6 +533,17 @@ class PITLossWrapper(nn.Module):
         """
         # After transposition, dim 1 corresp. to sources and dim 2 to estimates
         pwl = pair_wise_losses.transpose(-1, -2)
+        if backend == 'hungarian':
+            if perm_reduce is not None:
+                raise ValueError('The `hungarian` permutation backend cannot '
+                                 'be used with `perm_reduce`')
+            # [batch, n_src] : The estimate assigned to each source
+            perm = solve_assignment(pwl)
+            # [batch, n_src] : Pairwise losses of the best permutation
+            pwl_set = torch.gather(pwl, 2, perm.unsqueeze(-1)).squeeze(-1)
+            min_loss = torch.mean(pwl_set, dim=-1, keepdim=True)
+            return min_loss, get_permutation_index(perm)
+
         perms = pwl.new_tensor(list(itertools.permutations(range(n_src))),
                                dtype=torch.long)
         # Column permutation indices
@@ -386,6 +568,24 @@ class PITLossWrapper(nn.Module):
         min_loss, _ = torch.min(loss_set, dim=1, keepdim=True)
         return min_loss, min_loss_idx
 
+    @staticmethod
+    def reorder_source(source, n_src, min_loss_idx):
+        """ Reorder sources according to the best permutation.
+        Args:
+            source (torch.Tensor): Tensor of shape [batch, n_src, time]
+            n_src (int): Number of sources.
+            min_loss_idx (torch.LongTensor): Tensor of shape [batch],
+                each item is in [0, n_src!).
+        Returns:
+            :class:`torch.Tensor`:
+                Reordered sources of shape [batch, n_src, time].
+        """
+        # [batch, n_src] : The estimate of each source
+        min_loss_perm = get_permutation_from_index(min_loss_idx, n_src)
+        return torch.gather(source, 1, min_loss_perm.view(
+            min_loss_perm.shape + (1,) * (source.ndim - 2)).expand(
+            min_loss_perm.shape + source.shape[2:]))
+
 
 class PairwiseNegSDR(_Loss):
     """ Base class for pairwise negative SI-SDR, SD-SDR and SNR on a batch.
@@ -114,5 +114,144 @@ def test_sisnr_implementations(n_batches=2,
     print(np.abs(cpu_results - gpu_results.data.cpu().numpy()))
 
 
+def test_perm_search_matches_loop(bs=4, length=8000):
+    torch.manual_seed(0)
+    for n_sources in range(2, 6):
+        t_batch = torch.randn(bs, n_sources, length)
+        pr_batch = (t_batch[:, torch.randperm(n_sources)] +
+                    0.3 * torch.randn(bs, n_sources, length))
+        results = {}
+        for perm_search in ['loop', 'gather', 'hungarian']:
+            loss = sisdr_l.PermInvariantSISDR(n_sources=n_sources,
+                                              zero_mean=True,
+                                              improvement=True,
+                                              return_individual_results=True,
+                                              perm_search=perm_search)
+            pr = pr_batch.clone().requires_grad_()
+            sisnr, best_perms = loss(
+                pr, t_batch, initial_mixtures=t_batch.sum(1, keepdim=True),
+                return_best_permutation=True)
+            sisnr.sum().backward()
+            results[perm_search] = (sisnr.detach(), best_perms, pr.grad)
+
+        for perm_search in ['gather', 'hungarian']:
+            sisnr, best_perms, grad = results[perm_search]
+            assert torch.equal(best_perms, results['loop'][1])
+            assert torch.allclose(sisnr, results['loop'][0], atol=1e-5)
+            assert torch.allclose(grad, results['loop'][2], atol=1e-6)
+
+
+def test_hungarian_perm_search_many_sources(bs=2, n_sources=12,
+                                            length=4000):
+    # 12! permutations would not fit in memory, so none must be listed
+    torch.manual_seed(0)
+    loss = sisdr_l.PermInvariantSISDR(n_sources=n_sources, zero_mean=True,
+                                      perm_search='auto')
+    assert loss.perm_search == 'hungarian'
+    assert loss.permutations is None and loss.permutations_tensor is None
+    t_batch = torch.randn(bs, n_sources, length)
+    true_perms = torch.stack([torch.randperm(n_sources) for _ in range(bs)])
+    pr_batch = torch.stack([t[p] for t, p in zip(t_batch, true_perms)])
+    pr_batch = pr_batch + 0.1 * torch.randn(bs, n_sources, length)
+    _, best_perms = loss(pr_batch, t_batch, return_best_permutation=True)
+    # The estimate best_perms[b, j] is assigned to the target j
+    assert torch.equal(true_perms[torch.arange(bs).unsqueeze(1), best_perms],
+                       torch.arange(n_sources).expand(bs, -1))
+
+
+def test_masked_sisnr_matches_unpadded(n_sources=2):
+    torch.manual_seed(0)
+    lengths = [8000, 6500, 3000]
+    loss = sisdr_l.PermInvariantSISDR(n_sources=n_sources, zero_mean=True,
+                                      backward_loss=False,
+                                      return_individual_results=True)
+    pr_batch = torch.zeros(len(lengths), n_sources, max(lengths))
+    t_batch = torch.zeros(len(lengths), n_sources, max(lengths))
+    mask = torch.zeros(len(lengths), 1, max(lengths))
+    expected = []
+    for i, length in enumerate(lengths):
+        t = torch.randn(1, n_sources, length) + 0.5
+        pr = t.flip(1) + 0.5 * torch.randn(1, n_sources, length)
+        expected.append(loss(pr, t, initial_mixtures=t.sum(1, keepdim=True)))
+        pr_batch[i, :, :length] = pr[0]
+        # Garbage in the padding of the estimates must be ignored
+        pr_batch[i, :, length:] = 1.
+        t_batch[i, :, :length] = t[0]
+        mask[i, :, :length] = 1.
+    masked = loss(pr_batch, t_batch,
+                  initial_mixtures=t_batch.sum(1, keepdim=True), mask=mask)
+    assert torch.allclose(masked, torch.cat(expected), atol=1e-4)
+
+
+def test_pit_wrapper_hungarian_backend(bs=4, length=8000):
+    torch.manual_seed(0)
+    for n_src in range(2, 7):
+        targets = torch.randn(bs, n_src, length)
+        est_targets = (targets[:, torch.randperm(n_src)] +
+                       0.5 * torch.randn(bs, n_src, length))
+        results = {}
+        for perm_backend in ['permutations', 'hungarian']:
+            loss_func = sisdr_l.PITLossWrapper(
+                sisdr_l.PairwiseNegSDR("sisdr"), pit_from='pw_mtx',
+                perm_backend=perm_backend)
+            results[perm_backend] = loss_func(est_targets, targets,
+                                              return_est=True)
+        assert torch.allclose(results['hungarian'][0],
+                              results['permutations'][0], atol=1e-5)
+        assert torch.equal(results['hungarian'][1],
+                           results['permutations'][1])
+
+
+def test_pit_wrapper_perm_reduce_many_sources(bs=16, n_src=6):
+    # The worst source of the permutation with the best mean is in general
+    # not the best worst source, so the hungarian backend cannot be used
+    torch.manual_seed(0)
+
+    def max_reduce(pwl_set):
+        return torch.max(pwl_set, dim=-1)[0]
+
+    pw_losses = torch.rand(bs, n_src, n_src)
+    pwl = pw_losses.transpose(-1, -2)
+    perms = torch.tensor(list(itertools.permutations(range(n_src))))
+    pwl_set = pwl[:, torch.arange(n_src), perms]
+    expected = max_reduce(pwl_set).min(-1)[0].mean()
+    mean_optimal = max_reduce(pwl_set)[
+        torch.arange(bs), pwl_set.mean(-1).argmin(-1)].mean()
+    assert mean_optimal > expected
+
+    loss_func = sisdr_l.PITLossWrapper(lambda est, tgt: pw_losses,
+                                       pit_from='pw_mtx',
+                                       perm_reduce=max_reduce)
+    est_targets = torch.randn(bs, n_src, 100)
+    assert torch.allclose(loss_func(est_targets, est_targets), expected)
+
+    try:
+        sisdr_l.PITLossWrapper(lambda est, tgt: pw_losses,
+                               perm_reduce=max_reduce,
+                               perm_backend='hungarian')
+        assert False
+    except ValueError:
+        pass
+
+
+def benchmark_perm_search(bs=4, length=32000, max_n_sources=8):
+    for n_sources in range(2, max_n_sources + 1):
+        t_batch = torch.randn(bs, n_sources, length)
+        timings = []
+        # The loop keeps all the n_sources! permuted copies for the backward
+        for perm_search in (['loop', 'gather', 'hungarian'] if n_sources <= 5
+                            else ['gather', 'hungarian']):
+            loss = sisdr_l.PermInvariantSISDR(n_sources=n_sources,
+                                              zero_mean=True,
+                                              perm_search=perm_search)
+            pr_batch = torch.randn(bs, n_sources, length, requires_grad=True)
+            before = time()
+            loss(pr_batch, t_batch).backward()
+            timings.append('{}: {:.1f} ms'.format(
+                perm_search, 1000 * (time() - before)))
+        print('N={} '.format(n_sources) + ', '.join(timings))
+
+
 if __name__ == "__main__":
     test_sisnr_implementations()
+    benchmark_perm_search()
@@ -8,6 +8,13 @@
 import torch
 import torch.nn as nn
 import math
+try:
+    from . import efficient_attention
+    from .efficient_attention import PositionalEncoding
+except ImportError:
+    # When this file is run as a script
+    import efficient_attention
+    from efficient_attention import PositionalEncoding
 
 
 class _LayerNorm(nn.Module):
@@ -33,8 +40,15 @@ class GlobLN(_LayerNorm):
     def forward(self, x):
         dims = list(range(1, len(x.shape)))
         mean = x.mean(dim=dims, keepdim=True)
-        var = torch.pow(x - mean, 2).mean(dim=dims, keepdim=True)
-        return self.apply_gain_and_bias((x - mean) / (var + 1e-8).sqrt())
+        # The norm reduction avoids materializing the squared deviations
+        var = torch.linalg.vector_norm(
+            x - mean, dim=dims, keepdim=True) ** 2 / x[0].numel()
+        # Merge the normalization with the gain and the bias into a single
+        # scale and shift per channel which are applied in one pass.
+        affine_shape = [-1] + [1] * (len(x.shape) - 2)
+        scale = self.gamma.view(affine_shape) * (var + 1e-8).rsqrt()
+        shift = self.beta.view(affine_shape) - mean * scale
+        return torch.addcmul(shift, x, scale)
 
 
 class ConvNormAct(nn.Module):
@@ -150,24 +164,29 @@ class DilatedConvNorm(nn.Module):
 
 
 class MHANormLayer(nn.Module):
-    """Multi-head attention with residual addition and normalization."""
+    """Multi-head attention with residual addition and normalization. With a
+    window_size the attention is local (see
+    efficient_attention.windowed_attention)."""
+    # Class attribute so that the pickled models get the default
+    window_size = None
+
     def __init__(self, in_dim, att_dim=128,
                  num_heads=4, dropout=0.1,
-                 max_len=5000):
+                 window_size=None):
         super(MHANormLayer, self).__init__()
         self.mha = nn.MultiheadAttention(
             att_dim, num_heads=num_heads, dropout=dropout,
             bias=True, add_bias_kv=False,
             add_zero_attn=False, kdim=None, vdim=None, batch_first=True,
             device=None, dtype=None)
-        # self.in_linear = nn.Linear(in_dim, att_dim)
+        self.in_linear = nn.Linear(in_dim, att_dim)
         self.in_norm = GlobLN(att_dim)
         self.out_norm1 = GlobLN(att_dim)
         self.out_norm2 = GlobLN(in_dim)
-        # self.out_linear = nn.Linear(att_dim, in_dim)
-        self.pos_enc = PositionalEncoding(
-            d_model=att_dim, dropout=dropout, max_len=max_len)
+        self.out_linear = nn.Linear(att_dim, in_dim)
+        self.pos_enc = PositionalEncoding(d_model=att_dim, dropout=dropout)
         self.act = nn.PReLU()
+        self.window_size = window_size
 
     def forward(self, x):
         # x.shape: batch_size, n_channels, time_samples
@@ -175,9 +194,9 @@ class MHANormLayer(nn.Module):
         x = self.pos_enc(x)
         x = self.in_norm(x.transpose(1, 2)).transpose(1, 2)
         x = x + self.out_norm1(
-            self.mha(query=x,
-                     key=x,
-                     value=x)[0].transpose(1, 2)).transpose(1, 2)
+            efficient_attention.multihead_attention(
+                self.mha, x, x, x,
+                window_size=self.window_size).transpose(1, 2)).transpose(1, 2)
         return self.act(
             self.out_norm2(self.out_linear(x).transpose(1, 2)))
         # x = self.in_linear(x.transpose(1, 2))
@@ -193,25 +212,6 @@ class MHANormLayer(nn.Module):
         # return self.act(self.out_linear(x).transpose(1, 2))
 
 
-class PositionalEncoding(nn.Module):
-
-    def __init__(self, d_model, dropout=0.1, max_len=5000):
-        super(PositionalEncoding, self).__init__()
-        self.dropout = nn.Dropout(p=dropout)
-
-        pe = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(
-            torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
-
-    def forward(self, x):
-        return self.dropout(x + self.pe[:, :x.size(1), :])
-
-
 class AttentiveUConvBlock(nn.Module):
     '''
     This class defines the block which performs successive downsampling and
@@ -226,7 +226,8 @@ class AttentiveUConvBlock(nn.Module):
                  upsampling_depth=4,
                  n_heads=4,
                  att_dims=256,
-                 att_dropout=0.1):
+                 att_dropout=0.1,
+                 att_window_size=None):
         super().__init__()
         self.proj_1x1 = ConvNormAct(out_channels, in_channels, 1,
                                     stride=1, groups=1)
@@ -256,7 +257,8 @@ class AttentiveUConvBlock(nn.Module):
         self.attention = MHANormLayer(in_dim=in_channels,
                                       att_dim=att_dims,
                                       num_heads=n_heads,
-                                      dropout=att_dropout)
+                                      dropout=att_dropout,
+                                      window_size=att_window_size)
 
     def forward(self, x):
         '''
@@ -298,7 +300,8 @@ class SuDORMRF(nn.Module):
                  n_heads=4,
                  att_dims=256,
                  att_dropout=0.1,
-                 num_sources=2):
+                 num_sources=2,
+                 att_window_size=None):
         super(SuDORMRF, self).__init__()
 
         # Number of sources to produce
@@ -338,7 +341,8 @@ class SuDORMRF(nn.Module):
                                 upsampling_depth=upsampling_depth,
                                 n_heads=n_heads,
                                 att_dims=att_dims,
-                                att_dropout=att_dropout)
+                                att_dropout=att_dropout,
+                                att_window_size=att_window_size)
             for _ in range(num_blocks)])
 
         mask_conv = nn.Conv1d(out_channels, num_sources * enc_num_basis, 1)
@@ -377,16 +381,10 @@ class SuDORMRF(nn.Module):
         return self.remove_trailing_zeros(estimated_waveforms, input_wav)
 
     def pad_to_appropriate_length(self, x):
-        values_to_pad = int(x.shape[-1]) % self.lcm
-        if values_to_pad:
-            appropriate_shape = x.shape
-            padded_x = torch.zeros(
-                list(appropriate_shape[:-1]) +
-                [appropriate_shape[-1] + self.lcm - values_to_pad],
-                dtype=torch.float32)
-            padded_x[..., :x.shape[-1]] = x
-            return padded_x
-        return x
+        # The padding is computed from the traced length so that the same
+        # graph serves every input length after exporting.
+        values_to_pad = (self.lcm - x.shape[-1] % self.lcm) % self.lcm
+        return nn.functional.pad(x, (0, values_to_pad))
 
     @staticmethod
     def remove_trailing_zeros(padded_x, initial_x):
@@ -8,6 +8,13 @@
 import torch
 import torch.nn as nn
 import math
+try:
+    from . import efficient_attention
+    from .efficient_attention import PositionalEncoding
+except ImportError:
+    # When this file is run as a script
+    import efficient_attention
+    from efficient_attention import PositionalEncoding
 
 
 class _LayerNorm(nn.Module):
@@ -33,8 +40,15 @@ class GlobLN(_LayerNorm):
     def forward(self, x):
         dims = list(range(1, len(x.shape)))
         mean = x.mean(dim=dims, keepdim=True)
-        var = torch.pow(x - mean, 2).mean(dim=dims, keepdim=True)
-        return self.apply_gain_and_bias((x - mean) / (var + 1e-8).sqrt())
+        # The norm reduction avoids materializing the squared deviations
+        var = torch.linalg.vector_norm(
+            x - mean, dim=dims, keepdim=True) ** 2 / x[0].numel()
+        # Merge the normalization with the gain and the bias into a single
+        # scale and shift per channel which are applied in one pass.
+        affine_shape = [-1] + [1] * (len(x.shape) - 2)
+        scale = self.gamma.view(affine_shape) * (var + 1e-8).rsqrt()
+        shift = self.beta.view(affine_shape) - mean * scale
+        return torch.addcmul(shift, x, scale)
 
 
 class ConvNormAct(nn.Module):
@@ -152,8 +166,7 @@ class DilatedConvNorm(nn.Module):
 class MHANormLayer(nn.Module):
     """Multi-head attention with residual addition and normalization."""
     def __init__(self, in_dim, att_dim=128,
-                 num_heads=4, dropout=0.1,
-                 max_len=5000):
+                 num_heads=4, dropout=0.1):
         super(MHANormLayer, self).__init__()
         self.mha = nn.MultiheadAttention(
             att_dim, num_heads=num_heads, dropout=dropout,
@@ -164,8 +177,7 @@ class MHANormLayer(nn.Module):
         self.in_norm = GlobLN(att_dim)
         self.out_norm = GlobLN(att_dim)
         self.out_linear = nn.Linear(att_dim, in_dim)
-        self.pos_enc = PositionalEncoding(
-            d_model=att_dim, dropout=dropout, max_len=max_len)
+        self.pos_enc = PositionalEncoding(d_model=att_dim, dropout=dropout)
         self.act = nn.PReLU()
 
     def forward(self, x):
@@ -177,27 +189,12 @@ class MHANormLayer(nn.Module):
         return self.act(self.out_linear(x).transpose(1, 2))
 
 
-class PositionalEncoding(nn.Module):
-
-    def __init__(self, d_model, dropout=0.1, max_len=3200):
-        super(PositionalEncoding, self).__init__()
-        self.dropout = nn.Dropout(p=dropout)
-
-        pe = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(
-            torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
-
-    def forward(self, x):
-        return self.dropout(x + self.pe[:, :x.size(1), :])
-
-
 class MHAttentionLayer(nn.Module):
-    def __init__(self, emb_dim, d_model, n_heads, dropout=0.0):
+    # Class attribute so that the pickled models get the default
+    window_size = None
+
+    def __init__(self, emb_dim, d_model, n_heads, dropout=0.0,
+                 window_size=None):
         super(MHAttentionLayer, self).__init__()
         self.dropout = nn.Dropout(dropout)
         self.Q_proj = nn.Linear(emb_dim, d_model * n_heads)
@@ -206,10 +203,12 @@ class MHAttentionLayer(nn.Module):
         self.O_proj = nn.Linear(d_model * n_heads, emb_dim)
         self.n_heads = n_heads
         self.d_model = d_model
-        self.q_normalizer = 1. / math.sqrt(d_model)
+        self.window_size = window_size
 
     def forward(self, Q, K, V):
-        """Implements the multihead softmax attention.
+        """Implements the multihead softmax attention without materializing
+        the attention tensor, windowed if window_size is set (see
+        efficient_attention.windowed_attention).
         Arguments
         ---------
             Q: (batch_size, q_len, emb_dim)
@@ -219,19 +218,16 @@ class MHAttentionLayer(nn.Module):
         bs, q_len, _ = Q.shape
         _, kv_len, _ = K.shape
 
-        Q = self.q_normalizer * self.Q_proj(Q).view(
-            bs, q_len, self.n_heads, -1)
-        K = self.K_proj(K).view(bs, kv_len, self.n_heads, -1)
-        V = self.V_proj(V).view(bs, kv_len, self.n_heads, -1)
-
-        # Query-Key inner product per head
-        QK = torch.einsum("nlhd,nshd->nhls", Q, K)
+        # (batch_size, n_heads, seq_len, d_model)
+        Q = self.Q_proj(Q).view(bs, q_len, self.n_heads, -1).transpose(1, 2)
+        K = self.K_proj(K).view(bs, kv_len, self.n_heads, -1).transpose(1, 2)
+        V = self.V_proj(V).view(bs, kv_len, self.n_heads, -1).transpose(1, 2)
 
-        # Compute the attention tensor over the values length
-        A = self.dropout(torch.softmax(QK, dim=-1))
-
-        # Compute the output tensor per head
-        V = torch.einsum("nhls,nshd->nlhd", A, V)
+        # The softmax is scaled by 1 / sqrt(d_model)
+        V = efficient_attention.attention(
+            Q, K, V, window_size=self.window_size,
+            dropout_p=self.dropout.p if self.training else 0.)
+        V = V.transpose(1, 2)
         # V: (batch_size, q_len, n_heads, d_model)
 
         return self.O_proj(V.reshape(bs, q_len, -1))
@@ -239,15 +235,14 @@ class MHAttentionLayer(nn.Module):
 
 class TransformerLayer(nn.Module):
     def __init__(self, emb_dim, d_model, n_heads,
-                 dropout=0.1, max_len=5000):
+                 dropout=0.1, window_size=None):
         super(TransformerLayer, self).__init__()
         self.mha = MHAttentionLayer(
-            emb_dim, d_model, n_heads, dropout=0.0)
+            emb_dim, d_model, n_heads, dropout=0.0, window_size=window_size)
         self.out_norm = GlobLN(emb_dim)
         self.out_mha_norm = GlobLN(emb_dim)
         self.ffn = ConvNormAct(emb_dim, emb_dim, 1, stride=1, groups=1)
-        self.pos_enc = PositionalEncoding(
-            d_model=emb_dim, dropout=dropout, max_len=max_len)
+        self.pos_enc = PositionalEncoding(d_model=emb_dim, dropout=dropout)
 
     def forward(self, x):
         # x has shape: (batch_size, n_channels, seq_len)
@@ -275,7 +270,8 @@ class AttentiveUConvBlock(nn.Module):
                  upsampling_depth=4,
                  n_heads=4,
                  att_dims=256,
-                 att_dropout=0.1):
+                 att_dropout=0.1,
+                 att_window_size=None):
         super().__init__()
         self.proj_1x1 = ConvNormAct(out_channels, in_channels, 1,
                                     stride=1, groups=1)
@@ -304,7 +300,7 @@ class AttentiveUConvBlock(nn.Module):
         # Attention layer
         self.attention = TransformerLayer(
             in_channels, att_dims, n_heads,
-            dropout=att_dropout, max_len=5000
+            dropout=att_dropout, window_size=att_window_size
         )
 
     def forward(self, x):
@@ -347,7 +343,8 @@ class SuDORMRF(nn.Module):
                  n_heads=4,
                  att_dims=256,
                  att_dropout=0.1,
-                 num_sources=2):
+                 num_sources=2,
+                 att_window_size=None):
         super(SuDORMRF, self).__init__()
 
         # Number of sources to produce
@@ -387,7 +384,8 @@ class SuDORMRF(nn.Module):
                                 upsampling_depth=upsampling_depth,
                                 n_heads=4,
                                 att_dims=256,
-                                att_dropout=0.1)
+                                att_dropout=0.1,
+                                att_window_size=att_window_size)
             for _ in range(num_blocks)])
 
         mask_conv = nn.Conv1d(out_channels, num_sources * enc_num_basis, 1)
@@ -426,16 +424,10 @@ class SuDORMRF(nn.Module):
         return self.remove_trailing_zeros(estimated_waveforms, input_wav)
 
     def pad_to_appropriate_length(self, x):
-        values_to_pad = int(x.shape[-1]) % self.lcm
-        if values_to_pad:
-            appropriate_shape = x.shape
-            padded_x = torch.zeros(
-                list(appropriate_shape[:-1]) +
-                [appropriate_shape[-1] + self.lcm - values_to_pad],
-                dtype=torch.float32)
-            padded_x[..., :x.shape[-1]] = x
-            return padded_x
-        return x
+        # The padding is computed from the traced length so that the same
+        # graph serves every input length after exporting.
+        values_to_pad = (self.lcm - x.shape[-1] % self.lcm) % self.lcm
+        return nn.functional.pad(x, (0, values_to_pad))
 
     @staticmethod
     def remove_trailing_zeros(padded_x, initial_x):
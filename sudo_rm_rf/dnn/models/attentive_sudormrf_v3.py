@@ -8,6 +8,13 @@
 import torch
 import torch.nn as nn
 import math
+try:
+    from . import efficient_attention
+    from .efficient_attention import PositionalEncoding
+except ImportError:
+    # When this file is run as a script
+    import efficient_attention
+    from efficient_attention import PositionalEncoding
 
 
 class _LayerNorm(nn.Module):
@@ -33,8 +40,15 @@ class GlobLN(_LayerNorm):
     def forward(self, x):
         dims = list(range(1, len(x.shape)))
         mean = x.mean(dim=dims, keepdim=True)
-        var = torch.pow(x - mean, 2).mean(dim=dims, keepdim=True)
-        return self.apply_gain_and_bias((x - mean) / (var + 1e-8).sqrt())
+        # The norm reduction avoids materializing the squared deviations
+        var = torch.linalg.vector_norm(
+            x - mean, dim=dims, keepdim=True) ** 2 / x[0].numel()
+        # Merge the normalization with the gain and the bias into a single
+        # scale and shift per channel which are applied in one pass.
+        affine_shape = [-1] + [1] * (len(x.shape) - 2)
+        scale = self.gamma.view(affine_shape) * (var + 1e-8).rsqrt()
+        shift = self.beta.view(affine_shape) - mean * scale
+        return torch.addcmul(shift, x, scale)
 
 
 class ConvNormAct(nn.Module):
@@ -152,8 +166,7 @@ class DilatedConvNorm(nn.Module):
 class MHANormLayer(nn.Module):
     """Multi-head attention with residual addition and normalization."""
     def __init__(self, in_dim, att_dim=128,
-                 num_heads=4, dropout=0.1,
-                 max_len=5000):
+                 num_heads=4, dropout=0.1):
         super(MHANormLayer, self).__init__()
         self.mha = nn.MultiheadAttention(
             att_dim, num_heads=num_heads, dropout=dropout,
@@ -164,8 +177,7 @@ class MHANormLayer(nn.Module):
         self.in_norm = GlobLN(att_dim)
         self.out_norm = GlobLN(att_dim)
         self.out_linear = nn.Linear(att_dim, in_dim)
-        self.pos_enc = PositionalEncoding(
-            d_model=att_dim, dropout=dropout, max_len=max_len)
+        self.pos_enc = PositionalEncoding(d_model=att_dim, dropout=dropout)
         self.act = nn.PReLU()
 
     def forward(self, x):
@@ -177,27 +189,12 @@ class MHANormLayer(nn.Module):
         return self.act(self.out_linear(x).transpose(1, 2))
 
 
-class PositionalEncoding(nn.Module):
-
-    def __init__(self, d_model, dropout=0.1, max_len=3200):
-        super(PositionalEncoding, self).__init__()
-        self.dropout = nn.Dropout(p=dropout)
-
-        pe = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(
-            torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
-
-    def forward(self, x):
-        return self.dropout(x + self.pe[:, :x.size(1), :])
-
-
 class MHAttentionLayer(nn.Module):
-    def __init__(self, emb_dim, d_model, n_heads, dropout=0.0):
+    # Class attribute so that the pickled models get the default
+    window_size = None
+
+    def __init__(self, emb_dim, d_model, n_heads, dropout=0.0,
+                 window_size=None):
         super(MHAttentionLayer, self).__init__()
         self.dropout = nn.Dropout(dropout)
         self.Q_proj = nn.Linear(emb_dim, d_model * n_heads)
@@ -206,10 +203,12 @@ class MHAttentionLayer(nn.Module):
         self.O_proj = nn.Linear(d_model * n_heads, emb_dim)
         self.n_heads = n_heads
         self.d_model = d_model
-        self.q_normalizer = 1. / math.sqrt(d_model)
+        self.window_size = window_size
 
     def forward(self, Q, K, V):
-        """Implements the multihead softmax attention.
+        """Implements the multihead softmax attention without materializing
+        the attention tensor, windowed if window_size is set (see
+        efficient_attention.windowed_attention).
         Arguments
         ---------
             Q: (batch_size, q_len, emb_dim)
@@ -219,35 +218,61 @@ class MHAttentionLayer(nn.Module):
         bs, q_len, _ = Q.shape
         _, kv_len, _ = K.shape
 
-        Q = self.q_normalizer * self.Q_proj(Q).view(
-            bs, q_len, self.n_heads, -1)
-        K = self.K_proj(K).view(bs, kv_len, self.n_heads, -1)
-        V = self.V_proj(V).view(bs, kv_len, self.n_heads, -1)
+        # (batch_size, n_heads, seq_len, d_model)
+        Q = self.Q_proj(Q).view(bs, q_len, self.n_heads, -1).transpose(1, 2)
+        K = self.K_proj(K).view(bs, kv_len, self.n_heads, -1).transpose(1, 2)
+        V = self.V_proj(V).view(bs, kv_len, self.n_heads, -1).transpose(1, 2)
 
-        # Query-Key inner product per head
-        QK = torch.einsum("nlhd,nshd->nhls", Q, K)
+        # The softmax is scaled by 1 / sqrt(d_model)
+        V = efficient_attention.attention(
+            Q, K, V, window_size=self.window_size,
+            dropout_p=self.dropout.p if self.training else 0.)
+        V = V.transpose(1, 2)
+        # V: (batch_size, q_len, n_heads, d_model)
 
-        # Compute the attention tensor over the values length
-        A = self.dropout(torch.softmax(QK, dim=-1))
+        return self.O_proj(V.reshape(bs, q_len, -1))
 
-        # Compute the output tensor per head
-        V = torch.einsum("nhls,nshd->nlhd", A, V)
-        # V: (batch_size, q_len, n_heads, d_model)
+    def init_state(self, cache_size):
+        '''
+        Creates the streaming state of step, which holds the projected keys
+        and values of the last cache_size frames.
+        '''
+        return efficient_attention.init_kv_cache(cache_size)
+
+    def step(self, Q, K, V, state):
+        """Streaming version of forward for the next chunk of the queries
+        and the keys, where each query attends causally to the last
+        cache_size keys (see efficient_attention.cached_attention).
+        Arguments
+        ---------
+            Q: (batch_size, q_len, emb_dim), q_len a multiple of kv_len
+            K: (batch_size, kv_len, emb_dim)
+            V: (batch_size, kv_len, emb_dim)
+            state: the dictionary returned by init_state, updated in place
+        """
+        bs, q_len, _ = Q.shape
+        _, kv_len, _ = K.shape
+
+        # (batch_size, n_heads, seq_len, d_model)
+        Q = self.Q_proj(Q).view(bs, q_len, self.n_heads, -1).transpose(1, 2)
+        K = self.K_proj(K).view(bs, kv_len, self.n_heads, -1).transpose(1, 2)
+        V = self.V_proj(V).view(bs, kv_len, self.n_heads, -1).transpose(1, 2)
 
+        V = efficient_attention.cached_attention(Q, K, V, state)
+        V = V.transpose(1, 2)
         return self.O_proj(V.reshape(bs, q_len, -1))
 
 
 class TransformerLayer(nn.Module):
     def __init__(self, emb_dim, d_model, n_heads,
-                 dropout=0.1, max_len=5000):
+                 dropout=0.1, window_size=None):
         super(TransformerLayer, self).__init__()
         self.mha = MHAttentionLayer(
-            emb_dim, d_model, n_heads, dropout=0.0)
+            emb_dim, d_model, n_heads, dropout=0.0, window_size=window_size)
         self.out_norm = GlobLN(emb_dim)
         self.out_mha_norm = GlobLN(emb_dim)
         self.ffn = ConvNormAct(emb_dim, emb_dim, 1, stride=1, groups=1)
-        self.pos_enc = PositionalEncoding(
-            d_model=emb_dim, dropout=dropout, max_len=max_len)
+        self.pos_enc = PositionalEncoding(d_model=emb_dim, dropout=dropout)
 
     def forward(self, x):
         # x has shape: (batch_size, n_channels, seq_len)
@@ -260,18 +285,42 @@ class TransformerLayer(nn.Module):
         # Apply the FFN layer
         return self.out_norm(self.ffn(x) + x)
 
+    def init_state(self, cache_size):
+        '''
+        Creates the streaming state of step.
+
+        :param cache_size: the number of the past frames which each frame
+                           attends to, including itself
+        '''
+        return {'attention': self.mha.init_state(cache_size), 'n_frames': 0}
+
+    def step(self, x, state):
+        '''
+        Processes the next chunk of a stream with causal attention to the
+        last cache_size frames, in constant time and memory per chunk. The
+        normalization layers use the statistics of the chunk.
+
+        :param x: (batch_size, n_channels, chunk_len)
+        :param state: the dictionary returned by init_state, updated in place
+        :return: (batch_size, n_channels, chunk_len)
+        '''
+        x = self.pos_enc(x.transpose(1, 2), offset=state['n_frames'])
+        state['n_frames'] += x.shape[1]
+        x = x + self.mha.step(Q=x, K=x, V=x, state=state['attention'])
+        x = self.out_mha_norm(x.transpose(1, 2))
+        return self.out_norm(self.ffn(x) + x)
+
 
 class ConditionalTransformerLayer(nn.Module):
     def __init__(self, emb_dim, d_model, n_heads,
-                 dropout=0.1, max_len=5000):
+                 dropout=0.1, window_size=None):
         super(ConditionalTransformerLayer, self).__init__()
         self.mha = MHAttentionLayer(
-            emb_dim, d_model, n_heads, dropout=0.0)
+            emb_dim, d_model, n_heads, dropout=0.0, window_size=window_size)
         self.out_norm = GlobLN(emb_dim)
         self.out_mha_norm = GlobLN(emb_dim)
         self.ffn = ConvNormAct(emb_dim, emb_dim, 1, stride=1, groups=1)
-        self.pos_enc = PositionalEncoding(
-            d_model=emb_dim, dropout=dropout, max_len=max_len)
+        self.pos_enc = PositionalEncoding(d_model=emb_dim, dropout=dropout)
 
     def forward(self, q, v):
         # q has shape: (batch_size, n_channels, query_len)
@@ -286,6 +335,35 @@ class ConditionalTransformerLayer(nn.Module):
         # Apply the FFN layer
         return self.out_norm(self.ffn(q) + q)
 
+    def init_state(self, cache_size):
+        '''
+        Creates the streaming state of step.
+
+        :param cache_size: the number of the past frames of v which each
+                           frame of q attends to
+        '''
+        return {'attention': self.mha.init_state(cache_size), 'n_frames': 0}
+
+    def step(self, q, v, state):
+        '''
+        Processes the next chunk of a stream, where the frames of q attend
+        causally to the last cache_size frames of v, in constant time and
+        memory per chunk. The normalization layers use the statistics of
+        the chunk.
+
+        :param q: (batch_size, n_channels, query_len), a multiple of
+                  value_len, e.g. twice for the upsampling resamplers
+        :param v: (batch_size, n_channels, value_len)
+        :param state: the dictionary returned by init_state, updated in place
+        :return: (batch_size, n_channels, query_len)
+        '''
+        v = self.pos_enc(v.transpose(1, 2), offset=state['n_frames'])
+        state['n_frames'] += v.shape[1]
+        q = q.transpose(1, 2) + self.mha.step(
+            Q=q.transpose(1, 2), K=v, V=v, state=state['attention'])
+        q = self.out_mha_norm(q.transpose(1, 2))
+        return self.out_norm(self.ffn(q) + q)
+
 
 class AttentiveUConvBlock(nn.Module):
     '''
@@ -301,7 +379,8 @@ class AttentiveUConvBlock(nn.Module):
                  upsampling_depth=4,
                  n_heads=4,
                  att_dims=256,
-                 att_dropout=0.1):
+                 att_dropout=0.1,
+                 att_window_size=None):
         super().__init__()
         self.proj_1x1 = ConvNormAct(out_channels, in_channels, 1,
                                     stride=1, groups=1)
@@ -332,7 +411,7 @@ class AttentiveUConvBlock(nn.Module):
         for i in range(1, self.depth):
             this_layer = ConditionalTransformerLayer(
                 in_channels, att_dims, n_heads,
-                dropout=att_dropout, max_len=5000
+                dropout=att_dropout, window_size=att_window_size
             )
             self.attentive_resamplers.append(this_layer)
         self.attentive_resamplers = nn.ModuleList(
@@ -376,7 +455,8 @@ class SuDORMRF(nn.Module):
                  n_heads=4,
                  att_dims=256,
                  att_dropout=0.1,
-                 num_sources=2):
+                 num_sources=2,
+                 att_window_size=None):
         super(SuDORMRF, self).__init__()
 
         # Number of sources to produce
@@ -416,7 +496,8 @@ class SuDORMRF(nn.Module):
                                 upsampling_depth=upsampling_depth,
                                 n_heads=4,
                                 att_dims=256,
-                                att_dropout=0.1)
+                                att_dropout=0.1,
+                                att_window_size=att_window_size)
             for _ in range(num_blocks)])
 
         mask_conv = nn.Conv1d(out_channels, num_sources * enc_num_basis, 1)
@@ -455,16 +536,10 @@ class SuDORMRF(nn.Module):
         return self.remove_trailing_zeros(estimated_waveforms, input_wav)
 
     def pad_to_appropriate_length(self, x):
-        values_to_pad = int(x.shape[-1]) % self.lcm
-        if values_to_pad:
-            appropriate_shape = x.shape
-            padded_x = torch.zeros(
-                list(appropriate_shape[:-1]) +
-                [appropriate_shape[-1] + self.lcm - values_to_pad],
-                dtype=torch.float32)
-            padded_x[..., :x.shape[-1]] = x
-            return padded_x.to(x.device)
-        return x
+        # The padding is computed from the traced length so that the same
+        # graph serves every input length after exporting.
+        values_to_pad = (self.lcm - x.shape[-1] % self.lcm) % self.lcm
+        return nn.functional.pad(x, (0, values_to_pad))
 
     @staticmethod
     def remove_trailing_zeros(padded_x, initial_x):
@@ -19,18 +19,53 @@ class ScaledWSConv1d(nn.Conv1d):
                            kernel_size, stride, padding, dilation,
                            groups, bias)
         self.causal_mask = torch.ones_like(self.weight)
+        self.future_samples = 0
         if kernel_size >= 3:
-            future_samples = kernel_size // 2
-            self.causal_mask[..., -future_samples:] = 0.
+            self.future_samples = kernel_size // 2
+            self.causal_mask[..., -self.future_samples:] = 0.
+        self.causal_kernel_size = kernel_size - self.future_samples
 
     def get_weight(self):
         return self.weight * self.causal_mask.to(self.weight.device)
 
+    def get_causal_weight(self):
+        return self.weight[..., :self.causal_kernel_size]
+
     def forward(self, x):
+        if (self.future_samples > 0 and self.dilation[0] == 1 and
+                self.padding[0] == self.future_samples):
+            # The masked future taps do not contribute to the output so we
+            # skip them together with the right zero-padding.
+            return nn.functional.conv1d(
+                nn.functional.pad(x, (self.padding[0], 0)),
+                self.get_causal_weight(), self.bias,
+                self.stride, 0, self.dilation, self.groups)
         return nn.functional.conv1d(
             x, self.get_weight(), self.bias,
             self.stride, self.padding, self.dilation, self.groups)
 
+    def init_buffer(self, batch_size):
+        return self.weight.new_zeros(
+            batch_size, self.in_channels, self.causal_kernel_size - 1)
+
+    def step(self, x, buffer, compute_output=True):
+        '''
+        Streaming forward pass on the newest input frames.
+
+        :param x: newest input frames of size: batch x channels x stride
+        :param buffer: past input frames of size:
+                       batch x channels x (causal_kernel_size - 1)
+        :param compute_output: whether an output frame is due at this step
+        :return: the output frame (or None) and the updated buffer
+        '''
+        window = torch.cat([buffer, x], -1)
+        out = None
+        if compute_output:
+            out = nn.functional.conv1d(
+                window[..., :self.causal_kernel_size],
+                self.get_causal_weight(), self.bias, groups=self.groups)
+        return out, window[..., x.shape[-1]:]
+
 class ConvAct(nn.Module):
     '''
     This class defines the dilated convolution with normalized output.
@@ -53,6 +88,13 @@ class ConvAct(nn.Module):
         output = self.conv(input)
         return self.act(output)
 
+    def step(self, input, buffer, compute_output=True):
+        output, buffer = self.conv.step(input, buffer,
+                                        compute_output=compute_output)
+        if output is None:
+            return None, buffer
+        return self.act(output), buffer
+
 
 class UConvBlock(nn.Module):
     '''
@@ -86,11 +128,10 @@ class UConvBlock(nn.Module):
                                        kSize=21,
                                        stride=stride,
                                        groups=in_channels))
-        if upsampling_depth > 1:
-            self.upsampler = torch.nn.Upsample(scale_factor=2,
-                                               # align_corners=True,
-                                               # mode='bicubic'
-                                               )
+        self.upsampler = torch.nn.Upsample(scale_factor=2,
+                                           # align_corners=True,
+                                           # mode='bicubic'
+                                           )
         self.res_conv = ScaledWSConv1d(in_channels, out_channels, 1)
 
     def forward(self, x):
@@ -101,11 +142,12 @@ class UConvBlock(nn.Module):
         residual = x.clone()
         # Reduce --> project high-dimensional feature maps to low-dimensional space
         output1 = self.proj_1x1(x / self.beta)
-        output = [self.spp_dw[0](output1)]
+        output = []
+        out_k = output1
 
         # Do the downsampling process from the previous level
-        for k in range(1, self.depth):
-            out_k = self.spp_dw[k](output[-1])
+        for layer in self.spp_dw:
+            out_k = layer(out_k)
             output.append(out_k)
 
         # Gather them now in reverse order
@@ -116,6 +158,47 @@ class UConvBlock(nn.Module):
         return self.res_conv(output[-1]) * self.skipinit_gain * self.alpha + residual
         # return self.res_conv(output[-1]) + residual
 
+    def init_state(self, batch_size=1):
+        return {'buffers': [layer.conv.init_buffer(batch_size)
+                            for layer in self.spp_dw],
+                'resampled': [None] * self.depth,
+                'n_frames': 0}
+
+    def step(self, x, state):
+        '''
+        Streaming forward pass for a single frame.
+
+        The resolution level k produces a new frame every 2^k input frames
+        and until then the nearest upsampler keeps repeating its last
+        aggregated output.
+
+        :param x: input frame of size: batch x out_channels x 1
+        :param state: the dictionary returned by init_state, updated in place
+        :return: transformed frame of size: batch x out_channels x 1
+        '''
+        t = state['n_frames']
+        output = [self.proj_1x1(x / self.beta)]
+        for k in range(self.depth):
+            # The previous level has not produced a new frame
+            if t % (2 ** max(k - 1, 0)):
+                break
+            out_k, state['buffers'][k] = self.spp_dw[k].step(
+                output[-1], state['buffers'][k],
+                compute_output=not t % (2 ** k))
+            if out_k is None:
+                break
+            output.append(out_k)
+
+        # Gather the new frames in reverse order
+        for k in reversed(range(len(output) - 1)):
+            if k < self.depth - 1:
+                output[k + 1] = output[k + 1] + state['resampled'][k + 1]
+            state['resampled'][k] = output[k + 1]
+        state['n_frames'] += 1
+
+        return (self.res_conv(state['resampled'][0]) * self.skipinit_gain *
+                self.alpha + x)
+
 
 class CausalSuDORMRF(nn.Module):
     def __init__(self,
@@ -214,24 +297,66 @@ class CausalSuDORMRF(nn.Module):
         # x = x * s.unsqueeze(1)
         # Back end
         estimated_waveforms = self.decoder(x.view(x.shape[0], -1, x.shape[-1]))
-        return self.remove_trailing_zeros(estimated_waveforms, input_wav)
+        return estimated_waveforms[..., :input_wav.shape[-1]]
 
     def pad_to_appropriate_length(self, x):
-        values_to_pad = int(x.shape[-1]) % self.lcm
-        if values_to_pad:
-            appropriate_shape = x.shape
-            padded_x = torch.zeros(
-                list(appropriate_shape[:-1]) +
-                [appropriate_shape[-1] + self.lcm - values_to_pad],
-                dtype=torch.float32)
-            padded_x[..., :x.shape[-1]] = x
-            return padded_x.to(x.device)
-        return x
+        # The padding is computed from the traced length so that the same
+        # graph serves every input length after exporting.
+        values_to_pad = (self.lcm - x.shape[-1] % self.lcm) % self.lcm
+        return nn.functional.pad(x, (0, values_to_pad))
 
     @staticmethod
     def remove_trailing_zeros(padded_x, initial_x):
         return padded_x[..., :initial_x.shape[-1]]
 
+    def init_state(self, batch_size=1):
+        '''
+        Creates the streaming state which holds the buffered past inputs of
+        every causal convolution, the last aggregated output of every
+        resolution level and the overlap-add buffer of the decoder.
+        '''
+        hop = self.enc_kernel_size // 2
+        return {'encoder': self.encoder.init_buffer(batch_size),
+                'blocks': [block.init_state(batch_size) for block in self.sm],
+                'decoder': self.decoder.weight.new_zeros(
+                    batch_size, self.num_sources * self.in_audio_channels,
+                    self.enc_kernel_size - hop)}
+
+    def step(self, frame, state):
+        '''
+        Streaming forward pass with constant cost per frame.
+
+        Concatenating the outputs of successive steps gives the output of the
+        offline forward delayed by one hop, since each decoded frame overlaps
+        with the next one.
+
+        :param frame: input audio frame of size:
+                      batch x in_audio_channels x (enc_kernel_size // 2)
+        :param state: the dictionary returned by init_state, updated in place
+        :return: estimated sources frame of size:
+                 batch x (num_sources * in_audio_channels) x
+                 (enc_kernel_size // 2)
+        '''
+        hop = self.enc_kernel_size // 2
+        x, state['encoder'] = self.encoder.step(frame, state['encoder'])
+
+        x = self.bottleneck(x)
+        for block, block_state in zip(self.sm, state['blocks']):
+            x = block.step(x, block_state)
+
+        x = self.mask_net(x)
+        x = x.view(x.shape[0],
+                   self.num_sources * self.in_audio_channels,
+                   self.enc_num_basis, -1)
+        x = self.mask_nl_class(x)
+        decoded = nn.functional.conv_transpose1d(
+            x.view(x.shape[0], -1, 1), self.decoder.weight, stride=hop)
+        overlap = state['decoder'].shape[-1]
+        decoded = torch.cat([decoded[..., :overlap] + state['decoder'],
+                             decoded[..., overlap:]], -1)
+        state['decoder'] = decoded[..., hop:]
+        return decoded[..., :hop]
+
 
 if __name__ == "__main__":
     in_audio_channels = 2
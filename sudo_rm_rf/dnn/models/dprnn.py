@@ -13,6 +13,11 @@ import numpy
 import math
 from numpy.lib import stride_tricks
 # from utils import overlap_and_add, device
+try:
+    from . import dual_path_chunking
+except ImportError:
+    # When this file is run as a script
+    import dual_path_chunking
 from torch.autograd import Variable
 import glob2
 import datetime
@@ -27,41 +32,9 @@ def overlap_and_add(signal, frame_step):
     `[..., frames, frame_length]`, offsetting subsequent frames by `frame_step`.
     The resulting tensor has shape `[..., output_size]` where
         output_size = (frames - 1) * frame_step + frame_length
-    Args:
-        signal: A [..., frames, frame_length] Tensor. All dimensions may be unknown, and rank must be at least 2.
-        frame_step: An integer denoting overlap offsets. Must be less than or equal to frame_length.
-    Returns:
-        A Tensor with shape [..., output_size] containing the overlap-added frames of signal's inner-most two dimensions.
-        output_size = (frames - 1) * frame_step + frame_length
-    Based on https://github.com/tensorflow/tensorflow/blob/r1.12/tensorflow/contrib/signal/python/ops/reconstruction_ops.py
+    See dual_path_chunking.overlap_and_add.
     """
-    outer_dimensions = signal.size()[:-2]
-    frames, frame_length = signal.size()[-2:]
-
-    subframe_length = math.gcd(frame_length, frame_step)  # gcd=Greatest Common Divisor
-    subframe_step = frame_step // subframe_length
-    subframes_per_frame = frame_length // subframe_length
-    output_size = frame_step * (frames - 1) + frame_length
-    output_subframes = output_size // subframe_length
-
-    # print(subframe_length)
-    # print(signal.shape)
-    # print(outer_dimensions)
-    # subframe_signal = signal.view(*outer_dimensions, -1, subframe_length)
-    subframe_signal = signal.reshape(*outer_dimensions, -1, subframe_length)
-
-    frame = torch.arange(0, output_subframes).unfold(0, subframes_per_frame, subframe_step)
-    # frame = signal.new_tensor(frame).long()  # signal may in GPU or CPU
-    if int(subframe_signal.get_device()) >= 0:
-        frame = frame.clone().long().cuda()
-    else:
-        frame = frame.clone().long()
-    frame = frame.contiguous().view(-1)
-
-    result = signal.new_zeros(*outer_dimensions, output_subframes, subframe_length)
-    result.index_add_(-2, frame, subframe_signal)
-    result = result.view(*outer_dimensions, -1)
-    return result
+    return dual_path_chunking.overlap_and_add(signal, frame_step)
 
 def remove_pad(inputs, inputs_lengths):
     """
@@ -260,51 +233,16 @@ class DPRNN_base(nn.Module):
                                    self.feature_dim * self.num_spk,
                                    num_layers=layer, bidirectional=bidirectional)
 
-    def pad_segment(self, input, segment_size):
-        # input is the features: (B, N, T)
-        batch_size, dim, seq_len = input.shape
-        segment_stride = segment_size // 2
-
-        rest = segment_size - (segment_stride + seq_len % segment_size) % segment_size
-        if rest > 0:
-            pad = Variable(torch.zeros(batch_size, dim, rest)).type(input.type())
-            input = torch.cat([input, pad], 2)
-
-        pad_aux = Variable(torch.zeros(batch_size, dim, segment_stride)).type(input.type())
-        input = torch.cat([pad_aux, input, pad_aux], 2)
-
-        return input, rest
-
     def split_feature(self, input, segment_size):
         # split the feature into chunks of segment size
         # input is the features: (B, N, T)
-
-        input, rest = self.pad_segment(input, segment_size)
-        batch_size, dim, seq_len = input.shape
-        segment_stride = segment_size // 2
-
-        segments1 = input[:, :, :-segment_stride].contiguous().view(batch_size, dim, -1, segment_size)
-        segments2 = input[:, :, segment_stride:].contiguous().view(batch_size, dim, -1, segment_size)
-        segments = torch.cat([segments1, segments2], 3).view(batch_size, dim, -1, segment_size).transpose(2, 3)
-
-        return segments.contiguous(), rest
+        # output is a strided view of the padded features: (B, N, L, K)
+        return dual_path_chunking.split_chunks(input, segment_size)
 
     def merge_feature(self, input, rest):
         # merge the splitted features into full utterance
         # input is the features: (B, N, L, K)
-
-        batch_size, dim, segment_size, _ = input.shape
-        segment_stride = segment_size // 2
-        input = input.transpose(2, 3).contiguous().view(batch_size, dim, -1, segment_size * 2)  # B, N, K, L
-
-        input1 = input[:, :, :, :segment_size].contiguous().view(batch_size, dim, -1)[:, :, segment_stride:]
-        input2 = input[:, :, :, segment_size:].contiguous().view(batch_size, dim, -1)[:, :, :-segment_stride]
-
-        output = input1 + input2
-        if rest > 0:
-            output = output[:, :, :-rest]
-
-        return output.contiguous()  # B, N, T
+        return dual_path_chunking.merge_chunks(input, rest)  # B, N, T
 
     def forward(self, input):
         pass
@@ -0,0 +1,65 @@
+"""!
+@brief Half overlapping chunking of the dual-path models (Sepformer, DPRNN)
+and overlap-and-add of framed signals. The chunks are a strided view of the
+padded input (unfold), so no chunk is copied, and the overlap-and-add is a
+single F.fold instead of building the halves of the chunks separately.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch.nn.functional as F
+
+
+def overlap_and_add(signal, frame_step):
+    '''
+    Adds the frames of a signal, offsetting each one by frame_step.
+
+    :param signal: ... x frames x frame_length
+    :param frame_step: the hop between the frames, less than or equal to
+                       frame_length
+    :return: ... x output_size where
+             output_size = (frames - 1) * frame_step + frame_length
+    '''
+    outer_dimensions = signal.shape[:-2]
+    frames, frame_length = signal.shape[-2:]
+    output_size = (frames - 1) * frame_step + frame_length
+    # fold expects: batch x frame_length x frames
+    signal = signal.reshape(-1, frames, frame_length).transpose(1, 2)
+    result = F.fold(signal, output_size=(1, output_size),
+                    kernel_size=(1, frame_length), stride=(1, frame_step))
+    return result.view(*outer_dimensions, output_size)
+
+
+def split_chunks(x, chunk_size):
+    '''
+    Splits the input in chunks with a hop of chunk_size // 2. The input is
+    zero padded with the hop at the start and with the hop plus a gap at
+    the end, so that every sample is in two chunks.
+
+    :param x: B x N x L
+    :param chunk_size: K, an even number for exactly half overlapping
+                       chunks
+    :return: the chunks: B x N x K x S which are a strided view of the
+             padded input and the gap which merge_chunks removes.
+    '''
+    hop = chunk_size // 2
+    gap = chunk_size - (hop + x.shape[-1] % chunk_size) % chunk_size
+    x = F.pad(x, (hop, hop + gap))
+    # B x N x S x K
+    chunks = x.unfold(-1, chunk_size, hop)
+    return chunks.transpose(2, 3), gap
+
+
+def merge_chunks(chunks, gap):
+    '''
+    Overlap-and-add of the chunks of split_chunks.
+
+    :param chunks: B x N x K x S
+    :param gap: the gap which split_chunks returned
+    :return: B x N x L
+    '''
+    chunk_size = chunks.shape[2]
+    hop = chunk_size // 2
+    x = overlap_and_add(chunks.transpose(2, 3), hop)
+    return x[..., hop:x.shape[-1] - hop - gap]
@@ -0,0 +1,227 @@
+"""!
+@brief Attention helpers of the attentive SuDO-RM-RF models and the
+Sepformer for long inputs. The attention runs through
+F.scaled_dot_product_attention, which does not materialize the attention
+matrices when the memory-efficient or flash kernels are available, and can
+be restricted to a local window so that its memory and time grow linearly
+with the sequence length. The sinusoidal positional encodings are computed
+for any sequence length and cached, instead of a fixed buffer in each layer.
+For streaming, cached_attention attends causally to a bounded cache of the
+past keys and values, so that the cost of each chunk does not grow with the
+length of the stream.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# (d_model, device, dtype): the longest encodings computed so far
+_ENCODINGS = {}
+
+
+def compute_sinusoidal_encoding(start, end, d_model, device=None):
+    position = torch.arange(start, end, dtype=torch.float,
+                            device=device).unsqueeze(1)
+    div_term = torch.exp(
+        torch.arange(0, d_model, 2, device=device).float() *
+        (-math.log(10000.0) / d_model))
+    encoding = torch.zeros(end - start, d_model, device=device)
+    encoding[:, 0::2] = torch.sin(position * div_term)
+    encoding[:, 1::2] = torch.cos(position * div_term)
+    return encoding
+
+
+def sinusoidal_encoding(length, d_model, device=None, dtype=torch.float32,
+                        offset=0):
+    '''
+    The sinusoidal positional encodings of the positions: offset, ...,
+    offset + length - 1. The ones from 0 are cached for each d_model, device
+    and dtype, and recomputed for the next power of two when a longer
+    sequence comes. The ones of the later chunks of a stream (offset > 0)
+    are computed each time, so that the cache does not grow with the stream.
+
+    :param length: the sequence length
+    :param d_model: the (even) number of features
+    :param offset: the position of the first element
+    :return: length x d_model
+    '''
+    if offset > 0:
+        return compute_sinusoidal_encoding(
+            offset, offset + length, d_model, device=device).to(dtype)
+    key = (d_model, device, dtype)
+    encoding = _ENCODINGS.get(key)
+    if encoding is None or encoding.shape[0] < length:
+        max_len = 2 ** math.ceil(math.log2(max(length, 1)))
+        encoding = compute_sinusoidal_encoding(
+            0, max_len, d_model, device=device).to(dtype)
+        _ENCODINGS[key] = encoding
+    return encoding[:length]
+
+
+class PositionalEncoding(nn.Module):
+    """! Adds the sinusoidal positional encodings to an input of shape:
+    batch_size x seq_len x d_model, for any seq_len."""
+    def __init__(self, d_model, dropout=0.1):
+        super(PositionalEncoding, self).__init__()
+        self.dropout = nn.Dropout(p=dropout)
+
+    def forward(self, x, offset=0):
+        '''
+        :param x: batch_size x seq_len x d_model
+        :param offset: the position of the first element, e.g. the number
+                       of the already streamed frames
+        '''
+        return self.dropout(x + sinusoidal_encoding(
+            x.size(1), x.size(2), device=x.device, dtype=x.dtype,
+            offset=offset))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # The checkpoints of the fixed length version store the encodings
+        state_dict.pop(prefix + 'pe', None)
+        super(PositionalEncoding, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+
+def windowed_attention(q, k, v, window_size, dropout_p=0.):
+    '''
+    Local attention. The keys are split in blocks of window_size and the
+    queries in as many blocks (ratio * window_size long, where ratio is the
+    ceiling of q_len / kv_len). The queries of each block attend only to the
+    keys of the same and of the two neighbouring blocks.
+
+    :param q: batch_size x n_heads x q_len x head_dim
+    :param k: batch_size x n_heads x kv_len x head_dim
+    :param v: batch_size x n_heads x kv_len x value_dim
+    :param window_size: the length of the key blocks
+    :param dropout_p: dropout of the attention weights
+    :return: batch_size x n_heads x q_len x value_dim
+    '''
+    B, H, q_len, _ = q.shape
+    kv_len = k.shape[2]
+    n_blocks = -(-kv_len // window_size)
+    q_block = -(-q_len // kv_len) * window_size
+    kv_pad = n_blocks * window_size - kv_len
+    # B x (H * n_blocks) x q_block x head_dim
+    q = F.pad(q, (0, 0, 0, n_blocks * q_block - q_len)).reshape(
+        B, H * n_blocks, q_block, -1)
+    # B x (H * n_blocks) x (3 * window_size) x head_dim
+    k, v = [F.pad(x, (0, 0, window_size, window_size + kv_pad)).unfold(
+                2, 3 * window_size, window_size).transpose(-1, -2).reshape(
+                B, H * n_blocks, 3 * window_size, -1)
+            for x in (k, v)]
+    # Only the keys of the sequence take part in the attention
+    valid = F.pad(torch.ones(kv_len, dtype=torch.bool, device=q.device),
+                  (window_size, window_size + kv_pad)).unfold(
+                      0, 3 * window_size, window_size)
+    valid = valid.unsqueeze(1).repeat(H, 1, 1)
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=valid,
+                                         dropout_p=dropout_p)
+    return out.reshape(B, H, n_blocks * q_block, -1)[:, :, :q_len]
+
+
+def attention(q, k, v, window_size=None, dropout_p=0.):
+    '''
+    Softmax attention, windowed if window_size is set.
+
+    :param q: batch_size x n_heads x q_len x head_dim
+    :param k: batch_size x n_heads x kv_len x head_dim
+    :param v: batch_size x n_heads x kv_len x value_dim
+    :return: batch_size x n_heads x q_len x value_dim
+    '''
+    if window_size is None:
+        return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+    return windowed_attention(q, k, v, window_size, dropout_p=dropout_p)
+
+
+def causal_window_mask(q_len, kv_cached, kv_len, cache_size, device=None):
+    '''
+    The mask of the causal attention of a chunk of q_len queries to the
+    kv_cached keys of the previous chunks and the kv_len keys of the chunk.
+    There are ratio = q_len // kv_len queries per key of the chunk (e.g. 2
+    for the upsampled queries of a resampler). Query i attends to the last
+    cache_size keys up to the key kv_cached + i // ratio.
+
+    :return: q_len x (kv_cached + kv_len), True for the attended keys
+    '''
+    ratio = q_len // kv_len
+    last_key = kv_cached + torch.arange(q_len, device=device) // ratio
+    keys = torch.arange(kv_cached + kv_len, device=device)
+    return ((keys <= last_key.unsqueeze(1)) &
+            (keys > last_key.unsqueeze(1) - cache_size))
+
+
+def init_kv_cache(cache_size):
+    '''
+    :param cache_size: the number of the past keys (and values) which each
+                       query attends to, including its own
+    :return: the streaming state of cached_attention
+    '''
+    return {'keys': None, 'values': None, 'cache_size': cache_size}
+
+
+def cached_attention(q, k, v, cache):
+    '''
+    Streaming causal attention of the queries of a chunk to the keys of the
+    chunk and to the cached keys of the previous chunks (see
+    causal_window_mask). Only the last cache_size keys and values are kept,
+    so the cost of each chunk is bounded.
+
+    :param q: batch_size x n_heads x q_len x head_dim
+    :param k: batch_size x n_heads x kv_len x head_dim, the keys of the
+              chunk where q_len is a multiple of kv_len
+    :param v: batch_size x n_heads x kv_len x value_dim
+    :param cache: the dictionary returned by init_kv_cache, updated in place
+    :return: batch_size x n_heads x q_len x value_dim
+    '''
+    kv_len = k.shape[2]
+    if cache['keys'] is not None:
+        k = torch.cat([cache['keys'], k], dim=2)
+        v = torch.cat([cache['values'], v], dim=2)
+    mask = causal_window_mask(q.shape[2], k.shape[2] - kv_len, kv_len,
+                              cache['cache_size'], device=q.device)
+    cache['keys'] = k[:, :, -cache['cache_size']:]
+    cache['values'] = v[:, :, -cache['cache_size']:]
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+
+def multihead_attention(mha, query, key, value, window_size=None):
+    '''
+    The output of an nn.MultiheadAttention (without masks, bias_k or
+    add_zero_attn) with the same weights, through attention().
+
+    :param mha: the nn.MultiheadAttention
+    :param query: batch_size x q_len x embed_dim
+    :param key: batch_size x kv_len x kdim
+    :param value: batch_size x kv_len x vdim
+    :param window_size: see windowed_attention
+    :return: batch_size x q_len x embed_dim
+    '''
+    if query is key and key is value and mha._qkv_same_embed_dim:
+        # A single projection for the self-attention
+        q, k, v = F.linear(
+            query, mha.in_proj_weight, mha.in_proj_bias).chunk(3, dim=-1)
+    else:
+        if mha._qkv_same_embed_dim:
+            w_q, w_k, w_v = mha.in_proj_weight.chunk(3)
+        else:
+            w_q, w_k, w_v = (mha.q_proj_weight, mha.k_proj_weight,
+                             mha.v_proj_weight)
+        b_q, b_k, b_v = (mha.in_proj_bias.chunk(3)
+                         if mha.in_proj_bias is not None
+                         else (None, None, None))
+        q = F.linear(query, w_q, b_q)
+        k = F.linear(key, w_k, b_k)
+        v = F.linear(value, w_v, b_v)
+
+    B, q_len, E = q.shape
+    H = mha.num_heads
+    # B x H x seq_len x (E // H)
+    q, k, v = [x.reshape(B, x.shape[1], H, E // H).transpose(1, 2)
+               for x in (q, k, v)]
+    output = attention(q, k, v, window_size=window_size,
+                       dropout_p=mha.dropout if mha.training else 0.)
+    return mha.out_proj(output.transpose(1, 2).reshape(B, q_len, E))
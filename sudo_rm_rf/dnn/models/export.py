@@ -0,0 +1,158 @@
+"""!
+@brief Export of the SuDO-RM-RF models (improved, original, causal and
+groupcomm_v2) to TorchScript and ONNX with a dynamic batch and time axis,
+together with a separator which runs either of the exported files behind the
+same separate() call.
+
+E.g.:
+python export.py --model_path Improved_Sudormrf_U36_Bases2048_WSJ02mix.pt \
+--output_path improved_sudormrf.onnx --format onnx
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import argparse
+import copy
+import numpy as np
+import torch
+
+EXPORT_FORMATS = ['torchscript', 'onnx']
+INPUT_NAME = 'mixture'
+OUTPUT_NAME = 'estimated_sources'
+
+
+def prepare_for_export(model):
+    '''
+    Returns a copy of the model in evaluation mode with the affine parameters
+    of the input norm folded when the model supports it, so that the model
+    of the caller is not changed.
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    if hasattr(model, 'fuse_for_inference'):
+        model.fuse_for_inference()
+    return model
+
+
+def get_example_input(model, batch_size=1, n_samples=8000):
+    in_audio_channels = getattr(model, 'in_audio_channels', 1)
+    return torch.rand(batch_size, in_audio_channels, n_samples)
+
+
+def export_torchscript(model, filepath):
+    '''
+    Scripts the model so that the padding to the appropriate length and the
+    trailing zeros removal stay dynamic w.r.t. the input length.
+
+    :param model: one of the SuDO-RM-RF models
+    :param filepath: the path of the saved TorchScript module
+    :return: the scripted module
+    '''
+    scripted_model = torch.jit.script(prepare_for_export(model))
+    scripted_model.save(filepath)
+    return scripted_model
+
+
+def export_onnx(model, filepath, example_input=None, opset_version=13):
+    '''
+    Traces the model into an ONNX graph with a dynamic batch and time axis.
+
+    :param model: one of the SuDO-RM-RF models
+    :param filepath: the path of the saved ONNX graph
+    :param example_input: the mixture used for tracing of size:
+                          batch x in_audio_channels x n_samples. Its length
+                          should not be a multiple of the model lcm, so that
+                          the padding is traced.
+    :param opset_version: the ONNX opset
+    '''
+    model = prepare_for_export(model)
+    if example_input is None:
+        example_input = get_example_input(model, n_samples=8001)
+    dynamic_axes = {INPUT_NAME: {0: 'batch', 2: 'time'},
+                    OUTPUT_NAME: {0: 'batch', 2: 'time'}}
+    with torch.no_grad():
+        torch.onnx.export(model, (example_input,), filepath,
+                          input_names=[INPUT_NAME],
+                          output_names=[OUTPUT_NAME],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          # The folded constants are left behind Identity
+                          # nodes which the graph optimizations of
+                          # onnxruntime cannot resolve
+                          do_constant_folding=False)
+
+
+class ExportedSeparator(object):
+    '''
+    Runs an exported model on the CPU. Files with the .onnx extension are run
+    with onnxruntime and the rest are loaded as TorchScript modules.
+    '''
+
+    def __init__(self, filepath, num_threads=None):
+        self.filepath = filepath
+        if filepath.endswith('.onnx'):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = (
+                onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL)
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.backend = 'onnxruntime'
+            self.session = onnxruntime.InferenceSession(
+                filepath, options, providers=['CPUExecutionProvider'])
+        else:
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.backend = 'torchscript'
+            self.model = torch.jit.load(filepath, map_location='cpu').eval()
+
+    def separate(self, mixture):
+        '''
+        :param mixture: torch tensor or numpy array of size:
+                        batch x in_audio_channels x n_samples
+        :return: estimated sources torch tensor of size:
+                 batch x (num_sources * in_audio_channels) x n_samples
+        '''
+        if self.backend == 'onnxruntime':
+            if isinstance(mixture, torch.Tensor):
+                mixture = mixture.detach().cpu().numpy()
+            est_sources = self.session.run(
+                [OUTPUT_NAME],
+                {INPUT_NAME: np.ascontiguousarray(mixture, dtype=np.float32)})
+            return torch.from_numpy(est_sources[0])
+        if not isinstance(mixture, torch.Tensor):
+            mixture = torch.from_numpy(np.asarray(mixture, dtype=np.float32))
+        with torch.no_grad():
+            return self.model(mixture)
+
+
+def get_args():
+    """! Command line parser """
+    parser = argparse.ArgumentParser(
+        description='Export a pretrained SuDO-RM-RF model.')
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="""The path of the pretrained model saved with
+                        torch.save.""")
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--format", type=str, default='torchscript',
+                        choices=EXPORT_FORMATS)
+    parser.add_argument("--opset_version", type=int, default=13)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    model = torch.load(args.model_path, map_location='cpu',
+                       weights_only=False)
+    if args.format == 'torchscript':
+        export_torchscript(model, args.output_path)
+    else:
+        export_onnx(model, args.output_path,
+                    opset_version=args.opset_version)
+    # Parity of the exported file with eager mode on an unseen length
+    mixture = get_example_input(model, batch_size=2, n_samples=12345)
+    with torch.no_grad():
+        eager_sources = model(mixture)
+    exported_sources = ExportedSeparator(args.output_path).separate(mixture)
+    print('Exported to: {} max abs difference with eager mode: {}'.format(
+        args.output_path, (exported_sources - eager_sources).abs().max()))
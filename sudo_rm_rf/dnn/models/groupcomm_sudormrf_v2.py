@@ -49,10 +49,21 @@ class GlobLN(_LayerNorm):
         Returns:
             :class:`torch.Tensor`: gLN_x `[batch, chan, *]`
         """
-        dims = list(range(1, len(x.shape)))
+        dims = [d for d in range(1, x.dim())]
+        # The size is a product of traced dims and not a constant numel
+        n_elements = 1
+        for d in dims:
+            n_elements = n_elements * x.shape[d]
         mean = x.mean(dim=dims, keepdim=True)
-        var = torch.pow(x - mean, 2).mean(dim=dims, keepdim=True)
-        return self.apply_gain_and_bias((x - mean) / (var + 1e-8).sqrt())
+        # The norm reduction avoids materializing the squared deviations
+        var = torch.linalg.vector_norm(
+            x - mean, dim=dims, keepdim=True) ** 2 / n_elements
+        # Merge the normalization with the gain and the bias into a single
+        # scale and shift per channel which are applied in one pass.
+        affine_shape = [-1] + [1] * (len(x.shape) - 2)
+        scale = self.gamma.view(affine_shape) * (var + 1e-8).rsqrt()
+        shift = self.beta.view(affine_shape) - mean * scale
+        return torch.addcmul(shift, x, scale)
 
 
 class ConvNormAct(nn.Module):
@@ -195,11 +206,10 @@ class UConvBlock(nn.Module):
                                                kSize=2*stride + 1,
                                                stride=stride,
                                                groups=in_channels, d=1))
-        if upsampling_depth > 1:
-            self.upsampler = torch.nn.Upsample(scale_factor=2,
-                                               # align_corners=True,
-                                               # mode='bicubic'
-                                               )
+        self.upsampler = torch.nn.Upsample(scale_factor=2,
+                                           # align_corners=True,
+                                           # mode='bicubic'
+                                           )
         self.final_norm = NormAct(in_channels)
         self.res_conv = nn.Conv1d(in_channels, out_channels, 1)
 
@@ -211,11 +221,12 @@ class UConvBlock(nn.Module):
         residual = x.clone()
         # Reduce --> project high-dimensional feature maps to low-dimensional space
         output1 = self.proj_1x1(x)
-        output = [self.spp_dw[0](output1)]
+        output = []
+        out_k = output1
 
         # Do the downsampling process from the previous level
-        for k in range(1, self.depth):
-            out_k = self.spp_dw[k](output[-1])
+        for layer in self.spp_dw:
+            out_k = layer(out_k)
             output.append(out_k)
 
         # Gather them now in reverse order
@@ -322,19 +333,13 @@ class GroupCommSudoRmRf(nn.Module):
         x = x * s.unsqueeze(1)
         # Back end
         estimated_waveforms = self.decoder(x.view(x.shape[0], -1, x.shape[-1]))
-        return self.remove_trailing_zeros(estimated_waveforms, input_wav)
+        return estimated_waveforms[..., :input_wav.shape[-1]]
 
     def pad_to_appropriate_length(self, x):
-        values_to_pad = int(x.shape[-1]) % self.lcm
-        if values_to_pad:
-            appropriate_shape = x.shape
-            padded_x = torch.zeros(
-                list(appropriate_shape[:-1]) +
-                [appropriate_shape[-1] + self.lcm - values_to_pad],
-                dtype=torch.float32)
-            padded_x[..., :x.shape[-1]] = x
-            return padded_x.to(x.device)
-        return x
+        # The padding is computed from the traced length so that the same
+        # graph serves every input length after exporting.
+        values_to_pad = (self.lcm - x.shape[-1] % self.lcm) % self.lcm
+        return nn.functional.pad(x, (0, values_to_pad))
 
     @staticmethod
     def remove_trailing_zeros(padded_x, initial_x):
@@ -356,34 +361,42 @@ class TAC(nn.Module):
         self.TAC_norm = GlobLN(input_size)
 
     def forward(self, input):
-        # input shape: batch, group, N, seq_length
-
+        '''
+        The linear layers are applied as 1x1 convolutions over the time-major
+        layout of the input, so the groups are never permuted to the last
+        dimension. The output layer is split over the two halves of its
+        input (the group features and their mean) instead of concatenating
+        the mean broadcasted to every group.
+
+        :param input: batch, group, N, seq_length
+        :return: batch, group, N, seq_length
+        '''
         batch_size, G, N, T = input.shape
-        output = input
-
-        # transform group_input = output  # B, G, N, T
-        group_input = output.permute(0, 3, 1, 2).contiguous().view(-1,
-                                                                   N)  # B*T*G, N
-        group_output = self.TAC_input(group_input).view(batch_size, T, G,
-                                                        -1)  # B, T, G, H
-
-        # mean pooling
-        group_mean = group_output.mean(2).view(batch_size * T, -1)  # B*T, H
-
-        # concate
-        group_output = group_output.view(batch_size * T, G, -1)  # B*T, G, H
-        group_mean = self.TAC_mean(group_mean).unsqueeze(1).expand_as(
-            group_output).contiguous()  # B*T, G, H
-        group_output = torch.cat([group_output, group_mean], 2)  # B*T, G, 2H
-        group_output = self.TAC_output(
-            group_output.view(-1, group_output.shape[-1]))  # B*T*G, N
-        group_output = group_output.view(batch_size, T, G, -1).permute(0, 2, 3,
-                                                                       1).contiguous()  # B, G, N, T
-        group_output = self.TAC_norm(
-            group_output.view(batch_size * G, N, T))  # B*G, N, T
-        output = output + group_output.view(input.shape)
-
-        return output
+        hidden_size = self.TAC_input[0].out_features
+        in_weight = self.TAC_input[0].weight.unsqueeze(-1)
+        mean_weight = self.TAC_mean[0].weight.unsqueeze(-1)
+        out_weight = self.TAC_output[0].weight.unsqueeze(-1)
+
+        # B*G, H, T
+        group_output = self.TAC_input[1](nn.functional.conv1d(
+            input.view(batch_size * G, N, T), in_weight,
+            self.TAC_input[0].bias))
+        # B, H, T
+        group_mean = group_output.view(batch_size, G, hidden_size, T).mean(1)
+        group_mean = self.TAC_mean[1](nn.functional.conv1d(
+            group_mean, mean_weight, self.TAC_mean[0].bias))
+
+        # TAC_output([group_output, group_mean]) without the concatenation
+        group_output = nn.functional.conv1d(
+            group_output, out_weight[:, :hidden_size])
+        group_mean = nn.functional.conv1d(
+            group_mean, out_weight[:, hidden_size:], self.TAC_output[0].bias)
+        group_output = self.TAC_output[1](
+            group_output.view(batch_size, G, N, T) + group_mean.unsqueeze(1))
+
+        # B*G, N, T
+        group_output = self.TAC_norm(group_output.view(batch_size * G, N, T))
+        return input + group_output.view(input.shape)
 
 
 # GroupComm-UBlock
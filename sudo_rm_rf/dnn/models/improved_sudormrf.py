@@ -7,7 +7,10 @@
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import math
+import itertools
+import time
 
 
 class _LayerNorm(nn.Module):
@@ -41,10 +44,21 @@ class GlobLN(_LayerNorm):
         Returns:
             :class:`torch.Tensor`: gLN_x `[batch, chan, *]`
         """
-        dims = list(range(1, len(x.shape)))
+        dims = [d for d in range(1, x.dim())]
+        # The size is a product of traced dims and not a constant numel
+        n_elements = 1
+        for d in dims:
+            n_elements = n_elements * x.shape[d]
         mean = x.mean(dim=dims, keepdim=True)
-        var = torch.pow(x - mean, 2).mean(dim=dims, keepdim=True)
-        return self.apply_gain_and_bias((x - mean) / (var + 1e-8).sqrt())
+        # The norm reduction avoids materializing the squared deviations
+        var = torch.linalg.vector_norm(
+            x - mean, dim=dims, keepdim=True) ** 2 / n_elements
+        # Merge the normalization with the gain and the bias into a single
+        # scale and shift per channel which are applied in one pass.
+        affine_shape = [-1] + [1] * (len(x.shape) - 2)
+        scale = self.gamma.view(affine_shape) * (var + 1e-8).rsqrt()
+        shift = self.beta.view(affine_shape) - mean * scale
+        return torch.addcmul(shift, x, scale)
 
 
 class ConvNormAct(nn.Module):
@@ -165,6 +179,10 @@ class UConvBlock(nn.Module):
     upsampling in order to be able to analyze the input features in multiple
     resolutions.
     '''
+    # Number of the highest resolution levels which are recomputed in the
+    # backward pass instead of storing their activations. A class attribute
+    # so that the models pickled before it existed still load.
+    checkpoint_levels = 0
 
     def __init__(self,
                  out_channels=128,
@@ -187,11 +205,10 @@ class UConvBlock(nn.Module):
                                                kSize=2*stride + 1,
                                                stride=stride,
                                                groups=in_channels, d=1))
-        if upsampling_depth > 1:
-            self.upsampler = torch.nn.Upsample(scale_factor=2,
-                                               # align_corners=True,
-                                               # mode='bicubic'
-                                               )
+        self.upsampler = torch.nn.Upsample(scale_factor=2,
+                                           # align_corners=True,
+                                           # mode='bicubic'
+                                           )
         self.final_norm = NormAct(in_channels)
         self.res_conv = nn.Conv1d(in_channels, out_channels, 1)
 
@@ -200,14 +217,18 @@ class UConvBlock(nn.Module):
         :param x: input feature map
         :return: transformed feature map
         '''
-        residual = x.clone()
+        if not torch.jit.is_scripting():
+            if self.training and self.checkpoint_levels > 0:
+                return self.forward_checkpointed(x)
+        residual = x
         # Reduce --> project high-dimensional feature maps to low-dimensional space
         output1 = self.proj_1x1(x)
-        output = [self.spp_dw[0](output1)]
+        output = []
+        out_k = output1
 
         # Do the downsampling process from the previous level
-        for k in range(1, self.depth):
-            out_k = self.spp_dw[k](output[-1])
+        for layer in self.spp_dw:
+            out_k = layer(out_k)
             output.append(out_k)
 
         # Gather them now in reverse order
@@ -219,8 +240,46 @@ class UConvBlock(nn.Module):
 
         return self.res_conv(expanded) + residual
 
+    def forward_checkpointed(self, x):
+        '''
+        Same as forward but the checkpoint_levels highest resolution levels
+        are recomputed in the backward pass. The full resolution level,
+        i.e. the 1x1 projection, its downsampling and upsampling path and
+        the final norm, is checkpointed as one unit so that only its input
+        is kept. Each of the next checkpointed levels is a nested unit
+        which keeps only its (downsampled) input, so its own activations
+        are also not stored while the units above it are recomputed.
+        '''
+        expanded = checkpoint(self.forward_levels_from_input, x,
+                              use_reentrant=False)
+        return self.res_conv(expanded) + x
+
+    def forward_levels_from_input(self, x):
+        return self.final_norm(self.forward_levels(self.proj_1x1(x), 0))
+
+    def forward_levels(self, x, level):
+        '''
+        :param x: the input of the level
+        :param level: the level in the U-shape, 0 for the full resolution
+        :return: the output of the level plus the upsampled outputs of all
+                 the lower resolution levels, as in forward
+        '''
+        out_k = self.spp_dw[level](x)
+        if level + 1 == self.depth:
+            return out_k
+        if level + 1 < self.checkpoint_levels:
+            lower_levels = checkpoint(self.forward_levels, out_k, level + 1,
+                                      use_reentrant=False)
+        else:
+            lower_levels = self.forward_levels(out_k, level + 1)
+        return out_k + self.upsampler(lower_levels)
+
 
 class SuDORMRF(nn.Module):
+    # Every checkpoint_every_k_blocks-th block is recomputed in the backward
+    # pass, 0 disables it (see set_checkpointing)
+    checkpoint_every_k_blocks = 0
+
     def __init__(self,
                  out_channels=128,
                  in_channels=512,
@@ -228,7 +287,12 @@ class SuDORMRF(nn.Module):
                  upsampling_depth=4,
                  enc_kernel_size=21,
                  enc_num_basis=512,
-                 num_sources=2):
+                 num_sources=2,
+                 early_exit_blocks=None):
+        '''
+        :param early_exit_blocks: the numbers of blocks after which an
+                                  intermediate mask head is added, e.g. [4, 8]
+        '''
         super(SuDORMRF, self).__init__()
 
         # Number of sources to produce
@@ -271,6 +335,18 @@ class SuDORMRF(nn.Module):
         mask_conv = nn.Conv1d(out_channels, num_sources * enc_num_basis, 1)
         self.mask_net = nn.Sequential(nn.PReLU(), mask_conv)
 
+        # Intermediate mask heads for latency-budgeted inference
+        self.early_exit_blocks = sorted(set(early_exit_blocks or []))
+        if not all(0 < b < num_blocks for b in self.early_exit_blocks):
+            raise ValueError('Early exits: {} should be after one of the '
+                             'first {} blocks.'.format(
+                              self.early_exit_blocks, num_blocks - 1))
+        self.early_exit_heads = nn.ModuleDict({
+            str(b): nn.Sequential(
+                nn.PReLU(),
+                nn.Conv1d(out_channels, num_sources * enc_num_basis, 1))
+            for b in self.early_exit_blocks})
+
         # Back end
         self.decoder = nn.ConvTranspose1d(
             in_channels=enc_num_basis * num_sources,
@@ -284,41 +360,248 @@ class SuDORMRF(nn.Module):
         self.mask_nl_class = nn.ReLU()
     # Forward pass
     def forward(self, input_wav):
+        x, s = self.encode(input_wav)
+        # Separation module
+        if not torch.jit.is_scripting():
+            if self.training and self.checkpoint_every_k_blocks > 0:
+                for block_ind, block in enumerate(self.sm):
+                    x = self.run_block(block_ind, block, x)
+                return self.decode(self.mask_net(x), s, input_wav)
+        x = self.sm(x)
+        return self.decode(self.mask_net(x), s, input_wav)
+
+    def set_checkpointing(self, every_k_blocks=0, highest_res_levels=0):
+        '''
+        Trades compute for activation memory during training, e.g. for
+        segments of 10-20 sec. The recomputed activations are not stored
+        for the backward pass. Evaluation and TorchScript are not affected.
+
+        :param every_k_blocks: recompute the whole of every k-th UConvBlock,
+                               0 disables it
+        :param highest_res_levels: recompute the layers of this number of
+                                   the highest resolution levels in every
+                                   UConvBlock, 0 disables it
+        '''
+        if every_k_blocks < 0 or not 0 <= highest_res_levels <= \
+                self.upsampling_depth:
+            raise ValueError('Invalid checkpointing every: {} blocks for '
+                             'the {} highest resolution levels.'.format(
+                              every_k_blocks, highest_res_levels))
+        self.checkpoint_every_k_blocks = every_k_blocks
+        for block in self.sm:
+            block.checkpoint_levels = highest_res_levels
+        return self
+
+    def run_block(self, block_ind, block, x):
+        if (self.training and self.checkpoint_every_k_blocks > 0 and
+                block_ind % self.checkpoint_every_k_blocks == 0):
+            return checkpoint(block, x, use_reentrant=False)
+        return block(x)
+
+    def encode(self, input_wav):
         # Front end
         x = self.pad_to_appropriate_length(input_wav)
         x = self.encoder(x)
 
         # Split paths
         s = x.clone()
-        # Separation module
         x = self.ln(x)
         x = self.bottleneck(x)
-        x = self.sm(x)
+        return x, s
 
-        x = self.mask_net(x)
+    def decode(self, x, s, input_wav):
         x = x.view(x.shape[0], self.num_sources, self.enc_num_basis, -1)
         x = self.mask_nl_class(x)
         x = x * s.unsqueeze(1)
         # Back end
         estimated_waveforms = self.decoder(x.view(x.shape[0], -1, x.shape[-1]))
-        return self.remove_trailing_zeros(estimated_waveforms, input_wav)
+        return estimated_waveforms[..., :input_wav.shape[-1]]
+
+    def forward_early_exits(self, input_wav):
+        '''
+        Runs all the blocks and decodes the masks of every early exit head
+        as well as the final ones, for joint training of the heads.
+
+        :param input_wav: input mixture of size: batch x 1 x n_samples
+        :return: estimated sources of size:
+                 batch x (len(early_exit_blocks) + 1) x num_sources x
+                 n_samples, the last exit is the output of forward
+        '''
+        x, s = self.encode(input_wav)
+        estimated_waveforms = []
+        for n_blocks, block in enumerate(self.sm, 1):
+            x = self.run_block(n_blocks - 1, block, x)
+            if n_blocks in self.early_exit_blocks:
+                estimated_waveforms.append(self.decode(
+                    self.early_exit_heads[str(n_blocks)](x), s, input_wav))
+        estimated_waveforms.append(self.decode(self.mask_net(x), s,
+                                               input_wav))
+        return torch.stack(estimated_waveforms, 1)
+
+    @torch.no_grad()
+    def separate_early_exit(self, input_wav, max_blocks=None,
+                            deadline_ms=None):
+        '''
+        Separates with the deepest exit that the request budget allows,
+        so that one checkpoint trades quality for speed at request time.
+
+        With a deadline, the processing continues to the next exit only if
+        the time so far plus the blocks up to the next exit, at the mean
+        block time measured so far, fit in the deadline. The first exit is
+        always reached.
+
+        :param input_wav: input mixture of size: batch x 1 x n_samples
+        :param max_blocks: the maximum number of blocks to run
+        :param deadline_ms: the time budget of the call in milliseconds
+        :return: estimated sources of size: batch x num_sources x n_samples
+        '''
+        start = time.perf_counter()
+        exits = self.early_exit_blocks + [self.num_blocks]
+        if max_blocks is not None:
+            allowed_exits = [b for b in exits if b <= max_blocks]
+            if not allowed_exits:
+                raise ValueError('There is no exit within {} blocks, the '
+                                 'first one is after {} blocks.'.format(
+                                  max_blocks, exits[0]))
+            exits = allowed_exits
+
+        x, s = self.encode(input_wav)
+        n_blocks = 0
+        for next_exit in exits:
+            if deadline_ms is not None and n_blocks > 0:
+                elapsed_ms = 1000. * (time.perf_counter() - start)
+                block_ms = elapsed_ms / n_blocks
+                if elapsed_ms + block_ms * (
+                        next_exit - n_blocks) > deadline_ms:
+                    break
+            for block in self.sm[n_blocks:next_exit]:
+                x = block(x)
+            n_blocks = next_exit
+
+        if n_blocks == self.num_blocks:
+            return self.decode(self.mask_net(x), s, input_wav)
+        return self.decode(self.early_exit_heads[str(n_blocks)](x), s,
+                           input_wav)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        '''
+        Folds the gain and bias of the input GlobLN into the bottleneck 1x1
+        conv. The rest of the GlobLNs are followed by a PReLU or by a zero
+        padded depthwise conv and are left as they are since the folding
+        would not be exact.
+        '''
+        weight = self.bottleneck.weight
+        self.bottleneck.bias += weight[..., 0] @ self.ln.beta
+        weight *= self.ln.gamma.view(1, -1, 1)
+        self.ln.gamma.fill_(1.)
+        self.ln.beta.zero_()
+        return self
 
     def pad_to_appropriate_length(self, x):
-        values_to_pad = int(x.shape[-1]) % self.lcm
-        if values_to_pad:
-            appropriate_shape = x.shape
-            padded_x = torch.zeros(
-                list(appropriate_shape[:-1]) +
-                [appropriate_shape[-1] + self.lcm - values_to_pad],
-                dtype=torch.float32)
-            padded_x[..., :x.shape[-1]] = x
-            return padded_x.to(x.device)
-        return x
+        # The padding is computed from the traced length so that the same
+        # graph serves every input length after exporting.
+        values_to_pad = (self.lcm - x.shape[-1] % self.lcm) % self.lcm
+        return nn.functional.pad(x, (0, values_to_pad))
 
     @staticmethod
     def remove_trailing_zeros(padded_x, initial_x):
         return padded_x[..., :initial_x.shape[-1]]
 
+    @torch.no_grad()
+    def separate_long(self, wav, chunk_seconds=4., overlap_seconds=1.,
+                      fs=8000):
+        '''
+        Separates an arbitrarily long recording by running the model on
+        overlapping chunks and stitching the estimates with overlap-add.
+        Only one chunk is in flight at a time so the peak memory depends on
+        chunk_seconds and not on the length of the recording. The source
+        order of each chunk is aligned to the previous one by correlating
+        the estimates over their overlapping region.
+
+        With chunks of at least 4 sec and 1 sec overlap the stitched output
+        stays above 20 dB SI-SDR w.r.t. one-shot inference of the whole
+        recording.
+
+        :param wav: input mixture of size: batch_size x 1 x n_samples
+        :param chunk_seconds: length of each processed chunk in seconds
+        :param overlap_seconds: overlap between successive chunks in
+                                seconds, at most half of chunk_seconds so
+                                that only pairs of chunks overlap
+        :param fs: sampling rate of the input mixture
+        :return: estimated sources of size: batch x num_sources x n_samples
+        '''
+        chunk = int(chunk_seconds * fs)
+        overlap = int(overlap_seconds * fs)
+        if not 0 <= 2 * overlap <= chunk:
+            raise ValueError('Overlap: {} should be non-negative and at most '
+                             'half of the chunk size: {}.'.format(overlap,
+                                                                  chunk))
+        n_samples = wav.shape[-1]
+        if n_samples <= chunk:
+            return self(wav)
+
+        # The last chunk is shifted backwards in order to have full length
+        starts = list(range(0, n_samples - chunk, chunk - overlap))
+        # The shifted chunk would also overlap the chunk before the last
+        # one, so it replaces the last one instead
+        if len(starts) > 1 and n_samples - chunk - starts[-1] < overlap:
+            starts.pop()
+        starts.append(n_samples - chunk)
+
+        estimated_waveforms = wav.new_zeros(
+            wav.shape[0], self.num_sources, n_samples)
+        prev_tail = None
+        for i, start in enumerate(starts):
+            est = self(wav[..., start:start + chunk])
+            fade_in = 0 if i == 0 else starts[i - 1] + chunk - start
+            fade_out = 0 if i == len(starts) - 1 else (
+                start + chunk - starts[i + 1])
+
+            if fade_in:
+                est = self.align_sources(est, prev_tail, fade_in)
+            if fade_out:
+                prev_tail = est[..., -fade_out:].clone()
+            if fade_in:
+                ramp = torch.linspace(0., 1., fade_in + 2,
+                                      device=wav.device)[1:-1]
+                est[..., :fade_in] *= ramp
+            if fade_out:
+                ramp = torch.linspace(1., 0., fade_out + 2,
+                                      device=wav.device)[1:-1]
+                est[..., -fade_out:] *= ramp
+            estimated_waveforms[..., start:start + chunk] += est
+
+        return estimated_waveforms
+
+    @staticmethod
+    def align_sources(est, prev_tail, overlap):
+        '''
+        Permutes the sources of est so that its first overlap samples have
+        the maximum normalized correlation with prev_tail.
+
+        :param est: chunk estimates of size: batch x num_sources x n_samples
+        :param prev_tail: unwindowed tail of the previous chunk estimates of
+                          size: batch x num_sources x overlap
+        :param overlap: number of overlapping samples
+        :return: est with its source axis reordered
+        '''
+        n_sources = est.shape[1]
+        if n_sources < 2:
+            return est
+        head = est[..., :overlap]
+        head = head / (head.norm(dim=-1, keepdim=True) + 1e-8)
+        tail = prev_tail / (prev_tail.norm(dim=-1, keepdim=True) + 1e-8)
+        # corr[b, i, j]: correlation between new source i and old source j
+        corr = torch.einsum('bit,bjt->bij', head, tail)
+        perms = torch.tensor(
+            list(itertools.permutations(range(n_sources))),
+            device=est.device)
+        scores = corr[:, perms, torch.arange(n_sources)].sum(-1)
+        best_perms = perms[scores.argmax(-1)]
+        return est.gather(
+            1, best_perms.unsqueeze(-1).expand(-1, -1, est.shape[-1]))
+
 
 if __name__ == "__main__":
     model = SuDORMRF(out_channels=256,
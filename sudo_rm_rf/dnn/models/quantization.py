@@ -0,0 +1,130 @@
+"""!
+@brief Post-training int8 quantization of the improved SuDO-RM-RF model.
+
+Almost all the FLOPs are in the 1x1 convs (proj_1x1, res_conv, bottleneck,
+mask_net) and in the depthwise convs of the UConvBlocks, so only these run in
+int8. The GlobLNs need global statistics over channels and time and the
+PReLUs follow them, so both stay in floating point between a dequantize and
+a quantize.
+
+dynamic: the 1x1 convs run as int8 Linear layers which quantize their input
+on the fly, no calibration is needed.
+static: the 1x1 and the depthwise convs run as int8 Conv1d with input scales
+calibrated on a few hundred mixtures.
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import copy
+import torch
+import torch.nn as nn
+import torch.ao.quantization as quantization
+
+QUANTIZATION_MODES = ['dynamic', 'static']
+
+
+class PointwiseLinear(nn.Module):
+    '''
+    A 1x1 Conv1d applied as a Linear layer over the channels, since dynamic
+    quantization is only available for Linear layers.
+    '''
+
+    def __init__(self, conv):
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels,
+                                bias=conv.bias is not None)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight[..., 0])
+            if conv.bias is not None:
+                self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+class QuantizedConv(nn.Module):
+    '''
+    Quantizes the input of the wrapped conv with the calibrated scale and
+    dequantizes its output, so the modules around it stay in floating point.
+    '''
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = quantization.QuantStub()
+        self.conv = conv
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def get_quantizable_convs(model):
+    '''
+    :param model: improved_sudormrf.SuDORMRF
+    :return: list of (parent module, attribute name, conv) for the 1x1 and
+             the depthwise convs
+    '''
+    convs = [(model, 'bottleneck', model.bottleneck),
+             (model.mask_net, '1', model.mask_net[1])]
+    for block in model.sm:
+        convs.append((block.proj_1x1, 'conv', block.proj_1x1.conv))
+        convs += [(layer, 'conv', layer.conv) for layer in block.spp_dw]
+        convs.append((block, 'res_conv', block.res_conv))
+    return convs
+
+
+def copy_for_quantization(model):
+    model = copy.deepcopy(model).cpu().eval()
+    # The input GlobLN affine is folded before the bottleneck is quantized
+    model.fuse_for_inference()
+    return model
+
+
+def quantize_dynamic(model):
+    '''
+    :param model: improved_sudormrf.SuDORMRF, it is not modified
+    :return: a copy of the model with dynamically quantized 1x1 convs
+    '''
+    model = copy_for_quantization(model)
+    for parent, name, conv in get_quantizable_convs(model):
+        if conv.kernel_size[0] == 1 and conv.groups == 1:
+            setattr(parent, name, PointwiseLinear(conv))
+    return quantization.quantize_dynamic(model, {nn.Linear},
+                                         dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_mixtures, backend='fbgemm'):
+    '''
+    :param model: improved_sudormrf.SuDORMRF, it is not modified
+    :param calibration_mixtures: iterable of normalized mixtures of size:
+                                 batch x 1 x n_samples
+    :param backend: the quantized engine, fbgemm for x86 and qnnpack for arm
+    :return: a copy of the model with statically quantized 1x1 and
+             depthwise convs
+    '''
+    torch.backends.quantized.engine = backend
+    model = copy_for_quantization(model)
+    qconfig = quantization.get_default_qconfig(backend)
+    for parent, name, conv in get_quantizable_convs(model):
+        wrapper = QuantizedConv(conv)
+        wrapper.qconfig = qconfig
+        setattr(parent, name, wrapper)
+
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for mixture in calibration_mixtures:
+            model(mixture)
+    return quantization.convert(model, inplace=True)
+
+
+def quantize(model, mode, calibration_mixtures=None, backend='fbgemm'):
+    if mode == 'dynamic':
+        return quantize_dynamic(model)
+    elif mode == 'static':
+        if calibration_mixtures is None:
+            raise ValueError('Static quantization needs calibration '
+                             'mixtures.')
+        return quantize_static(model, calibration_mixtures, backend=backend)
+    raise NotImplementedError(
+        'Quantization mode: {} is not yet available.'.format(mode))
@@ -0,0 +1,221 @@
+"""!
+@brief Reversible SuDO-RM-RF model. The UConvBlocks are used in reversible
+additive couplings (RevNet), so the input of every block is reconstructed
+from its output in the backward pass instead of being stored and the
+activation memory of the separation module does not grow with num_blocks.
+
+E.g.: python -m sudo_rm_rf.dnn.models.reversible_sudormrf
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+import torch.nn as nn
+try:
+    from . import improved_sudormrf
+except ImportError:
+    # When this file is run as a script
+    import improved_sudormrf
+
+
+class UConvBranch(improved_sudormrf.UConvBlock):
+    '''
+    The UConvBlock without its residual connection, which is replaced by
+    the additive coupling.
+    '''
+
+    def forward(self, x):
+        output = []
+        out_k = self.proj_1x1(x)
+        for layer in self.spp_dw:
+            out_k = layer(out_k)
+            output.append(out_k)
+
+        for _ in range(self.depth-1):
+            resampled_out_k = self.upsampler(output.pop(-1))
+            output[-1] = output[-1] + resampled_out_k
+
+        return self.res_conv(self.final_norm(output[-1]))
+
+
+class ReversibleUConvBlock(nn.Module):
+    '''
+    Splits the channels in two halves x1, x2 and computes:
+        y1 = x1 + F(x2)
+        y2 = x2 + G(y1)
+    where F and G are UConvBranches with half of the channels of the
+    corresponding UConvBlock, so the FLOPs per block stay about the same.
+    '''
+
+    def __init__(self,
+                 out_channels=128,
+                 in_channels=512,
+                 upsampling_depth=4):
+        super().__init__()
+        if out_channels % 2 or in_channels % 2:
+            raise ValueError('The reversible block needs an even number of '
+                             'channels, got: {} and {}.'.format(
+                              out_channels, in_channels))
+        self.f = UConvBranch(out_channels=out_channels // 2,
+                             in_channels=in_channels // 2,
+                             upsampling_depth=upsampling_depth)
+        self.g = UConvBranch(out_channels=out_channels // 2,
+                             in_channels=in_channels // 2,
+                             upsampling_depth=upsampling_depth)
+
+    def forward(self, x):
+        x1, x2 = torch.chunk(x, 2, dim=1)
+        y1 = x1 + self.f(x2)
+        y2 = x2 + self.g(y1)
+        return torch.cat([y1, y2], dim=1)
+
+    def inverse(self, y):
+        y1, y2 = torch.chunk(y, 2, dim=1)
+        x2 = y2 - self.g(y1)
+        x1 = y1 - self.f(x2)
+        return torch.cat([x1, x2], dim=1)
+
+    def backward_pass(self, y, dy):
+        '''
+        Reconstructs the input of the block from its output and
+        backpropagates the output gradient through the block.
+
+        :param y: output of the block
+        :param dy: gradient of the loss w.r.t. y
+        :return: the input of the block, the gradient w.r.t. it and the
+                 gradients w.r.t. the parameters of the block
+        '''
+        y1, y2 = torch.chunk(y, 2, dim=1)
+        dy1, dy2 = torch.chunk(dy, 2, dim=1)
+        f_params = list(self.f.parameters())
+        g_params = list(self.g.parameters())
+
+        with torch.enable_grad():
+            y1 = y1.detach().requires_grad_()
+            g_y1 = self.g(y1)
+            grads = torch.autograd.grad(g_y1, [y1] + g_params, dy2,
+                                        allow_unused=True)
+        # y1 gets the gradient of the loss from both y1 and y2
+        dy1 = dy1 + grads[0]
+        g_grads = grads[1:]
+
+        with torch.no_grad():
+            x2 = y2 - g_y1
+        with torch.enable_grad():
+            x2 = x2.detach().requires_grad_()
+            f_x2 = self.f(x2)
+            grads = torch.autograd.grad(f_x2, [x2] + f_params, dy1,
+                                        allow_unused=True)
+        dx2 = dy2 + grads[0]
+        f_grads = grads[1:]
+
+        with torch.no_grad():
+            x1 = y1 - f_x2
+        return (torch.cat([x1, x2.detach()], dim=1),
+                torch.cat([dy1, dx2], dim=1),
+                f_grads + g_grads)
+
+
+class ReversibleSequenceFunction(torch.autograd.Function):
+    '''
+    Runs the reversible blocks without building the graph and only keeps
+    the output of the last block for the backward pass.
+    '''
+
+    @staticmethod
+    def forward(ctx, x, blocks, *params):
+        ctx.blocks = blocks
+        with torch.no_grad():
+            for block in blocks:
+                x = block(x)
+        ctx.save_for_backward(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, dy):
+        y, = ctx.saved_tensors
+        params_grads = []
+        for block in reversed(ctx.blocks):
+            y, dy, block_params_grads = block.backward_pass(y, dy)
+            params_grads = list(block_params_grads) + params_grads
+        return (dy, None) + tuple(params_grads)
+
+
+class ReversibleSequence(nn.Module):
+    def __init__(self, blocks):
+        super().__init__()
+        self.blocks = nn.ModuleList(blocks)
+
+    def forward(self, x):
+        if not torch.jit.is_scripting():
+            if self.training and torch.is_grad_enabled():
+                # The parameters are inputs of the function so that their
+                # gradients are returned by its backward
+                params = [p for block in self.blocks
+                          for p in list(block.f.parameters()) +
+                          list(block.g.parameters())]
+                return ReversibleSequenceFunction.apply(x, self.blocks,
+                                                        *params)
+        for block in self.blocks:
+            x = block(x)
+        return x
+
+
+class ReversibleSuDORMRF(improved_sudormrf.SuDORMRF):
+    '''
+    The improved SuDO-RM-RF with its separation module made of reversible
+    UConvBlocks. Same front end, mask estimation and back end.
+    '''
+
+    def __init__(self,
+                 out_channels=128,
+                 in_channels=512,
+                 num_blocks=16,
+                 upsampling_depth=4,
+                 enc_kernel_size=21,
+                 enc_num_basis=512,
+                 num_sources=2):
+        super(ReversibleSuDORMRF, self).__init__(
+            out_channels=out_channels,
+            in_channels=in_channels,
+            num_blocks=num_blocks,
+            upsampling_depth=upsampling_depth,
+            enc_kernel_size=enc_kernel_size,
+            enc_num_basis=enc_num_basis,
+            num_sources=num_sources)
+        self.sm = ReversibleSequence([
+            ReversibleUConvBlock(out_channels=out_channels,
+                                 in_channels=in_channels,
+                                 upsampling_depth=upsampling_depth)
+            for _ in range(num_blocks)])
+
+    def set_checkpointing(self, every_k_blocks=0, highest_res_levels=0):
+        raise NotImplementedError('The reversible blocks do not store their '
+                                  'activations, checkpointing is not '
+                                  'needed.')
+
+    def forward_early_exits(self, input_wav):
+        raise NotImplementedError('The reversible blocks run as a single '
+                                  'autograd function and have no early '
+                                  'exits.')
+
+    def separate_early_exit(self, input_wav, max_blocks=None,
+                            deadline_ms=None):
+        raise NotImplementedError('The reversible blocks run as a single '
+                                  'autograd function and have no early '
+                                  'exits.')
+
+
+if __name__ == "__main__":
+    model = ReversibleSuDORMRF(out_channels=256,
+                               in_channels=512,
+                               num_blocks=16,
+                               upsampling_depth=5,
+                               enc_kernel_size=21,
+                               enc_num_basis=512,
+                               num_sources=2)
+
+    dummy_input = torch.rand(3, 1, 32079)
+    estimated_sources = model(dummy_input)
+    print(estimated_sources.shape)
@@ -19,8 +19,19 @@ import torch.nn as nn
 import torch.nn.functional as F
 import copy
 from torch.nn.modules.linear import Linear
+try:
+    from . import dual_path_chunking
+    from . import efficient_attention
+except ImportError:
+    # When this file is run as a script
+    import dual_path_chunking
+    import efficient_attention
 
 EPS = 1e-8
+# torch: nn.MultiheadAttention which materializes the attention matrices,
+# sdpa: F.scaled_dot_product_attention with the same weights, which uses the
+# memory-efficient (or flash) kernels when they are available
+ATTENTION_BACKENDS = ["torch", "sdpa"]
 
 
 class PositionalEncoding(nn.Module):
@@ -93,8 +104,17 @@ class MultiheadAttention(nn.Module):
     >>> outputs, attn = net(inputs, inputs, inputs)
     >>> outputs.shape
     torch.Size([8, 60, 512])
+
+    With backend = "sdpa" the same weights are used by
+    F.scaled_dot_product_attention, no attention weights are returned and
+    with a window_size the attention is windowed (see
+    efficient_attention.windowed_attention).
     """
 
+    # Class attributes so that the pickled models get the defaults
+    backend = "torch"
+    window_size = None
+
     def __init__(
         self,
         nhead,
@@ -170,6 +190,19 @@ class MultiheadAttention(nn.Module):
             (B, L, S) where B is the batch size, L is the target
             sequence length, S is the source sequence length.
         """
+        if (
+            self.backend == "sdpa"
+            and attn_mask is None
+            and key_padding_mask is None
+            and pos_embs is None
+            and self.att.bias_k is None
+            and not self.att.add_zero_attn
+        ):
+            output = self._sdpa_forward(query, key, value)
+            if return_attn_weights:
+                return output, None
+            return output
+
         # give tensors of shape (time, batch, fea)
         query = query.permute(1, 0, 2)
         key = key.permute(1, 0, 2)
@@ -201,6 +234,13 @@ class MultiheadAttention(nn.Module):
             output = output.permute(1, 0, 2)
             return output
 
+    def _sdpa_forward(self, query, key, value):
+        """Same output as self.att for (batch, time, fea) inputs without
+        materializing the attention matrices."""
+        return efficient_attention.multihead_attention(
+            self.att, query, key, value, window_size=self.window_size
+        )
+
 
 class PositionalwiseFeedForward(nn.Module):
     """The class implements the positional-wise feed forward module in
@@ -1568,33 +1608,6 @@ class Dual_Path_Model(nn.Module):
         return x
 
 
-    def _padding(self, input, K):
-        """Padding the audio times.
-
-        Arguments
-        ---------
-        K : int
-            Chunks of length.
-        P : int
-            Hop size.
-        input : torch.Tensor
-            Tensor of size [B, N, L].
-            where, B = Batchsize,
-                   N = number of filters
-                   L = time points
-        """
-        B, N, L = input.shape
-        P = K // 2
-        gap = K - (P + L % K) % K
-        if gap > 0:
-            pad = torch.Tensor(torch.zeros(B, N, gap)).type(input.type())
-            input = torch.cat([input, pad], dim=2)
-
-        _pad = torch.Tensor(torch.zeros(B, N, P)).type(input.type())
-        input = torch.cat([_pad, input, _pad], dim=2)
-
-        return input, gap
-
     def _Segmentation(self, input, K):
         """The segmentation stage splits
 
@@ -1615,17 +1628,8 @@ class Dual_Path_Model(nn.Module):
                S = the number of chunks
                L = the number of time points
         """
-        B, N, L = input.shape
-        P = K // 2
-        input, gap = self._padding(input, K)
-        # [B, N, K, S]
-        input1 = input[:, :, :-P].contiguous().view(B, N, -1, K)
-        input2 = input[:, :, P:].contiguous().view(B, N, -1, K)
-        input = (
-            torch.cat([input1, input2], dim=3).view(B, N, -1, K).transpose(2, 3)
-        )
-
-        return input.contiguous(), gap
+        # [B, N, K, S] strided view of the padded input
+        return dual_path_chunking.split_chunks(input, K)
 
     def _over_add(self, input, gap):
         """Merge the sequence with the overlap-and-add method.
@@ -1648,20 +1652,7 @@ class Dual_Path_Model(nn.Module):
                L = the number of time points
 
         """
-        B, N, K, S = input.shape
-        P = K // 2
-        # [B, N, S, K]
-        input = input.transpose(2, 3).contiguous().view(B, N, -1, K * 2)
-
-        input1 = input[:, :, :, :K].contiguous().view(B, N, -1)[:, :, P:]
-        input2 = input[:, :, :, K:].contiguous().view(B, N, -1)[:, :, :-P]
-        input = input1 + input2
-        # [B, N, L]
-        if gap > 0:
-            input = input[:, :, :-gap]
-
-        return input
-
+        return dual_path_chunking.merge_chunks(input, gap)
 
 
 class SepformerWrapper(nn.Module):
@@ -1713,6 +1704,11 @@ class SepformerWrapper(nn.Module):
         Whether or not we use normalization before the transformations in the intra block
     inter_norm_before: bool
         Whether or not we use normalization before the transformations in the inter block
+    attention_backend: str,
+        One of ATTENTION_BACKENDS, see set_attention_backend
+    inter_attention_window: int,
+        If set, the inter block uses windowed attention with this window
+        (in chunks), see set_attention_backend
 
     Example
     -----
@@ -1744,6 +1740,8 @@ class SepformerWrapper(nn.Module):
         inter_use_positional=True,
         intra_norm_before=True,
         inter_norm_before=True,
+        attention_backend="torch",
+        inter_attention_window=None,
     ):
 
         super(SepformerWrapper, self).__init__()
@@ -1795,6 +1793,46 @@ class SepformerWrapper(nn.Module):
         for module in [self.encoder, self.masknet, self.decoder]:
             self.reset_layer_recursively(module)
 
+        self.set_attention_backend(
+            attention_backend, inter_window_size=inter_attention_window
+        )
+
+    def set_attention_backend(self, backend="sdpa", inter_window_size=None):
+        """Selects the attention implementation of all the intra and inter
+        blocks. The weights are the same for all the backends, so it can
+        also be changed on a trained or a loaded model.
+
+        Arguments
+        ---------
+        backend : str
+            "torch" for nn.MultiheadAttention, or "sdpa" for
+            F.scaled_dot_product_attention, which does not materialize the
+            attention matrices when the memory-efficient or flash kernels
+            are available.
+        inter_window_size : int
+            If set (only with "sdpa"), the inter blocks attend only to the
+            chunks of the neighbouring windows of this size, so their memory
+            grows linearly with the length of the input. This approximates
+            the full attention for long inputs.
+        """
+        if backend not in ATTENTION_BACKENDS:
+            raise ValueError(
+                "Attention backend: {} is not one of: {}".format(
+                    backend, ATTENTION_BACKENDS
+                )
+            )
+        if inter_window_size is not None and backend != "sdpa":
+            raise ValueError("Windowed attention requires the sdpa backend")
+        for block in self.masknet.dual_mdl:
+            for mdl, window_size in [
+                (block.intra_mdl, None),
+                (block.inter_mdl, inter_window_size),
+            ]:
+                for module in mdl.modules():
+                    if isinstance(module, MultiheadAttention):
+                        module.backend = backend
+                        module.window_size = window_size
+
     def reset_layer_recursively(self, layer):
         """Reinitializes the parameters of the network"""
         if hasattr(layer, "reset_parameters"):
@@ -148,11 +148,10 @@ class UBlock(nn.Module):
                                                kSize=2*stride + 1,
                                                stride=stride,
                                                groups=in_channels, d=1))
-        if upsampling_depth > 1:
-            self.upsampler = torch.nn.Upsample(scale_factor=2,
-                                               # align_corners=True,
-                                               # mode='bicubic'
-                                               )
+        self.upsampler = torch.nn.Upsample(scale_factor=2,
+                                           # align_corners=True,
+                                           # mode='bicubic'
+                                           )
         self.conv_1x1_exp = ConvNorm(in_channels, out_channels, 1, 1, groups=1)
         self.final_norm = NormAct(in_channels)
         self.module_act = NormAct(out_channels)
@@ -165,11 +164,12 @@ class UBlock(nn.Module):
 
         # Reduce --> project high-dimensional feature maps to low-dimensional space
         output1 = self.proj_1x1(x)
-        output = [self.spp_dw[0](output1)]
+        output = []
+        out_k = output1
 
         # Do the downsampling process from the previous level
-        for k in range(1, self.depth):
-            out_k = self.spp_dw[k](output[-1])
+        for layer in self.spp_dw:
+            out_k = layer(out_k)
             output.append(out_k)
 
         # Gather them now in reverse order
@@ -234,6 +234,9 @@ class SuDORMRF(nn.Module):
             self.reshape_before_masks = nn.Conv1d(in_channels=out_channels,
                                                   out_channels=enc_num_basis,
                                                   kernel_size=1)
+        else:
+            # TorchScript compiles both branches of the forward pass
+            self.reshape_before_masks = nn.Identity()
 
         # Masks layer
         self.m = nn.Conv2d(in_channels=1,
@@ -278,19 +281,13 @@ class SuDORMRF(nn.Module):
         x = x * s.unsqueeze(1)
         # Back end
         estimated_waveforms = self.decoder(x.view(x.shape[0], -1, x.shape[-1]))
-        return self.remove_trailing_zeros(estimated_waveforms, input_wav)
+        return estimated_waveforms[..., :input_wav.shape[-1]]
 
     def pad_to_appropriate_length(self, x):
-        values_to_pad = int(x.shape[-1]) % self.lcm
-        if values_to_pad:
-            appropriate_shape = x.shape
-            padded_x = torch.zeros(
-                list(appropriate_shape[:-1]) +
-                [appropriate_shape[-1] + self.lcm - values_to_pad],
-                dtype=torch.float32)
-            padded_x[..., :x.shape[-1]] = x
-            return padded_x
-        return x
+        # The padding is computed from the traced length so that the same
+        # graph serves every input length after exporting.
+        values_to_pad = (self.lcm - x.shape[-1] % self.lcm) % self.lcm
+        return nn.functional.pad(x, (0, values_to_pad))
 
     @staticmethod
     def remove_trailing_zeros(padded_x, initial_x):
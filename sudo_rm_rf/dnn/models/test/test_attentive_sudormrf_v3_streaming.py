@@ -0,0 +1,103 @@
+"""!
+@brief Testing the streaming attention layers of the attentive SuDO-RM-RF v3
+against the full context attention on the frames which the cache covers
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import math
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.attentive_sudormrf_v3 as attentive_sudormrf_v3
+
+
+def full_context_attention(mha, Q, K, V, cache_size):
+    # Query i attends to the last cache_size keys up to the key i // ratio
+    bs, q_len, _ = Q.shape
+    kv_len = K.shape[1]
+    ratio = q_len // kv_len
+    Q = mha.Q_proj(Q).view(bs, q_len, mha.n_heads, -1).transpose(1, 2)
+    K = mha.K_proj(K).view(bs, kv_len, mha.n_heads, -1).transpose(1, 2)
+    V = mha.V_proj(V).view(bs, kv_len, mha.n_heads, -1).transpose(1, 2)
+    mask = torch.zeros(q_len, kv_len, dtype=torch.bool)
+    for i in range(q_len):
+        last = i // ratio
+        mask[i, max(last - cache_size + 1, 0):last + 1] = True
+    QK = Q @ K.transpose(-1, -2) / math.sqrt(Q.shape[-1])
+    A = torch.softmax(QK.masked_fill(~mask, float('-inf')), dim=-1)
+    V = (A @ V).transpose(1, 2)
+    return mha.O_proj(V.reshape(bs, q_len, -1))
+
+
+def split(x, chunk_lens, dim=-1):
+    return torch.split(x, chunk_lens, dim=dim)
+
+
+def test_mha_step_matches_full_context(cache_size=10):
+    torch.manual_seed(0)
+    mha = attentive_sudormrf_v3.MHAttentionLayer(16, 8, 2).eval()
+    chunk_lens = [1, 7, 12, 40]
+    for ratio in [1, 2]:
+        kv = torch.randn(2, sum(chunk_lens), 16)
+        q = torch.randn(2, ratio * sum(chunk_lens), 16)
+        state = mha.init_state(cache_size)
+        with torch.no_grad():
+            streamed = torch.cat([
+                mha.step(q_chunk, kv_chunk, kv_chunk, state)
+                for q_chunk, kv_chunk in zip(
+                    split(q, [ratio * l for l in chunk_lens], dim=1),
+                    split(kv, chunk_lens, dim=1))], dim=1)
+            full = full_context_attention(mha, q, kv, kv, cache_size)
+        assert torch.allclose(streamed, full, atol=1e-5)
+        # Only the cache is kept from the previous chunks
+        assert state['keys'].shape[2] == cache_size
+
+
+def test_transformer_layer_step(cache_size=16):
+    torch.manual_seed(0)
+    layer = attentive_sudormrf_v3.TransformerLayer(16, 8, 2).eval()
+    x = torch.randn(2, 16, 60)
+    chunk_lens = [12] * 5
+    state = layer.init_state(cache_size)
+    with torch.no_grad():
+        streamed = [layer.step(chunk, state)
+                    for chunk in split(x, chunk_lens)]
+        x_enc = layer.pos_enc(x.transpose(1, 2))
+        attended = x_enc + full_context_attention(
+            layer.mha, x_enc, x_enc, x_enc, cache_size)
+        for out, h in zip(streamed, split(attended, chunk_lens, dim=1)):
+            h = layer.out_mha_norm(h.transpose(1, 2))
+            assert torch.allclose(out, layer.out_norm(layer.ffn(h) + h),
+                                  atol=1e-5)
+
+
+def test_conditional_transformer_layer_step(cache_size=16):
+    torch.manual_seed(0)
+    layer = attentive_sudormrf_v3.ConditionalTransformerLayer(
+        16, 8, 2).eval()
+    q = torch.randn(2, 16, 120)
+    v = torch.randn(2, 16, 60)
+    chunk_lens = [12] * 5
+    state = layer.init_state(cache_size)
+    with torch.no_grad():
+        streamed = [layer.step(q_chunk, v_chunk, state)
+                    for q_chunk, v_chunk in zip(
+                        split(q, [2 * l for l in chunk_lens]),
+                        split(v, chunk_lens))]
+        v_enc = layer.pos_enc(v.transpose(1, 2))
+        attended = q.transpose(1, 2) + full_context_attention(
+            layer.mha, q.transpose(1, 2), v_enc, v_enc, cache_size)
+        for out, h in zip(streamed,
+                          split(attended, [2 * l for l in chunk_lens],
+                                dim=1)):
+            h = layer.out_mha_norm(h.transpose(1, 2))
+            assert torch.allclose(out, layer.out_norm(layer.ffn(h) + h),
+                                  atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_mha_step_matches_full_context()
+    test_transformer_layer_step()
+    test_conditional_transformer_layer_step()
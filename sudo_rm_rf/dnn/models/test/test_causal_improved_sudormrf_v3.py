@@ -0,0 +1,71 @@
+"""!
+@brief Testing the streaming mode of the causal SuDO-RM-RF model against the
+offline forward pass
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.causal_improved_sudormrf_v3 as causal_sudormrf
+
+
+def create_model(in_audio_channels=2, upsampling_depth=4):
+    torch.manual_seed(0)
+    model = causal_sudormrf.CausalSuDORMRF(
+        in_audio_channels=in_audio_channels,
+        out_channels=16,
+        in_channels=32,
+        num_blocks=3,
+        upsampling_depth=upsampling_depth,
+        enc_kernel_size=21,
+        enc_num_basis=24,
+        num_sources=2).eval()
+    # The blocks are initialized to identity mappings
+    for block in model.sm:
+        torch.nn.init.normal_(block.skipinit_gain)
+    return model
+
+
+def stream(model, mixture, batch_size):
+    hop = model.enc_kernel_size // 2
+    state = model.init_state(batch_size)
+    with torch.no_grad():
+        frames = [model.step(mixture[..., i:i + hop], state)
+                  for i in range(0, mixture.shape[-1], hop)]
+    # The streaming output is delayed by one hop
+    return torch.cat(frames, -1)[..., hop:]
+
+
+def test_streaming_matches_offline(batch_size=2,
+                                   in_audio_channels=2,
+                                   n_frames=160):
+    for upsampling_depth in [1, 4, 5]:
+        model = create_model(in_audio_channels=in_audio_channels,
+                             upsampling_depth=upsampling_depth)
+        hop = model.enc_kernel_size // 2
+        mixture = torch.randn(batch_size, in_audio_channels, hop * n_frames)
+        with torch.no_grad():
+            offline = model(mixture)
+        streamed = stream(model, mixture, batch_size)
+        assert streamed.shape == offline[..., :-hop].shape
+        # Equal up to the float round-off of the different conv algorithms
+        assert torch.allclose(streamed, offline[..., :-hop],
+                              rtol=0., atol=1e-6)
+
+
+def test_offline_skips_future_taps():
+    model = create_model()
+    conv = model.sm[0].spp_dw[1].conv
+    x = torch.randn(2, conv.in_channels, 64)
+    masked = torch.nn.functional.conv1d(
+        x, conv.get_weight(), conv.bias, conv.stride, conv.padding,
+        conv.dilation, conv.groups)
+    assert torch.allclose(conv(x), masked, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_streaming_matches_offline()
+    test_offline_skips_future_taps()
@@ -0,0 +1,97 @@
+"""!
+@brief Testing the strided chunking and the overlap-and-add of the dual-path
+models against the concatenation based implementation which they replaced
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import math
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.dual_path_chunking as dual_path_chunking
+
+
+def reference_split_chunks(x, K):
+    B, N, L = x.shape
+    P = K // 2
+    gap = K - (P + L % K) % K
+    x = torch.cat([x, torch.zeros(B, N, gap)], dim=2)
+    x = torch.cat([torch.zeros(B, N, P), x, torch.zeros(B, N, P)], dim=2)
+    x1 = x[:, :, :-P].contiguous().view(B, N, -1, K)
+    x2 = x[:, :, P:].contiguous().view(B, N, -1, K)
+    x = torch.cat([x1, x2], dim=3).view(B, N, -1, K).transpose(2, 3)
+    return x.contiguous(), gap
+
+
+def reference_merge_chunks(x, gap):
+    B, N, K, S = x.shape
+    P = K // 2
+    x = x.transpose(2, 3).contiguous().view(B, N, -1, K * 2)
+    x1 = x[:, :, :, :K].contiguous().view(B, N, -1)[:, :, P:]
+    x2 = x[:, :, :, K:].contiguous().view(B, N, -1)[:, :, :-P]
+    return (x1 + x2)[:, :, :-gap]
+
+
+def reference_overlap_and_add(signal, frame_step):
+    outer_dimensions = signal.size()[:-2]
+    frames, frame_length = signal.size()[-2:]
+    subframe_length = math.gcd(frame_length, frame_step)
+    subframe_step = frame_step // subframe_length
+    subframes_per_frame = frame_length // subframe_length
+    output_size = frame_step * (frames - 1) + frame_length
+    output_subframes = output_size // subframe_length
+    subframe_signal = signal.reshape(*outer_dimensions, -1, subframe_length)
+    frame = torch.arange(0, output_subframes).unfold(
+        0, subframes_per_frame, subframe_step).contiguous().view(-1)
+    result = signal.new_zeros(*outer_dimensions, output_subframes,
+                              subframe_length)
+    result.index_add_(-2, frame, subframe_signal)
+    return result.view(*outer_dimensions, -1)
+
+
+def test_split_chunks_matches_reference():
+    for K in [4, 100, 250]:
+        for L in [1, 99, 100, 1001, 4000]:
+            x = torch.randn(2, 3, L)
+            chunks, gap = dual_path_chunking.split_chunks(x, K)
+            ref_chunks, ref_gap = reference_split_chunks(x, K)
+            assert gap == ref_gap
+            assert torch.equal(chunks, ref_chunks)
+
+
+def test_merge_chunks_matches_reference():
+    for K in [4, 100, 250]:
+        for L in [1, 99, 1001, 4000]:
+            chunks, gap = reference_split_chunks(torch.randn(2, 3, L), K)
+            chunks = torch.randn_like(chunks)
+            merged = dual_path_chunking.merge_chunks(chunks, gap)
+            assert merged.shape == (2, 3, L)
+            assert torch.allclose(merged,
+                                  reference_merge_chunks(chunks, gap),
+                                  atol=1e-6)
+
+
+def test_merge_of_split_doubles_the_input():
+    x = torch.randn(2, 3, 1001, requires_grad=True)
+    chunks, gap = dual_path_chunking.split_chunks(x, 100)
+    merged = dual_path_chunking.merge_chunks(chunks, gap)
+    assert torch.allclose(merged, 2 * x, atol=1e-6)
+    merged.sum().backward()
+    assert torch.allclose(x.grad, 2 * torch.ones_like(x))
+
+
+def test_overlap_and_add_matches_reference():
+    for frame_length, frame_step in [(2, 1), (16, 8), (21, 10), (8, 8)]:
+        signal = torch.randn(2, 3, 50, frame_length)
+        assert torch.allclose(
+            dual_path_chunking.overlap_and_add(signal, frame_step),
+            reference_overlap_and_add(signal, frame_step), atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_split_chunks_matches_reference()
+    test_merge_chunks_matches_reference()
+    test_merge_of_split_doubles_the_input()
+    test_overlap_and_add_matches_reference()
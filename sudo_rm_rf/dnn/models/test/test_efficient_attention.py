@@ -0,0 +1,107 @@
+"""!
+@brief Testing the attention helpers of the attentive SuDO-RM-RF models
+against the fixed length encodings and the full attention which they
+replaced, and the attentive models on inputs longer than the old encodings
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import math
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.efficient_attention as efficient_attention
+import dnn.models.attentive_sudormrf as attentive_sudormrf
+import dnn.models.attentive_sudormrf_v2 as attentive_sudormrf_v2
+import dnn.models.attentive_sudormrf_v3 as attentive_sudormrf_v3
+
+
+def reference_encoding(max_len, d_model):
+    pe = torch.zeros(max_len, d_model)
+    position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
+    div_term = torch.exp(
+        torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
+    pe[:, 0::2] = torch.sin(position * div_term)
+    pe[:, 1::2] = torch.cos(position * div_term)
+    return pe
+
+
+def reference_attention(Q, K, V, local_mask=None):
+    # batch_size x n_heads x seq_len x d_model as in the einsum version
+    QK = Q @ K.transpose(-1, -2) / math.sqrt(Q.shape[-1])
+    if local_mask is not None:
+        QK = QK.masked_fill(~local_mask, float('-inf'))
+    return torch.softmax(QK, dim=-1) @ V
+
+
+def test_sinusoidal_encoding():
+    for length in [1, 100, 3200, 7000]:
+        assert torch.allclose(
+            efficient_attention.sinusoidal_encoding(length, 32),
+            reference_encoding(length, 32), atol=1e-6)
+
+
+def test_positional_encoding_loads_old_checkpoints():
+    pos_enc = efficient_attention.PositionalEncoding(32, dropout=0.)
+    pos_enc.load_state_dict({'pe': reference_encoding(3200, 32)[None]})
+    x = torch.randn(2, 6000, 32)
+    assert torch.allclose(pos_enc(x), x + reference_encoding(6000, 32),
+                          atol=1e-6)
+
+
+def test_windowed_attention():
+    window_size = 5
+    for q_len, kv_len in [(37, 37), (74, 37), (40, 20)]:
+        q = torch.randn(2, 4, q_len, 8)
+        k, v = torch.randn(2, 2, 4, kv_len, 8).unbind(0)
+        full = reference_attention(q, k, v)
+        assert torch.allclose(
+            efficient_attention.windowed_attention(q, k, v, kv_len), full,
+            atol=1e-5)
+        # The queries of each block attend to the keys of the same and of
+        # the two neighbouring blocks
+        q_block = torch.arange(q_len) // (q_len // kv_len * window_size)
+        k_block = torch.arange(kv_len) // window_size
+        mask = (q_block.unsqueeze(1) - k_block.unsqueeze(0)).abs() <= 1
+        assert torch.allclose(
+            efficient_attention.windowed_attention(q, k, v, window_size),
+            reference_attention(q, k, v, local_mask=mask), atol=1e-5)
+
+
+def test_multihead_attention():
+    torch.manual_seed(0)
+    mha = torch.nn.MultiheadAttention(16, 4, batch_first=True).eval()
+    x = torch.randn(2, 50, 16)
+    y = torch.randn(2, 30, 16)
+    for query, key in [(x, x), (x, y)]:
+        assert torch.allclose(
+            efficient_attention.multihead_attention(mha, query, key, key),
+            mha(query, key, key)[0], atol=1e-5)
+
+
+def test_attentive_models_on_long_inputs():
+    # 13 secs at 8kHz are 10400 encoded frames and the attention layers
+    # attend over 5200 of them, more than the old encodings (5000)
+    x = torch.randn(1, 1, 104000)
+    for module in [attentive_sudormrf, attentive_sudormrf_v2,
+                   attentive_sudormrf_v3]:
+        for att_window_size in [None, 64]:
+            torch.manual_seed(0)
+            model = module.SuDORMRF(
+                out_channels=16, in_channels=32, num_blocks=1,
+                upsampling_depth=2, enc_kernel_size=21, enc_num_basis=32,
+                n_heads=2, att_dims=16, att_dropout=0.,
+                num_sources=2, att_window_size=att_window_size).eval()
+            with torch.no_grad():
+                estimates = model(x)
+            assert estimates.shape == (1, 2, 104000)
+            assert torch.isfinite(estimates).all()
+
+
+if __name__ == "__main__":
+    test_sinusoidal_encoding()
+    test_positional_encoding_loads_old_checkpoints()
+    test_windowed_attention()
+    test_multihead_attention()
+    test_attentive_models_on_long_inputs()
@@ -0,0 +1,84 @@
+"""!
+@brief Testing the numerical parity of the exported SuDO-RM-RF models with
+eager mode for lengths different than the traced one
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import os
+import tempfile
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.export as export
+import dnn.models.improved_sudormrf as improved_sudormrf
+import dnn.models.sudormrf as sudormrf
+import dnn.models.causal_improved_sudormrf_v3 as causal_sudormrf
+import dnn.models.groupcomm_sudormrf_v2 as sudormrf_gc_v2
+
+
+def create_models():
+    torch.manual_seed(0)
+    small_kwargs = dict(out_channels=16, in_channels=32, num_blocks=2,
+                        upsampling_depth=3, enc_kernel_size=21,
+                        enc_num_basis=32, num_sources=2)
+    models = {
+        'improved': improved_sudormrf.SuDORMRF(**small_kwargs),
+        'sudormrf': sudormrf.SuDORMRF(**small_kwargs),
+        'causal': causal_sudormrf.CausalSuDORMRF(in_audio_channels=2,
+                                                 **small_kwargs),
+        'groupcomm': sudormrf_gc_v2.GroupCommSudoRmRf(group_size=4,
+                                                      **small_kwargs)}
+    for block in models['causal'].sm:
+        torch.nn.init.normal_(block.skipinit_gain)
+    return {name: model.eval() for name, model in models.items()}
+
+
+def check_parity(model, separator, atol=1e-4):
+    for batch_size, n_samples in [(1, 8000), (2, 12345), (3, 160)]:
+        mixture = export.get_example_input(model, batch_size=batch_size,
+                                           n_samples=n_samples)
+        with torch.no_grad():
+            eager_sources = model(mixture)
+        exported_sources = separator.separate(mixture)
+        assert exported_sources.shape == eager_sources.shape
+        assert torch.allclose(exported_sources, eager_sources, atol=atol)
+
+
+def test_torchscript_parity():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, model in create_models().items():
+            filepath = os.path.join(tmp_dir, name + '.pt')
+            export.export_torchscript(model, filepath)
+            check_parity(model, export.ExportedSeparator(filepath))
+
+
+def test_onnx_parity():
+    try:
+        import onnxruntime
+    except ImportError:
+        print('Could not find onnxruntime, skipping the ONNX parity test')
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, model in create_models().items():
+            filepath = os.path.join(tmp_dir, name + '.onnx')
+            export.export_onnx(model, filepath)
+            check_parity(model, export.ExportedSeparator(filepath))
+
+
+def test_export_keeps_the_model():
+    model = create_models()['improved'].train()
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export.export_torchscript(model, os.path.join(tmp_dir, 'model.pt'))
+    assert model.training
+    assert model.state_dict().keys() == state_dict.keys()
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, state_dict[k])
+
+
+if __name__ == "__main__":
+    test_torchscript_parity()
+    test_onnx_parity()
+    test_export_keeps_the_model()
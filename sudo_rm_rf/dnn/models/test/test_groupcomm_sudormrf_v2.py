@@ -0,0 +1,76 @@
+"""!
+@brief Testing the time-major TAC of the GroupComm SuDO-RM-RF model against
+the permuting implementation which it replaced
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+from time import time
+import sys
+sys.path.append("../../../")
+import dnn.models.groupcomm_sudormrf_v2 as sudormrf_gc_v2
+
+
+def reference_tac(tac, input):
+    batch_size, G, N, T = input.shape
+    group_input = input.permute(0, 3, 1, 2).contiguous().view(-1, N)
+    group_output = tac.TAC_input(group_input).view(batch_size, T, G, -1)
+    group_mean = group_output.mean(2).view(batch_size * T, -1)
+    group_output = group_output.view(batch_size * T, G, -1)
+    group_mean = tac.TAC_mean(group_mean).unsqueeze(1).expand_as(
+        group_output).contiguous()
+    group_output = torch.cat([group_output, group_mean], 2)
+    group_output = tac.TAC_output(
+        group_output.view(-1, group_output.shape[-1]))
+    group_output = group_output.view(batch_size, T, G, -1).permute(
+        0, 2, 3, 1).contiguous()
+    group_output = tac.TAC_norm(group_output.view(batch_size * G, N, T))
+    return input + group_output.view(input.shape)
+
+
+def test_tac_matches_reference():
+    torch.manual_seed(0)
+    tac = sudormrf_gc_v2.TAC(16, 48).double()
+    x = torch.randn(2, 8, 16, 100, dtype=torch.float64, requires_grad=True)
+    output = tac(x)
+    reference = reference_tac(tac, x)
+    assert torch.allclose(output, reference)
+
+    # The TAC ends with a GlobLN, so the gradients of output.sum() are
+    # about zero and a random cotangent is needed to compare them
+    cotangent = torch.randn_like(output)
+    params = [x] + list(tac.parameters())
+    grads = torch.autograd.grad((output * cotangent).sum(), params)
+    ref_grads = torch.autograd.grad((reference * cotangent).sum(), params)
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert torch.allclose(grad, ref_grad)
+
+
+def benchmark_tac(batch_size=4, length=3200, repeats=20):
+    # The TAC of the groupcomm_sudormrf_v2_U8 entry of benchmark_models.py:
+    # 256 channels in 16 groups, on 4 secs at 8kHz encoded with a stride
+    # of 10
+    tac = sudormrf_gc_v2.TAC(16, 48)
+    x = torch.randn(batch_size, 16, 16, length, requires_grad=True)
+    for name, forward in [('permuting', lambda: reference_tac(tac, x)),
+                          ('time-major', lambda: tac(x))]:
+        for mode in ['forward', 'backward']:
+            timings = []
+            for _ in range(repeats + 1):
+                before = time()
+                if mode == 'forward':
+                    with torch.no_grad():
+                        forward()
+                else:
+                    forward().sum().backward()
+                timings.append(time() - before)
+            # The first run is a warm-up
+            print('{} TAC {}: {:.2f} ms'.format(
+                name, mode, 1000 * sorted(timings[1:])[repeats // 2]))
+
+
+if __name__ == "__main__":
+    test_tac_matches_reference()
+    benchmark_tac()
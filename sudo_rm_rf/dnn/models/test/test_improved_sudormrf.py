@@ -0,0 +1,162 @@
+"""!
+@brief Testing the chunked inference of the improved SuDO-RM-RF model
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.improved_sudormrf as improved_sudormrf
+
+
+def sisdr(est, target):
+    est = est - est.mean(-1, keepdim=True)
+    target = target - target.mean(-1, keepdim=True)
+    s_t = ((est * target).sum(-1, keepdim=True) /
+           (target * target).sum(-1, keepdim=True) * target)
+    return 10 * torch.log10((s_t ** 2).sum(-1) / ((est - s_t) ** 2).sum(-1))
+
+
+def create_model(num_blocks=2, early_exit_blocks=None):
+    torch.manual_seed(0)
+    return improved_sudormrf.SuDORMRF(out_channels=32,
+                                      in_channels=64,
+                                      num_blocks=num_blocks,
+                                      upsampling_depth=4,
+                                      enc_kernel_size=21,
+                                      enc_num_basis=64,
+                                      num_sources=2,
+                                      early_exit_blocks=early_exit_blocks
+                                      ).eval()
+
+
+def test_separate_long_matches_one_shot(fs=8000, timelength=20.):
+    model = create_model()
+    t = torch.arange(int(fs * timelength)) / fs
+    mixture = (torch.sin(2 * 3.14 * 220 * t) * torch.sin(2 * 3.14 * 0.3 * t)
+               + 0.5 * torch.randn_like(t)).view(1, 1, -1)
+    mixture = (mixture - mixture.mean()) / mixture.std()
+    with torch.no_grad():
+        one_shot = model(mixture)
+    chunked = model.separate_long(mixture, chunk_seconds=4.,
+                                  overlap_seconds=1., fs=fs)
+    assert chunked.shape == one_shot.shape
+    assert (sisdr(chunked, one_shot) > 20.).all()
+
+
+def test_separate_long_short_input():
+    model = create_model()
+    mixture = torch.randn(2, 1, 8000)
+    with torch.no_grad():
+        one_shot = model(mixture)
+    assert torch.allclose(model.separate_long(mixture), one_shot)
+
+
+def test_separate_long_reconstructs_identity(chunk=4000, overlap=1000):
+    model = create_model()
+    # Two distinct sources so that the alignment has something to match
+    model.forward = lambda x: torch.cat([x, x ** 2], 1)
+    hop = chunk - overlap
+    # Including a last chunk which ends a few samples after the regular ones
+    for n_samples in [chunk + hop + 10, chunk + 2 * hop, chunk + 2 * hop + 1,
+                      chunk + hop + overlap + 1, 5 * chunk + 123]:
+        mixture = torch.randn(2, 1, n_samples)
+        estimates = model.separate_long(mixture, chunk_seconds=chunk / 8000.,
+                                        overlap_seconds=overlap / 8000.)
+        assert torch.allclose(estimates, model(mixture), atol=1e-5)
+
+
+def test_align_sources_undoes_swap():
+    est = torch.randn(3, 2, 100)
+    swapped = est[:, [1, 0]]
+    swapped[1] = est[1]
+    aligned = improved_sudormrf.SuDORMRF.align_sources(
+        swapped, est[..., :40], 40)
+    assert torch.equal(aligned, est)
+
+
+def test_fuse_for_inference():
+    model = create_model()
+    torch.nn.init.normal_(model.ln.gamma)
+    torch.nn.init.normal_(model.ln.beta)
+    mixture = torch.randn(2, 1, 8000)
+    with torch.no_grad():
+        before = model(mixture)
+        after = model.fuse_for_inference()(mixture)
+    assert torch.allclose(before, after, atol=1e-5)
+
+
+def test_early_exits():
+    model = create_model(num_blocks=4, early_exit_blocks=[2, 1])
+    mixture = torch.randn(2, 1, 8000)
+    with torch.no_grad():
+        full = model(mixture)
+        all_exits = model.forward_early_exits(mixture)
+    assert all_exits.shape == (2, 3, 2, 8000)
+    assert torch.allclose(all_exits[:, -1], full, atol=1e-6)
+    for max_blocks, exit_ind in [(1, 0), (3, 1), (4, 2), (None, 2)]:
+        est = model.separate_early_exit(mixture, max_blocks=max_blocks)
+        assert torch.allclose(est, all_exits[:, exit_ind], atol=1e-6)
+    # An exhausted budget stops at the first exit
+    est = model.separate_early_exit(mixture, deadline_ms=0.)
+    assert torch.allclose(est, all_exits[:, 0], atol=1e-6)
+
+
+def test_early_exit_budget_below_first_exit():
+    mixture = torch.randn(1, 1, 8000)
+    for early_exit_blocks in [[2], None]:
+        model = create_model(num_blocks=4,
+                             early_exit_blocks=early_exit_blocks)
+        try:
+            model.separate_early_exit(mixture, max_blocks=1)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_checkpointing_gradients():
+    model = create_model(num_blocks=3).train()
+    mixture = torch.randn(2, 1, 8000)
+    model(mixture).pow(2).mean().backward()
+    grads = [p.grad.clone() for p in model.parameters()]
+    for every_k_blocks, highest_res_levels in [(1, 0), (2, 2), (0, 4)]:
+        model.zero_grad()
+        model.set_checkpointing(every_k_blocks=every_k_blocks,
+                                highest_res_levels=highest_res_levels)
+        model(mixture).pow(2).mean().backward()
+        for p, grad in zip(model.parameters(), grads):
+            assert torch.allclose(p.grad, grad, atol=1e-6)
+
+
+def test_checkpointing_saves_activations():
+    block = create_model().sm[0].train()
+    x = torch.randn(1, 32, 4000, requires_grad=True)
+    saved_bytes = []
+    for checkpoint_levels in [0, 1]:
+        block.checkpoint_levels = checkpoint_levels
+        sizes = []
+
+        def pack(t):
+            sizes.append(t.numel() * t.element_size())
+            return t
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            block(x)
+        saved_bytes.append(sum(sizes))
+    # Only the input of the full resolution unit and the res_conv input
+    # are kept instead of the activations of all the levels
+    assert saved_bytes[1] < saved_bytes[0] / 4
+
+
+if __name__ == "__main__":
+    test_separate_long_matches_one_shot()
+    test_separate_long_short_input()
+    test_separate_long_reconstructs_identity()
+    test_align_sources_undoes_swap()
+    test_fuse_for_inference()
+    test_early_exits()
+    test_early_exit_budget_below_first_exit()
+    test_checkpointing_gradients()
+    test_checkpointing_saves_activations()
@@ -0,0 +1,65 @@
+"""!
+@brief Testing the int8 quantization of the improved SuDO-RM-RF model
+against the floating point model
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.improved_sudormrf as improved_sudormrf
+import dnn.models.quantization as quantization
+
+
+def sisdr(est, target):
+    est = est - est.mean(-1, keepdim=True)
+    target = target - target.mean(-1, keepdim=True)
+    s_t = ((est * target).sum(-1, keepdim=True) /
+           (target * target).sum(-1, keepdim=True) * target)
+    return 10 * torch.log10((s_t ** 2).sum(-1) / ((est - s_t) ** 2).sum(-1))
+
+
+def create_model():
+    torch.manual_seed(0)
+    return improved_sudormrf.SuDORMRF(out_channels=32,
+                                      in_channels=64,
+                                      num_blocks=2,
+                                      upsampling_depth=4,
+                                      enc_kernel_size=21,
+                                      enc_num_basis=64,
+                                      num_sources=2).eval()
+
+
+def check_close_to_float(model, quantized_model, min_sisdr=15.):
+    mixture = torch.randn(2, 1, 8000)
+    with torch.no_grad():
+        float_sources = model(mixture)
+        quantized_sources = quantized_model(mixture)
+    assert quantized_sources.shape == float_sources.shape
+    assert (sisdr(quantized_sources, float_sources) > min_sisdr).all()
+    # The quantized model is deployed as a TorchScript module
+    scripted_model = torch.jit.script(quantized_model)
+    with torch.no_grad():
+        assert torch.allclose(scripted_model(mixture), quantized_sources)
+
+
+def test_dynamic_quantization():
+    model = create_model()
+    quantized_model = quantization.quantize(model, 'dynamic')
+    assert isinstance(model.bottleneck, torch.nn.Conv1d)
+    check_close_to_float(model, quantized_model)
+
+
+def test_static_quantization():
+    model = create_model()
+    calibration_mixtures = [torch.randn(4, 1, 8000) for _ in range(8)]
+    quantized_model = quantization.quantize(
+        model, 'static', calibration_mixtures=calibration_mixtures)
+    check_close_to_float(model, quantized_model)
+
+
+if __name__ == "__main__":
+    test_dynamic_quantization()
+    test_static_quantization()
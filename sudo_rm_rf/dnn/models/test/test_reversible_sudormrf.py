@@ -0,0 +1,80 @@
+"""!
+@brief Testing the gradients of the reversible SuDO-RM-RF blocks, which
+reconstruct their inputs in the backward pass, against plain autograd
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.reversible_sudormrf as reversible_sudormrf
+
+
+def create_model(num_blocks=3):
+    torch.manual_seed(0)
+    return reversible_sudormrf.ReversibleSuDORMRF(out_channels=32,
+                                                  in_channels=64,
+                                                  num_blocks=num_blocks,
+                                                  upsampling_depth=4,
+                                                  enc_kernel_size=21,
+                                                  enc_num_basis=64,
+                                                  num_sources=2).train()
+
+
+def get_gradients(model, mixture):
+    model.zero_grad()
+    model(mixture).pow(2).mean().backward()
+    return [p.grad.clone() for p in model.parameters()]
+
+
+def test_inverse():
+    block = reversible_sudormrf.ReversibleUConvBlock(
+        out_channels=32, in_channels=64, upsampling_depth=4)
+    x = torch.randn(2, 32, 400)
+    with torch.no_grad():
+        assert torch.allclose(block.inverse(block(x)), x, atol=1e-5)
+
+
+def test_gradients_match_autograd():
+    model = create_model()
+    mixture = torch.randn(2, 1, 8000)
+    reversible_grads = get_gradients(model, mixture)
+
+    # The same blocks without the reversible function store their
+    # activations and go through plain autograd
+    model.sm.forward = lambda x: torch.nn.Sequential(*model.sm.blocks)(x)
+    autograd_grads = get_gradients(model, mixture)
+    for reversible_grad, autograd_grad in zip(reversible_grads,
+                                              autograd_grads):
+        assert torch.allclose(reversible_grad, autograd_grad, atol=1e-5)
+
+
+def test_eval_matches_train_forward():
+    model = create_model()
+    mixture = torch.randn(2, 1, 8000)
+    train_output = model(mixture)
+    with torch.no_grad():
+        eval_output = model.eval()(mixture)
+    assert torch.allclose(train_output, eval_output, atol=1e-6)
+
+
+def test_unsupported_methods():
+    model = create_model().eval()
+    mixture = torch.randn(1, 1, 8000)
+    for call in [lambda: model.forward_early_exits(mixture),
+                 lambda: model.separate_early_exit(mixture, max_blocks=2),
+                 lambda: model.set_checkpointing(every_k_blocks=1)]:
+        try:
+            call()
+            assert False
+        except NotImplementedError:
+            pass
+
+
+if __name__ == "__main__":
+    test_inverse()
+    test_gradients_match_autograd()
+    test_eval_matches_train_forward()
+    test_unsupported_methods()
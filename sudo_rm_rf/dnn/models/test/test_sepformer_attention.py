@@ -0,0 +1,63 @@
+"""!
+@brief Testing the sdpa and the windowed attention backends of the Sepformer
+against the nn.MultiheadAttention one with the same weights
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import torch
+import sys
+sys.path.append("../../../")
+import dnn.models.sepformer as sepformer
+
+
+def create_model(**kwargs):
+    torch.manual_seed(0)
+    return sepformer.SepformerWrapper(
+        encoder_kernel_size=16, encoder_in_nchannels=1,
+        encoder_out_nchannels=32, masknet_chunksize=20,
+        masknet_numlayers=1, masknet_norm="ln",
+        masknet_useextralinearlayer=False, masknet_extraskipconnection=True,
+        masknet_numspks=2, intra_numlayers=1, inter_numlayers=1,
+        intra_nhead=4, inter_nhead=4, intra_dffn=64, inter_dffn=64,
+        intra_use_positional=True, inter_use_positional=True,
+        intra_norm_before=True, inter_norm_before=True, **kwargs).eval()
+
+
+def test_sdpa_backend_matches_torch_backend():
+    model = create_model()
+    x = torch.randn(2, 1, 4000)
+    with torch.no_grad():
+        torch_out = model(x)
+        model.set_attention_backend("sdpa")
+        sdpa_out = model(x)
+    assert sdpa_out.shape == torch_out.shape == (2, 2, 4000)
+    assert torch.allclose(sdpa_out, torch_out, atol=1e-4)
+
+
+def test_large_inter_window_matches_full_attention():
+    # 4000 samples are 500 frames and less than 64 chunks of 20 frames
+    x = torch.randn(1, 1, 4000)
+    with torch.no_grad():
+        full_out = create_model(attention_backend="sdpa")(x)
+        windowed_out = create_model(attention_backend="sdpa",
+                                    inter_attention_window=64)(x)
+    assert torch.allclose(windowed_out, full_out, atol=1e-4)
+
+
+def test_invalid_backend():
+    model = create_model()
+    for kwargs in [dict(backend="linear"),
+                   dict(backend="torch", inter_window_size=8)]:
+        try:
+            model.set_attention_backend(**kwargs)
+            assert False
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    test_sdpa_backend_matches_torch_backend()
+    test_large_inter_window_matches_full_attention()
+    test_invalid_backend()
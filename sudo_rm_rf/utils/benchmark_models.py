@@ -0,0 +1,360 @@
+"""!
+@brief Benchmark suite over all the separation models of dnn/models.
+
+Sweeps input length x batch size x number of threads for the forward
+(inference) and/or the backward (training step) pass. Each configuration runs
+in a fresh process after a few warm-up iterations and reports the median and
+the 95th percentile latency, the real-time factor and the peak resident
+memory. The results are stored as JSON and/or CSV so that the numbers of two
+commits can be compared with --baseline_json. For the models which support
+activation checkpointing, the backward pass is also swept over the
+checkpointing policies to trade the peak memory against the step time.
+
+E.g.:
+python benchmark_models.py --models improved_sudormrf_U16 sepformer \
+--input_samples 8000 32000 --batch_sizes 1 4 --threads 1 4 \
+--output_json bench_$(git rev-parse --short HEAD).json
+
+python benchmark_models.py --models improved_sudormrf_U16 --modes backward \
+--input_samples 80000 160000 --batch_sizes 1 --threads 4 \
+--checkpoint_every_k_blocks 0 1 4 --checkpoint_levels 0 1 2
+
+python benchmark_models.py --modes backward --input_samples 32000 \
+--batch_sizes 4 --threads 4 --models improved_sudormrf_U8 \
+improved_sudormrf_U16 improved_sudormrf_U36 reversible_sudormrf_U8 \
+reversible_sudormrf_U16 reversible_sudormrf_U36
+
+python benchmark_models.py --models sepformer dprnn --modes forward backward \
+--input_samples 80000 240000 480000 --batch_sizes 1 --threads 4 \
+--baseline_json bench_<previous commit>.json
+
+python benchmark_models.py --models sepformer sepformer_sdpa \
+sepformer_sdpa_window16 --input_samples 80000 480000 --batch_sizes 1 \
+--threads 4
+
+python benchmark_models.py --models attentive_sudormrf_v3_U16 \
+attentive_sudormrf_v3_U16_window64 --input_samples 80000 480000 \
+--batch_sizes 1 --threads 4
+
+python benchmark_models.py --models groupcomm_sudormrf_v2_U8 \
+--modes forward backward --input_samples 32000 80000 --batch_sizes 1 4 \
+--threads 1 4 --baseline_json bench_<previous commit>.json
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+
+current_dir = os.path.dirname(os.path.abspath('__file__'))
+root_dir = os.path.abspath(os.path.join(current_dir, '../../'))
+sys.path.append(root_dir)
+import sudo_rm_rf.dnn.models.improved_sudormrf as improved_sudormrf
+import sudo_rm_rf.dnn.models.reversible_sudormrf as reversible_sudormrf
+import sudo_rm_rf.dnn.models.causal_improved_sudormrf_v3 as \
+    causal_improved_sudormrf
+import sudo_rm_rf.dnn.models.attentive_sudormrf as attentive_sudormrf
+import sudo_rm_rf.dnn.models.attentive_sudormrf_v2 as attentive_sudormrf_v2
+import sudo_rm_rf.dnn.models.attentive_sudormrf_v3 as attentive_sudormrf_v3
+import sudo_rm_rf.dnn.models.groupcomm_sudormrf_v2 as sudormrf_gc_v2
+import sudo_rm_rf.dnn.models.sepformer as sepformer
+import sudo_rm_rf.dnn.models.sudormrf as sudormrf
+import sudo_rm_rf.dnn.models.demucs as demucs
+import sudo_rm_rf.dnn.models.dprnn as dprnn
+import sudo_rm_rf.dnn.models.original_convtasnet as original_convtasnet
+import sudo_rm_rf.dnn.models.two_step_tdcn as two_step_tdcn
+
+# The keys which identify a configuration across result files
+CONFIG_KEYS = ['model', 'mode', 'input_samples', 'batch_size', 'threads',
+               'checkpoint_every_k_blocks', 'checkpoint_levels']
+
+
+def get_sepformer_kwargs():
+    return dict(
+        encoder_kernel_size=16, encoder_in_nchannels=1,
+        encoder_out_nchannels=256, masknet_chunksize=250,
+        masknet_numlayers=2, masknet_norm="ln",
+        masknet_useextralinearlayer=False, masknet_extraskipconnection=True,
+        masknet_numspks=2, intra_numlayers=4, inter_numlayers=4,
+        intra_nhead=8, inter_nhead=8, intra_dffn=2048, inter_dffn=2048,
+        intra_use_positional=True, inter_use_positional=True,
+        intra_norm_before=True, inter_norm_before=True)
+
+
+def get_attentive_kwargs():
+    return dict(out_channels=256, in_channels=512, num_blocks=16,
+                upsampling_depth=5, enc_kernel_size=21, enc_num_basis=512,
+                n_heads=4, att_dims=256, att_dropout=0.1, num_sources=2)
+
+
+# Model name: (constructor, whether the input has a channel dimension)
+MODELS = {
+    'improved_sudormrf_U16': (lambda: improved_sudormrf.SuDORMRF(
+        out_channels=256, in_channels=512, num_blocks=16, upsampling_depth=5,
+        enc_kernel_size=21, enc_num_basis=512, num_sources=2), True),
+    'improved_sudormrf_U8': (lambda: improved_sudormrf.SuDORMRF(
+        out_channels=256, in_channels=512, num_blocks=8, upsampling_depth=5,
+        enc_kernel_size=21, enc_num_basis=512, num_sources=2), True),
+    'improved_sudormrf_U36': (lambda: improved_sudormrf.SuDORMRF(
+        out_channels=256, in_channels=512, num_blocks=36, upsampling_depth=5,
+        enc_kernel_size=21, enc_num_basis=512, num_sources=2), True),
+    'reversible_sudormrf_U8': (
+        lambda: reversible_sudormrf.ReversibleSuDORMRF(
+            out_channels=256, in_channels=512, num_blocks=8,
+            upsampling_depth=5, enc_kernel_size=21, enc_num_basis=512,
+            num_sources=2), True),
+    'reversible_sudormrf_U16': (
+        lambda: reversible_sudormrf.ReversibleSuDORMRF(
+            out_channels=256, in_channels=512, num_blocks=16,
+            upsampling_depth=5, enc_kernel_size=21, enc_num_basis=512,
+            num_sources=2), True),
+    'reversible_sudormrf_U36': (
+        lambda: reversible_sudormrf.ReversibleSuDORMRF(
+            out_channels=256, in_channels=512, num_blocks=36,
+            upsampling_depth=5, enc_kernel_size=21, enc_num_basis=512,
+            num_sources=2), True),
+    'causal_sudormrf_U16': (lambda: causal_improved_sudormrf.CausalSuDORMRF(
+        in_audio_channels=1, out_channels=256, in_channels=512,
+        num_blocks=16, upsampling_depth=5, enc_kernel_size=21,
+        enc_num_basis=512, num_sources=2), True),
+    'attentive_sudormrf_U16': (lambda: attentive_sudormrf.SuDORMRF(
+        **get_attentive_kwargs()), True),
+    'attentive_sudormrf_v2_U16': (lambda: attentive_sudormrf_v2.SuDORMRF(
+        **get_attentive_kwargs()), True),
+    'attentive_sudormrf_v3_U16': (lambda: attentive_sudormrf_v3.SuDORMRF(
+        **get_attentive_kwargs()), True),
+    'attentive_sudormrf_U16_window64': (lambda: attentive_sudormrf.SuDORMRF(
+        att_window_size=64, **get_attentive_kwargs()), True),
+    'attentive_sudormrf_v2_U16_window64': (
+        lambda: attentive_sudormrf_v2.SuDORMRF(
+            att_window_size=64, **get_attentive_kwargs()), True),
+    'attentive_sudormrf_v3_U16_window64': (
+        lambda: attentive_sudormrf_v3.SuDORMRF(
+            att_window_size=64, **get_attentive_kwargs()), True),
+    'groupcomm_sudormrf_v2_U8': (lambda: sudormrf_gc_v2.GroupCommSudoRmRf(
+        in_audio_channels=1, out_channels=256, in_channels=512,
+        num_blocks=8, upsampling_depth=5, enc_kernel_size=21,
+        enc_num_basis=512, num_sources=2, group_size=16), True),
+    'sepformer': (lambda: sepformer.SepformerWrapper(
+        **get_sepformer_kwargs()), False),
+    'sepformer_sdpa': (lambda: sepformer.SepformerWrapper(
+        attention_backend='sdpa', **get_sepformer_kwargs()), False),
+    'sepformer_sdpa_window16': (lambda: sepformer.SepformerWrapper(
+        attention_backend='sdpa', inter_attention_window=16,
+        **get_sepformer_kwargs()), False),
+    'sudormrf_R16': (lambda: sudormrf.SuDORMRF(
+        out_channels=128, in_channels=512, num_blocks=16, upsampling_depth=5,
+        enc_kernel_size=21, enc_num_basis=512, num_sources=2), True),
+    'demucs': (lambda: demucs.Demucs(), False),
+    'dprnn': (lambda: dprnn.FaSNet_base(), False),
+    'convtasnet': (lambda: original_convtasnet.TasNet(), True),
+    'two_step_tdcn': (lambda: two_step_tdcn.TDCN(
+        B=256, H=512, P=3, R=4, X=8, L=21, N=256, S=2), True),
+}
+
+# The models with set_checkpointing
+CHECKPOINTED_MODELS = ['improved_sudormrf_U16']
+
+
+def get_args():
+    """! Command line parser """
+    parser = argparse.ArgumentParser(
+        description='Benchmark suite for all the separation models.')
+    parser.add_argument("--models", type=str, nargs='+',
+                        default=list(MODELS.keys()),
+                        choices=list(MODELS.keys()))
+    parser.add_argument("--modes", type=str, nargs='+', default=['forward'],
+                        choices=['forward', 'backward'],
+                        help="""forward: inference without gradients,
+                        backward: forward, backward and optimizer step.""")
+    parser.add_argument("--input_samples", type=int, nargs='+',
+                        default=[8000, 32000])
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 4])
+    parser.add_argument("--threads", type=int, nargs='+',
+                        default=[1, os.cpu_count()])
+    parser.add_argument("--checkpoint_every_k_blocks", type=int, nargs='+',
+                        default=[0],
+                        help="""Activation checkpointing of every k-th block
+                        in the backward mode, 0 disables it.""")
+    parser.add_argument("--checkpoint_levels", type=int, nargs='+',
+                        default=[0],
+                        help="""Activation checkpointing of this number of
+                        the highest resolution levels of every block in the
+                        backward mode, 0 disables it.""")
+    parser.add_argument("--warmup", type=int, default=2,
+                        help="""Untimed iterations before measuring.""")
+    parser.add_argument("-r", "--repeats", type=int, default=10,
+                        help="""Timed iterations for each configuration.""")
+    parser.add_argument("-fs", type=int, default=8000,
+                        help="""Sampling rate for the real-time factor.""")
+    parser.add_argument("--output_json", type=str, default=None)
+    parser.add_argument("--output_csv", type=str, default=None)
+    parser.add_argument("--baseline_json", type=str, default=None,
+                        help="""The JSON output of a previous run to compare
+                        the median latencies with.""")
+    return parser.parse_args()
+
+
+def get_peak_rss_mb():
+    # Linux reports kilobytes and macOS bytes
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+
+
+def get_metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(
+                os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {'commit': commit,
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def run_configuration(config):
+    """! Measures a single configuration. It runs in its own process so that
+    the peak memory and the number of threads refer only to it."""
+    torch.set_num_threads(config['threads'])
+    torch.manual_seed(0)
+    rss_before_model = get_peak_rss_mb()
+
+    model_builder, has_channel_dim = MODELS[config['model']]
+    model = model_builder()
+    n_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    input_shape = [config['batch_size'], config['input_samples']]
+    if has_channel_dim:
+        input_shape.insert(1, 1)
+    mixture = torch.rand(input_shape)
+
+    if config['mode'] == 'forward':
+        model.eval()
+
+        def step():
+            with torch.no_grad():
+                model(mixture)
+    else:
+        model.train()
+        if (config['checkpoint_every_k_blocks'] > 0 or
+                config['checkpoint_levels'] > 0):
+            model.set_checkpointing(
+                every_k_blocks=config['checkpoint_every_k_blocks'],
+                highest_res_levels=config['checkpoint_levels'])
+        opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+        def step():
+            opt.zero_grad()
+            # The loss does not matter for the cost of the backward pass
+            model(mixture).abs().mean().backward()
+            opt.step()
+
+    for _ in range(config['warmup']):
+        step()
+    timings = []
+    for _ in range(config['repeats']):
+        before = time.perf_counter()
+        step()
+        timings.append(time.perf_counter() - before)
+
+    timings = np.array(timings)
+    audio_seconds = config['batch_size'] * config['input_samples'] / \
+        float(config['fs'])
+    result = {k: config[k] for k in CONFIG_KEYS}
+    result.update({
+        'parameters': n_params,
+        'median_ms': 1000. * float(np.median(timings)),
+        'p95_ms': 1000. * float(np.percentile(timings, 95)),
+        'mean_ms': 1000. * float(np.mean(timings)),
+        'rtf': float(np.median(timings)) / audio_seconds,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'model_peak_rss_mb': get_peak_rss_mb() - rss_before_model})
+    return result
+
+
+def get_config_key(result):
+    # The results of older runs do not have the checkpointing keys
+    return tuple(result.get(k, 0) for k in CONFIG_KEYS)
+
+
+def compare_with_baseline(results, baseline_json):
+    with open(baseline_json, 'r') as f:
+        baseline = {get_config_key(r): r for r in json.load(f)['results']
+                    if 'median_ms' in r}
+    print('Median latency compared to: {}'.format(baseline_json))
+    for result in results:
+        key = get_config_key(result)
+        if key in baseline and 'median_ms' in result:
+            print('{}: {:.2f} ms -> {:.2f} ms ({:.2f}x)'.format(
+                ', '.join(map(str, key)), baseline[key]['median_ms'],
+                result['median_ms'],
+                baseline[key]['median_ms'] / result['median_ms']))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for (model_name, mode, input_samples, batch_size, threads,
+         checkpoint_every_k_blocks, checkpoint_levels) in itertools.product(
+            args.models, args.modes, args.input_samples, args.batch_sizes,
+            args.threads, args.checkpoint_every_k_blocks,
+            args.checkpoint_levels):
+        if checkpoint_every_k_blocks > 0 or checkpoint_levels > 0:
+            # Checkpointing only affects the training step
+            if mode != 'backward' or model_name not in CHECKPOINTED_MODELS:
+                continue
+        config = {'model': model_name, 'mode': mode,
+                  'input_samples': input_samples, 'batch_size': batch_size,
+                  'threads': threads,
+                  'checkpoint_every_k_blocks': checkpoint_every_k_blocks,
+                  'checkpoint_levels': checkpoint_levels,
+                  'warmup': args.warmup, 'repeats': args.repeats,
+                  'fs': args.fs}
+        with ctx.Pool(1) as pool:
+            try:
+                result = pool.apply(run_configuration, (config,))
+                print('{model} {mode} samples: {input_samples} bs: '
+                      '{batch_size} threads: {threads} checkpointing: '
+                      '{checkpoint_every_k_blocks}/{checkpoint_levels} | '
+                      'median: '
+                      '{median_ms:.2f} ms p95: {p95_ms:.2f} ms rtf: '
+                      '{rtf:.4f} peak rss: {peak_rss_mb:.0f} MB'.format(
+                       **result))
+            except Exception as e:
+                result = {k: config[k] for k in CONFIG_KEYS}
+                result['error'] = repr(e)
+                print('{} failed: {}'.format(get_config_key(result), e))
+        results.append(result)
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as f:
+            json.dump({'metadata': get_metadata(), 'results': results}, f,
+                      indent=2)
+    if args.output_csv is not None:
+        fieldnames = []
+        for result in results:
+            fieldnames += [k for k in result if k not in fieldnames]
+        with open(args.output_csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+    if args.baseline_json is not None:
+        compare_with_baseline(results, args.baseline_json)
@@ -0,0 +1,370 @@
+"""!
+@brief Batched evaluation of several pretrained separation models on a test
+split, e.g. WSJ0-2mix or WHAMR! from the WHAMR! tt folder, in a single pass.
+
+The mixtures and the ground truth sources are decoded once in a shared memory
+cache and the utterances are bucketed by length so that each batch needs
+minimal padding. The metrics are computed in a pool of processes while the
+next batches are separated and each (model, utterance) result is appended to
+a jsonl file, so an interrupted evaluation resumes where it stopped.
+
+E.g.:
+python evaluate_models.py --dataset_dirpath /mnt/data/whamr/wav8k/min/tt \
+--mixture_folder mix_both_reverb \
+--model_paths ../../pretrained_models/Improved_Sudormrf_U16_Bases2048_WHAMRexclmark.pt \
+../../pretrained_models/Improved_Sudormrf_U36_Bases4096_WHAMRexclmark.pt \
+--results_filepath whamr_tt_results.jsonl
+
+The speechbrain Sepformer can also run with the memory-efficient attention
+of the Sepformer of this repo, e.g. on minute-long utterances:
+python evaluate_models.py --dataset_dirpath /mnt/data/whamr/wav8k/min/tt \
+--mixture_folder mix_both_reverb --model_paths sepformer \
+--sepformer_attention sdpa --results_filepath whamr_tt_results.jsonl
+
+The separation time of each model is also reported, e.g. for comparing the
+GroupComm SuDO-RM-RF of two commits on WSJ0-2mix:
+python evaluate_models.py --dataset_dirpath /mnt/data/whamr/wav8k/min/tt \
+--model_paths \
+../../pretrained_models/GroupCom_Sudormrf_U8_Bases512_WSJ02mix.pt \
+--results_filepath wsj02mix_tt_$(git rev-parse --short HEAD).jsonl
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from pprint import pprint
+import numpy as np
+import torch
+from scipy.io import wavfile
+from tqdm import tqdm
+from asteroid.metrics import get_metrics
+
+current_dir = os.path.dirname(os.path.abspath('__file__'))
+root_dir = os.path.abspath(os.path.join(current_dir, '../../'))
+sys.path.append(root_dir)
+import sudo_rm_rf.dnn.dataset_loader.wav_index as wav_index
+import sudo_rm_rf.dnn.experiments.utils.mixture_consistency as \
+    mixture_consistency
+import sudo_rm_rf.dnn.models.sepformer as sepformer
+
+SEPFORMER = 'sepformer'
+# The configuration of speechbrain/sepformer-wsj02mix
+SPEECHBRAIN_SEPFORMER_KWARGS = dict(
+    encoder_kernel_size=16, encoder_in_nchannels=1,
+    encoder_out_nchannels=256, masknet_chunksize=250, masknet_numlayers=2,
+    masknet_norm="ln", masknet_useextralinearlayer=False,
+    masknet_extraskipconnection=True, masknet_numspks=2, intra_numlayers=8,
+    inter_numlayers=8, intra_nhead=8, inter_nhead=8, intra_dffn=1024,
+    inter_dffn=1024, intra_use_positional=True, inter_use_positional=True,
+    intra_norm_before=True, inter_norm_before=True)
+
+# The view of the shared memory cache in each process
+_CACHE = {}
+
+
+def get_args():
+    """! Command line parser """
+    parser = argparse.ArgumentParser(
+        description='Batched evaluation of pretrained separation models.')
+    parser.add_argument("--dataset_dirpath", type=str, required=True,
+                        help="""The path of the test split, e.g.
+                        /mnt/data/whamr/wav8k/min/tt""")
+    parser.add_argument("--mixture_folder", type=str,
+                        default='mix_clean_anechoic',
+                        help="""The folder of the input mixtures, e.g.
+                        mix_clean_anechoic for WSJ0-2mix or mix_both_reverb
+                        for WHAMR!""")
+    parser.add_argument("--source_folders", type=str, nargs='+',
+                        default=['s1_anechoic', 's2_anechoic'],
+                        help="""The folders of the ground truth sources.""")
+    parser.add_argument("--model_paths", type=str, nargs='+', required=True,
+                        help="""The paths of the pretrained models. Use
+                        'sepformer' for the speechbrain Sepformer trained
+                        on WSJ0-2mix.""")
+    parser.add_argument("--results_filepath", type=str, required=True,
+                        help="""The jsonl file with the per utterance
+                        results. If it exists, the utterances which are
+                        already evaluated are skipped.""")
+    parser.add_argument("--max_batch_samples", type=int, default=2 ** 20,
+                        help="""Maximum number of padded samples in each
+                        batch.""")
+    parser.add_argument("--max_length_samples", type=int, default=None,
+                        help="""If set, the utterances are cropped to this
+                        number of samples.""")
+    parser.add_argument("--sample_rate", type=int, default=8000)
+    parser.add_argument("--metrics", type=str, nargs='+', default=['all'],
+                        help="""The asteroid metrics to compute e.g. si_sdr
+                        sdr pesq stoi.""")
+    parser.add_argument("--n_jobs", type=int, default=os.cpu_count(),
+                        help="""The number of processes for decoding and
+                        computing the metrics.""")
+    parser.add_argument("--sepformer_attention", type=str, default='torch',
+                        choices=sepformer.ATTENTION_BACKENDS,
+                        help="""The attention implementation of the
+                        speechbrain Sepformer. With sdpa its weights are
+                        loaded in the Sepformer of this repo which does not
+                        materialize the attention matrices.""")
+    parser.add_argument("--sepformer_inter_window", type=int, default=None,
+                        help="""If set with --sepformer_attention sdpa, the
+                        inter-chunk attention is windowed with this number
+                        of chunks.""")
+    parser.add_argument("--device", type=str, default='gpu',
+                        choices=['cpu', 'gpu'])
+    parser.add_argument("-cad", "--cuda_available_devices", type=str,
+                        nargs="+", default=['0'],
+                        help="""A list of Cuda IDs that would be
+                        available for running this script.""")
+    return parser.parse_args()
+
+
+def normalize_wav(wav, eps=1e-8):
+    return (wav - wav.mean(-1, keepdims=True)) / (
+            wav.std(-1, keepdims=True) + eps)
+
+
+def attach_cache(shm_name, shape):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _CACHE['shm'] = shm
+    _CACHE['samples'] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+
+
+def decode_file(args):
+    folder_ind, file_path, offset, length = args
+    _, waveform = wavfile.read(file_path)
+    waveform = waveform[:length]
+    if np.issubdtype(waveform.dtype, np.integer):
+        waveform = waveform / float(np.iinfo(waveform.dtype).max + 1)
+    _CACHE['samples'][folder_ind, offset:offset + length] = waveform
+
+
+def compute_metrics(args):
+    """! Computes the metrics of an utterance in a pool process. Only the
+    estimated sources are sent, the rest are read from the cache."""
+    model_name, file_name, offset, length, est_sources, metrics_list, \
+        sample_rate = args
+    samples = _CACHE['samples'][:, offset:offset + length]
+    result = {'model': model_name, 'file': file_name}
+    try:
+        metrics_dic = get_metrics(
+            normalize_wav(samples[:1]), normalize_wav(samples[1:]),
+            normalize_wav(est_sources), compute_permutation=True,
+            sample_rate=sample_rate, metrics_list=metrics_list)
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    for k, v in metrics_dic.items():
+        if np.ndim(v) == 0:
+            result[k] = float(v)
+    if 'si_sdr' in result and 'input_si_sdr' in result:
+        result['sisdri'] = result['si_sdr'] - result['input_si_sdr']
+    return result
+
+
+class SharedTestSet(object):
+    """! The mixtures and the sources of all the utterances of a split,
+    decoded once in a shared memory block of shape:
+    (1 + n_sources) x total_samples."""
+
+    def __init__(self, dataset_dirpath, folder_names, pool_size,
+                 max_length_samples=None):
+        file_names, lengths = wav_index.get_mixtures_info(
+            os.path.join(dataset_dirpath, folder_names[0]))
+        if max_length_samples is not None:
+            lengths = np.minimum(lengths, max_length_samples)
+        self.file_names = file_names.tolist()
+        self.lengths = lengths
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        self.shape = (len(folder_names), int(lengths.sum()))
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=4 * self.shape[0] * self.shape[1])
+        self.pool = multiprocessing.Pool(
+            pool_size, initializer=attach_cache,
+            initargs=(self.shm.name, self.shape))
+        attach_cache(self.shm.name, self.shape)
+        self.samples = _CACHE['samples']
+
+        jobs = [(f_ind, os.path.join(dataset_dirpath, folder_name, name),
+                 offset, length)
+                for f_ind, folder_name in enumerate(folder_names)
+                for name, offset, length in zip(
+                    self.file_names, self.offsets, self.lengths)]
+        for _ in tqdm(self.pool.imap_unordered(decode_file, jobs,
+                                               chunksize=64),
+                      total=len(jobs), desc='Decoding'):
+            pass
+
+    def get_batches(self, indices, max_batch_samples):
+        """! Groups the utterances of similar lengths in batches with at
+        most max_batch_samples padded samples."""
+        indices = sorted(indices, key=lambda i: self.lengths[i])
+        batches, batch = [], []
+        for i in indices:
+            if batch and (len(batch) + 1) * self.lengths[i] > \
+                    max_batch_samples:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def get_mixtures(self, batch, normalize=True):
+        """! Returns the zero padded mixtures of a batch."""
+        mixtures = np.zeros((len(batch), max(self.lengths[i] for i in batch)),
+                            dtype=np.float32)
+        for b_ind, i in enumerate(batch):
+            mixture = self.samples[0, self.offsets[i]:
+                                   self.offsets[i] + self.lengths[i]]
+            if normalize:
+                mixture = normalize_wav(mixture)
+            mixtures[b_ind, :self.lengths[i]] = mixture
+        return torch.from_numpy(mixtures)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        _CACHE.clear()
+        self.samples = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def get_model(model_path, device, sepformer_attention='torch',
+              sepformer_inter_window=None):
+    if model_path == SEPFORMER:
+        from speechbrain.pretrained import SepformerSeparation
+        model = SepformerSeparation.from_hparams(
+            source="speechbrain/sepformer-wsj02mix",
+            savedir='../notebooks/pretrained_models/sepformer-wsj02mix',
+            run_opts={"device": device})
+        if sepformer_attention == 'torch':
+            return model, "Sepformer"
+        # The same weights in the copy of the Sepformer of this repo
+        sepformer_model = sepformer.SepformerWrapper(
+            attention_backend=sepformer_attention,
+            inter_attention_window=sepformer_inter_window,
+            **SPEECHBRAIN_SEPFORMER_KWARGS)
+        for name in ['encoder', 'masknet', 'decoder']:
+            getattr(sepformer_model, name).load_state_dict(
+                model.mods[name].state_dict())
+        model_name = "Sepformer_" + sepformer_attention
+        if sepformer_inter_window is not None:
+            model_name += "_window{}".format(sepformer_inter_window)
+        return sepformer_model.eval().to(device), model_name
+    model = torch.load(model_path, map_location=device, weights_only=False)
+    model.eval()
+    return model.to(device), os.path.basename(model_path)
+
+
+def separate(model, model_name, mixtures):
+    if model_name == "Sepformer":
+        return model(mixtures).permute(0, 2, 1)
+    if model_name.startswith("Sepformer"):
+        return model(mixtures.unsqueeze(1))
+    est_sources = model(mixtures.unsqueeze(1))
+    if "Group" in model_name:
+        est_sources = mixture_consistency.apply(est_sources,
+                                                mixtures.unsqueeze(1))
+    return est_sources
+
+
+def load_results(results_filepath):
+    results = []
+    if os.path.lexists(results_filepath):
+        with open(results_filepath, 'r') as f:
+            results = [json.loads(line) for line in f if line.strip()]
+    return results
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.device == 'gpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(
+            args.cuda_available_devices)
+        device = 'cuda'
+    else:
+        device = 'cpu'
+    metrics_list = (args.metrics[0] if args.metrics == ['all']
+                    else args.metrics)
+
+    done = set((r['model'], r['file'])
+               for r in load_results(args.results_filepath))
+    test_set = SharedTestSet(args.dataset_dirpath,
+                             [args.mixture_folder] + args.source_folders,
+                             args.n_jobs,
+                             max_length_samples=args.max_length_samples)
+    try:
+        with open(args.results_filepath, 'a') as results_file:
+            for model_path in args.model_paths:
+                model, model_name = get_model(
+                    model_path, device,
+                    sepformer_attention=args.sepformer_attention,
+                    sepformer_inter_window=args.sepformer_inter_window)
+                remaining = [i for i, name in enumerate(test_set.file_names)
+                             if (model_name, name) not in done]
+                print("======================")
+                print(f"Evaluating model: {model_name} on {len(remaining)} "
+                      f"utterances")
+
+                pending = []
+                separation_secs, separated_samples = 0., 0
+                for batch in tqdm(test_set.get_batches(
+                        remaining, args.max_batch_samples)):
+                    before = time.perf_counter()
+                    with torch.no_grad():
+                        est_sources = separate(
+                            model, model_name,
+                            test_set.get_mixtures(
+                                batch,
+                                normalize=not model_name.startswith(
+                                    "Sepformer")
+                            ).to(device)).cpu()
+                    # The copy to the cpu waits for the separation
+                    separation_secs += time.perf_counter() - before
+                    separated_samples += sum(test_set.lengths[i]
+                                             for i in batch)
+                    for b_ind, i in enumerate(batch):
+                        length = test_set.lengths[i]
+                        pending.append(test_set.pool.apply_async(
+                            compute_metrics,
+                            ((model_name, test_set.file_names[i],
+                              test_set.offsets[i], length,
+                              est_sources[b_ind, :, :length].numpy(),
+                              metrics_list, args.sample_rate),)))
+                    # Write the finished results while the model runs
+                    while pending and pending[0].ready():
+                        results_file.write(
+                            json.dumps(pending.pop(0).get()) + '\n')
+                    results_file.flush()
+                for result in pending:
+                    results_file.write(json.dumps(result.get()) + '\n')
+                results_file.flush()
+                if separated_samples > 0:
+                    audio_secs = separated_samples / float(args.sample_rate)
+                    print(f"Separated {audio_secs:.1f} secs of audio in "
+                          f"{separation_secs:.1f} secs (real-time factor: "
+                          f"{separation_secs / audio_secs:.4f})")
+                del model
+    finally:
+        test_set.close()
+
+    results_dic = {}
+    for result in load_results(args.results_filepath):
+        if 'error' in result:
+            print(f"{result['model']} failed on {result['file']}: "
+                  f"{result['error']}")
+            continue
+        model_results = results_dic.setdefault(result['model'], {})
+        for k, v in result.items():
+            if k not in ['model', 'file']:
+                model_results.setdefault(k, []).append(v)
+    pprint({model_name: {k: float(np.mean(v))
+                         for k, v in model_results.items()}
+            for model_name, model_results in results_dic.items()})
@@ -1,6 +1,9 @@
 """!
 @brief Extract model performance measures using profilers and timing.
 
+For latency and memory sweeps over all the models with structured JSON/CSV
+output use benchmark_models.py instead.
+
 @author Efthymios Tzinis {etzinis2@illinois.edu}
 @copyright University of Illinois at Urbana-Champaign
 """
@@ -0,0 +1,64 @@
+"""!
+@brief Packs the splits of the WHAM, WHAMR! or Libri2Mix datasets in
+pre-decoded memory-mapped shards. The shards of each split are stored under
+the same relative path as the split itself, so by passing
+shards_root_dirpath to the dataset loaders they read the shards instead of
+the wav files.
+
+E.g.:
+python pack_wav_shards.py --dataset_root_dirpath /mnt/data/wham \
+--output_root_dirpath /mnt/nvme/wham_shards \
+--splits wav8k/min/tr wav8k/min/cv wav8k/min/tt
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import argparse
+import os
+import sys
+
+current_dir = os.path.dirname(os.path.abspath('__file__'))
+root_dir = os.path.abspath(os.path.join(current_dir, '../../'))
+sys.path.append(root_dir)
+import sudo_rm_rf.dnn.dataset_loader.wav_shards as wav_shards
+
+
+def get_args():
+    """! Command line parser """
+    parser = argparse.ArgumentParser(
+        description='Pack dataset splits in memory-mapped shards.')
+    parser.add_argument("--dataset_root_dirpath", type=str, required=True,
+                        help="""The root path of the dataset, e.g. 
+                        /mnt/data/wham""")
+    parser.add_argument("--output_root_dirpath", type=str, required=True,
+                        help="""The root path for storing the shards.""")
+    parser.add_argument("--splits", type=str, nargs='+', required=True,
+                        help="""The paths of the splits relatively to the 
+                        dataset root path, e.g. wav8k/min/tr""")
+    parser.add_argument("--folders", type=str, nargs='+', default=None,
+                        help="""The folders of each split to pack, all 
+                        folders with wav files are packed by default.""")
+    parser.add_argument("--dtype", type=str, default=None,
+                        choices=['int16', 'float16', 'float32'],
+                        help="""The dtype of the stored samples, by default 
+                        the dtype of the wav files is kept. Integer samples 
+                        are scaled to [-1, 1) when stored as float32 and 
+                        float samples are scaled back to int16. The 
+                        loaders read them back in the scale of the wav 
+                        files.""")
+    parser.add_argument("--max_shard_samples", type=int, default=2 ** 28,
+                        help="""The maximum number of samples in each 
+                        shard.""")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    for split in args.splits:
+        wav_shards.pack_split(
+            os.path.join(args.dataset_root_dirpath, split),
+            os.path.join(args.output_root_dirpath, split),
+            folder_names=args.folders,
+            max_shard_samples=args.max_shard_samples,
+            dtype=args.dtype)
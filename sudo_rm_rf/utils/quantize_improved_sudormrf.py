@@ -0,0 +1,152 @@
+"""!
+@brief Post-training int8 quantization of a pretrained improved SuDO-RM-RF
+model. The static variant is calibrated on mixtures of the WHAM! cv split
+and every variant is compared with the floating point model on the tt split
+w.r.t. its separation time and SI-SDRi. The quantized models are saved as
+TorchScript modules which run with dnn.models.export.ExportedSeparator.
+
+E.g.:
+python quantize_improved_sudormrf.py \
+--model_path ../../pretrained_models/Improved_Sudormrf_U16_Bases2048_WHAMexclmark.pt \
+--wham_root_dirpath /mnt/data/wham --output_dirpath /tmp/int8 \
+--modes dynamic static
+
+@author Efthymios Tzinis {etzinis2@illinois.edu}
+@copyright University of Illinois at Urbana-Champaign
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pprint import pprint
+import numpy as np
+import torch
+from tqdm import tqdm
+
+current_dir = os.path.dirname(os.path.abspath('__file__'))
+root_dir = os.path.abspath(os.path.join(current_dir, '../../'))
+sys.path.append(root_dir)
+import sudo_rm_rf.dnn.dataset_loader.wham as wham_loader
+import sudo_rm_rf.dnn.losses.sisdr as sisdr_lib
+import sudo_rm_rf.dnn.models.quantization as quantization
+
+
+def get_args():
+    """! Command line parser """
+    parser = argparse.ArgumentParser(
+        description='Int8 quantization of an improved SuDO-RM-RF model.')
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="""The path of the pretrained model saved with
+                        torch.save.""")
+    parser.add_argument("--wham_root_dirpath", type=str, required=True)
+    parser.add_argument("--output_dirpath", type=str, required=True,
+                        help="""Where the quantized TorchScript modules and
+                        the report are stored.""")
+    parser.add_argument("--modes", type=str, nargs='+',
+                        default=quantization.QUANTIZATION_MODES,
+                        choices=quantization.QUANTIZATION_MODES)
+    parser.add_argument("--task", type=str, default='sep_clean',
+                        choices=['sep_clean', 'sep_noisy'])
+    parser.add_argument("--min_or_max", type=str, default='min',
+                        choices=['min', 'max'])
+    parser.add_argument("--n_calibration_utterances", type=int, default=300,
+                        help="""Number of cv mixtures for the calibration of
+                        the static quantization.""")
+    parser.add_argument("--calibration_timelength", type=float, default=4.,
+                        help="""Length of each calibration mixture in
+                        seconds.""")
+    parser.add_argument("--n_test_utterances", type=int, default=0,
+                        help="""Number of tt mixtures for the evaluation,
+                        0 for all of them.""")
+    parser.add_argument("--backend", type=str, default='fbgemm',
+                        choices=['fbgemm', 'qnnpack'],
+                        help="""fbgemm for x86 and qnnpack for arm.""")
+    parser.add_argument("--n_threads", type=int, default=1,
+                        help="""Number of threads of the timed
+                        separation.""")
+    return parser.parse_args()
+
+
+def normalize_tensor_wav(wav_tensor, eps=1e-8, std=None):
+    mean = wav_tensor.mean(-1, keepdim=True)
+    if std is None:
+        std = wav_tensor.std(-1, keepdim=True)
+    return (wav_tensor - mean) / (std + eps)
+
+
+def get_wham_data(args, split, timelength, n_samples, zero_pad):
+    return wham_loader.Dataset(
+        root_dirpath=args.wham_root_dirpath, task=args.task, split=split,
+        sample_rate=8000, timelength=timelength, zero_pad=zero_pad,
+        min_or_max=args.min_or_max, augment=False, normalize_audio=False,
+        n_samples=n_samples)
+
+
+def evaluate(model, test_set, n_sources):
+    sisdri_metric = sisdr_lib.PermInvariantSISDR(
+        batch_size=1, n_sources=n_sources, zero_mean=True,
+        backward_loss=False, improvement=True,
+        return_individual_results=True)
+    sisdris, separation_time = [], 0.
+    with torch.no_grad():
+        for mixture, sources in tqdm(test_set):
+            before = time.perf_counter()
+            est_sources = model(mixture)
+            separation_time += time.perf_counter() - before
+            sisdris += sisdri_metric(est_sources, sources,
+                                     initial_mixtures=mixture).tolist()
+    return {'SISDRi': float(np.mean(sisdris)),
+            'separation_time_sec': separation_time}
+
+
+if __name__ == "__main__":
+    args = get_args()
+    torch.set_num_threads(args.n_threads)
+    os.makedirs(args.output_dirpath, exist_ok=True)
+    model = torch.load(args.model_path, map_location='cpu',
+                       weights_only=False).eval()
+    model_name = os.path.splitext(os.path.basename(args.model_path))[0]
+
+    # The whole tt split is decoded once so that only the separation is
+    # timed
+    test_set = [(normalize_tensor_wav(mixture).view(1, 1, -1),
+                 sources.unsqueeze(0))
+                for mixture, sources in get_wham_data(
+                    args, 'tt', -1., args.n_test_utterances, False)]
+
+    print('Evaluating the floating point model...')
+    results = {'fp32': evaluate(model, test_set, model.num_sources)}
+
+    for mode in args.modes:
+        calibration_mixtures = None
+        if mode == 'static':
+            calibration_generator = get_wham_data(
+                args, 'cv', args.calibration_timelength,
+                args.n_calibration_utterances, True).get_generator(
+                batch_size=4, shuffle=False)
+            calibration_mixtures = [
+                normalize_tensor_wav(mixture).unsqueeze(1)
+                for mixture, _ in calibration_generator]
+        quantized_model = quantization.quantize(
+            model, mode, calibration_mixtures=calibration_mixtures,
+            backend=args.backend)
+
+        print('Evaluating the {} int8 model...'.format(mode))
+        results[mode] = evaluate(quantized_model, test_set,
+                                 model.num_sources)
+        results[mode]['SISDRi_delta'] = (results[mode]['SISDRi'] -
+                                         results['fp32']['SISDRi'])
+        results[mode]['speedup'] = (
+            results['fp32']['separation_time_sec'] /
+            results[mode]['separation_time_sec'])
+        results[mode]['artifact'] = os.path.join(
+            args.output_dirpath, '{}_int8_{}.pt'.format(model_name, mode))
+        torch.jit.script(quantized_model).save(results[mode]['artifact'])
+
+    pprint(results)
+    with open(os.path.join(args.output_dirpath,
+                           '{}_int8_report.json'.format(model_name)),
+              'w') as f:
+        json.dump(results, f, indent=2)